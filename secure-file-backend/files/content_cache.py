@@ -0,0 +1,409 @@
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from functools import lru_cache
+import threading
+import time
+
+
+class FrequencySketch:
+    """
+    Approximate access counts of recently seen keys (TinyLFU).
+
+    A count-min sketch of `depth` rows of small saturating counters.
+    Every `sample_size` increments all counters are halved, so keys that
+    were popular a while ago fade out and new favourites can take over.
+    """
+
+    MAX_COUNT = 15
+    DEPTH = 4
+
+    def __init__(self, width):
+        self.width = 1 << max(width - 1, 1).bit_length()  # Rounded up to a power of two
+        self.sample_size = 10 * self.width
+        self.counters = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self.additions = 0
+
+    def _slots(self, key):
+        mask = self.width - 1
+        return [hash((row, key)) & mask for row in range(self.DEPTH)]
+
+    def estimate(self, key):
+        return min(counters[slot] for counters, slot in zip(self.counters, self._slots(key)))
+
+    def increment(self, key):
+        for counters, slot in zip(self.counters, self._slots(key)):
+            if counters[slot] < self.MAX_COUNT:
+                counters[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.additions //= 2
+            for counters in self.counters:
+                for slot in range(self.width):
+                    counters[slot] >>= 1
+
+
+class ContentCache:
+    """
+    Byte-bounded LRU of decrypted file content with TinyLFU admission.
+
+    Every lookup is counted in a FrequencySketch. When storing an entry
+    needs room, it only pushes out the least recently used entries if it
+    has been asked for more often than each of them; otherwise it isn't
+    cached at all. A burst of one-off downloads therefore can't flush the
+    content that is actually popular. Entries expire after `ttl` seconds
+    and carry a version (the file's encrypted_filename), so a lookup never
+    returns content stored for another version of a key.
+    """
+
+    def __init__(self, max_bytes, max_entry_size, ttl):
+        self.max_bytes = max_bytes
+        self.max_entry_size = min(max_entry_size, max_bytes)
+        self.ttl = ttl
+        self.size = 0
+        # Sized for entries averaging 4 KiB, fewer larger ones are tracked just as well
+        self.sketch = FrequencySketch(max(max_bytes // 4096, 1024))
+        self.stats = dict.fromkeys(
+            ('hits', 'misses', 'admissions', 'rejections', 'evictions', 'expirations', 'invalidations'), 0
+        )
+        self._entries = OrderedDict()  # key -> (version, data, expires_at), least recently used first
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+        return entry is not None
+
+    def get(self, key, version):
+        """Get the cached content of a key, or None"""
+        with self._lock:
+            self.sketch.increment(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, data, expires_at = entry
+                if entry_version == version and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return data
+                self._remove(key)
+                if entry_version == version:
+                    self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, version, data):
+        """
+        Offer content for caching.
+
+        Returns:
+            bool: Whether it was admitted
+        """
+        size = len(data)
+        with self._lock:
+            if size > self.max_entry_size:
+                self.stats['rejections'] += 1
+                return False
+            self._remove(key)
+
+            # Pick the entries that would have to go before changing anything
+            now = time.monotonic()
+            frequency = self.sketch.estimate(key)
+            victims, freed = [], 0
+            for victim_key, (_, victim_data, expires_at) in self._entries.items():
+                if self.size - freed + size <= self.max_bytes:
+                    break
+                if expires_at > now and self.sketch.estimate(victim_key) >= frequency:
+                    self.stats['rejections'] += 1
+                    return False
+                victims.append(victim_key)
+                freed += len(victim_data)
+
+            for victim_key in victims:
+                self._remove(victim_key)
+                self.stats['evictions'] += 1
+            self._entries[key] = (version, data, now + self.ttl)
+            self.size += size
+            self.stats['admissions'] += 1
+            return True
+
+    def invalidate(self, key):
+        """Drop a key's content, e.g. when its file is deleted"""
+        with self._lock:
+            if self._remove(key):
+                self.stats['invalidations'] += 1
+
+    def info(self):
+        """Get the counters and current fill, for tuning the FILE_CONTENT_CACHE_* settings"""
+        with self._lock:
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'max_entry_size': self.max_entry_size,
+                'ttl': self.ttl,
+            }
+
+
+class FellBehind(Exception):
+    """Raised to a SharedStream subscriber that has to read the rest of the content on its own"""
+
+
+class SharedStream:
+    """
+    One pass over a stream of chunks, read by any number of subscribers.
+
+    The leader that creates it announces the length of the content once
+    it's open and then starts it with the chunks, or fails it. Whichever
+    subscriber first needs a chunk that hasn't been read yet reads it;
+    the others wait and take it from a buffer. Chunks are dropped once
+    every subscriber is past them, and the oldest are dropped anyway when
+    the buffer would hold more than `max_bytes`. A subscriber that needs a
+    dropped chunk, or has waited `timeout` seconds for someone else, gets
+    FellBehind. New subscribers can join until the first chunk is dropped.
+    """
+
+    def __init__(self, max_bytes, timeout, on_close, on_fell_behind):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.length = None
+        self._on_close = on_close
+        self._on_fell_behind = on_fell_behind
+        self._chunks = None
+        self._close = None
+        self._buffer = deque()
+        self._base = 0  # Index of the first buffered chunk
+        self._size = 0  # Bytes buffered
+        self._subscribers = set()
+        self._reading = True  # Until started the leader is still opening the content
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def subscribe(self):
+        """Get a subscriber starting at the first chunk, or None when it can't be joined anymore"""
+        with self._condition:
+            if self._closed or self._base or self._error is not None:
+                return None
+            subscriber = StreamSubscriber(self)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def announce(self, length):
+        """Let subscribers know the length of the content the leader opened"""
+        with self._condition:
+            self.length = length
+            self._condition.notify_all()
+
+    def start(self, chunks, close):
+        """Hand over the chunks to share, and what closes them once nobody reads them"""
+        with self._condition:
+            self._chunks = iter(chunks)
+            self._close = close
+            self._reading = False
+            self._condition.notify_all()
+
+    def fail(self, error):
+        """Raise an error to every subscriber instead of starting; FellBehind lets them read on their own"""
+        with self._condition:
+            self._error = error
+            self._reading = False
+            self._condition.notify_all()
+
+    def wait_length(self):
+        """Wait for the leader to announce the length of the content"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.length is not None or self._error is not None, self.timeout):
+                raise FellBehind('Timed out waiting for the content to be opened')
+            if self.length is None:
+                raise self._error
+            return self.length
+
+    def _next(self, subscriber):
+        while True:
+            with self._condition:
+                while True:
+                    position = subscriber.position
+                    if position < self._base:
+                        raise FellBehind('The next chunk was dropped from the buffer')
+                    if position < self._base + len(self._buffer):
+                        chunk = self._buffer[position - self._base]
+                        subscriber.position += 1
+                        subscriber.offset += len(chunk)
+                        self._trim()
+                        return chunk
+                    if self._error is not None:
+                        raise self._error
+                    if self._done:
+                        return None
+                    if not self._reading:
+                        self._reading = True
+                        break
+                    if not self._condition.wait(self.timeout):
+                        raise FellBehind('Timed out waiting for the next chunk')
+            self._read()
+
+    def _read(self):
+        chunk = error = None
+        try:
+            chunk = next(self._chunks, None)
+        except Exception as e:
+            error = e
+            raise
+        except BaseException:
+            # The chunks may not continue where the interrupted read stopped
+            error = FellBehind('The shared read was interrupted')
+            raise
+        finally:
+            with self._condition:
+                self._reading = False
+                if error is not None:
+                    self._error = error
+                elif chunk is None:
+                    self._done = True
+                else:
+                    self._buffer.append(chunk)
+                    self._size += len(chunk)
+                    self._trim()
+                self._condition.notify_all()
+
+    def _trim(self):
+        """Drop the chunks every subscriber is past, and the oldest beyond max_bytes"""
+        needed = min((subscriber.position for subscriber in self._subscribers), default=self._base + len(self._buffer))
+        while self._buffer and (self._base < needed or (self._size > self.max_bytes and len(self._buffer) > 1)):
+            self._size -= len(self._buffer.popleft())
+            self._base += 1
+
+    def _unsubscribe(self, subscriber):
+        with self._condition:
+            self._subscribers.discard(subscriber)
+            if self._subscribers or self._closed:
+                self._trim()
+                return
+            self._closed = True
+            self._buffer.clear()
+            close = self._close
+        if close is not None:
+            close()
+        self._on_close(self)
+
+
+class StreamSubscriber:
+    """Iterator over the chunks of a SharedStream for one reader"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0  # Index of the next chunk
+        self.offset = 0  # Bytes received so far
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = self.stream._next(self)
+        except FellBehind:
+            # Leave right away, so the buffer isn't kept for this subscriber
+            self.close()
+            self.stream._on_fell_behind()
+            raise
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        self.stream._unsubscribe(self)
+
+
+class ContentFlights:
+    """
+    Lets concurrent reads of the same content share one SharedStream.
+
+    The first reader of a key leads a stream, and readers of the key that
+    arrive while its first chunk is still buffered follow it.
+    """
+
+    def __init__(self, buffer_size, timeout=None):
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.stats = dict.fromkeys(('led', 'shared', 'fell_behind'), 0)
+        self._streams = {}  # key -> SharedStream
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """
+        Follow the stream of a key, or lead a new one.
+
+        Returns:
+            tuple: (SharedStream, its subscriber, whether the caller leads it)
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None:
+                subscriber = stream.subscribe()
+                if subscriber is not None:
+                    self.stats['shared'] += 1
+                    return stream, subscriber, False
+
+            stream = self._streams[key] = SharedStream(
+                self.buffer_size,
+                self.timeout,
+                on_close=lambda closed: self._remove(key, closed),
+                on_fell_behind=self._fell_behind,
+            )
+            self.stats['led'] += 1
+            return stream, stream.subscribe(), True
+
+    def _remove(self, key, stream):
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+
+    def _fell_behind(self):
+        with self._lock:
+            self.stats['fell_behind'] += 1
+
+    def info(self):
+        with self._lock:
+            return {**self.stats, 'in_flight': len(self._streams)}
+
+
+@lru_cache(maxsize=None)
+def get_content_cache():
+    """
+    Get this process's cache of decrypted content.
+
+    Returns:
+        ContentCache | None: The cache, or None when FILE_CONTENT_CACHE_SIZE is 0
+    """
+    if not settings.FILE_CONTENT_CACHE_SIZE:
+        return None
+    return ContentCache(
+        settings.FILE_CONTENT_CACHE_SIZE,
+        settings.FILE_CONTENT_CACHE_MAX_ENTRY_SIZE,
+        settings.FILE_CONTENT_CACHE_TTL.total_seconds(),
+    )
+
+
+def invalidate_content(file_id):
+    """Drop a file's content from this process's cache"""
+    cache = get_content_cache()
+    if cache is not None:
+        cache.invalidate(file_id)
+
+
+@lru_cache(maxsize=None)
+def get_content_flights():
+    """Get this process's coalescing of concurrent content reads"""
+    return ContentFlights(settings.FILE_COALESCE_BUFFER_SIZE, settings.FILE_COALESCE_TIMEOUT.total_seconds())
+
+
+@receiver(setting_changed)
+def _reset_content_cache(*, setting, **kwargs):
+    if setting.startswith('FILE_CONTENT_CACHE'):
+        get_content_cache.cache_clear()
+    elif setting.startswith('FILE_COALESCE'):
+        get_content_flights.cache_clear()
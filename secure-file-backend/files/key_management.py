@@ -2,12 +2,27 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ThreadPoolExecutor
 import os
 import base64
 from django.conf import settings
 import secrets
 
+# Segmented AES-256-GCM storage format (see segment_encryptor)
+SEGMENT_MAGIC = b'SFSG'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER_SIZE = 16
+SEGMENT_TAG_SIZE = 16
+SEGMENT_NONCE_PREFIX_SIZE = 7
+
+# Shared pool for sealing and opening segments in parallel;
+# AES-GCM in OpenSSL releases the GIL while it works
+CRYPTO_WORKERS = getattr(settings, 'FILE_CRYPTO_WORKERS', None) or os.cpu_count() or 1
+_crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='file-crypto')
+
 class KeyManagement:
     KEY_STORE_PATH = os.path.join(settings.BASE_DIR, 'key_store')
     MASTER_KEY_PATH = os.path.join(KEY_STORE_PATH, 'master.key')
@@ -58,6 +73,10 @@ class KeyManagement:
     def encrypt_file(file_data, key, iv):
         """
         Encrypt file data using AES-256-CBC
+
+        The ciphertext is written with update_into straight into a single
+        preallocated buffer, so encrypting a file costs one output buffer
+        rather than copies for padding and concatenation.
         
         Args:
             file_data (bytes): The file data to encrypt
@@ -65,7 +84,7 @@ class KeyManagement:
             iv (bytes): 16-byte initialization vector
         
         Returns:
-            bytes: The encrypted file data
+            bytearray: The encrypted file data
         """
         cipher = Cipher(
             algorithms.AES(key),
@@ -74,20 +93,31 @@ class KeyManagement:
         )
         encryptor = cipher.encryptor()
         
-        # Add PKCS7 padding
+        # Add PKCS7 padding to the last, partial block only
         block_size = algorithms.AES.block_size // 8
-        padding_length = block_size - (len(file_data) % block_size)
-        padding = bytes([padding_length] * padding_length)
-        padded_data = file_data + padding
+        data = memoryview(file_data)
+        whole_blocks = len(data) - len(data) % block_size
+        padding_length = block_size - (len(data) % block_size)
+        last_block = bytes(data[whole_blocks:]) + bytes([padding_length] * padding_length)
         
-        # Encrypt the data
-        encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+        # update_into needs block_size - 1 bytes of slack past the output
+        encrypted_data = bytearray(whole_blocks + 2 * block_size - 1)
+        with memoryview(encrypted_data) as out:
+            written = encryptor.update_into(data[:whole_blocks], out)
+            written += encryptor.update_into(last_block, out[written:])
+            encryptor.finalize()
+        del encrypted_data[written:]
         return encrypted_data
     
     @staticmethod
     def decrypt_file(encrypted_data, key, iv):
         """
         Decrypt file data using AES-256-CBC
+
+        The plaintext is written into a single preallocated buffer and the
+        padding trimmed off in place. Data of at least
+        FILE_PARALLEL_DECRYPT_THRESHOLD bytes is decrypted in pieces on the
+        crypto thread pool (see parallel_decrypt).
         
         Args:
             encrypted_data (bytes): The encrypted file data
@@ -95,18 +125,491 @@ class KeyManagement:
             iv (bytes): 16-byte initialization vector
         
         Returns:
-            bytes: The decrypted file data
+            bytearray: The decrypted file data
+        """
+        parallel = len(encrypted_data) >= settings.FILE_PARALLEL_DECRYPT_THRESHOLD
+        padded_data = KeyManagement.parallel_decrypt(encrypted_data, key, iv, None if parallel else 1)
+        
+        # Remove PKCS7 padding
+        padding_length = padded_data[-1]
+        del padded_data[-padding_length:]
+        return padded_data
+
+    @staticmethod
+    def parallel_decrypt(encrypted_data, key, iv, workers=None):
+        """
+        Decrypt AES-256-CBC data on several threads, leaving padding in place.
+
+        Each CBC block only depends on the ciphertext block before it, so
+        the data is split into one block-aligned piece per worker, each
+        decrypted with the last ciphertext block of the piece before it as
+        IV. OpenSSL releases the GIL while it works, so the pieces really
+        run side by side, each writing into its own slice of one output
+        buffer.
+
+        Args:
+            encrypted_data (bytes): The encrypted data, a whole number of blocks
+            key (bytes): 32-byte encryption key
+            iv (bytes): 16-byte initialization vector
+            workers (int): Number of pieces, CRYPTO_WORKERS by default
+
+        Returns:
+            bytearray: The decrypted, still padded data
+        """
+        block_size = algorithms.AES.block_size // 8
+        data = memoryview(encrypted_data)
+        blocks = len(data) // block_size
+        piece_size = max(-(-blocks // (workers or CRYPTO_WORKERS)), 1) * block_size
+
+        # update_into needs block_size - 1 bytes of slack past the output
+        decrypted_data = bytearray(len(data) + block_size - 1)
+        with memoryview(decrypted_data) as out:
+            def decrypt_piece(offset):
+                piece_iv = bytes(data[offset - block_size:offset]) if offset else iv
+                decryptor = Cipher(
+                    algorithms.AES(key),
+                    modes.CBC(piece_iv),
+                    backend=default_backend()
+                ).decryptor()
+                written = decryptor.update_into(data[offset:offset + piece_size], out[offset:])
+                decryptor.finalize()
+                return written
+
+            offsets = range(0, len(data), piece_size)
+            if len(offsets) > 1:
+                written = sum(_crypto_pool.map(decrypt_piece, offsets))
+            else:
+                written = sum(map(decrypt_piece, offsets))
+        del decrypted_data[written:]
+        return decrypted_data
+
+    @staticmethod
+    def stream_decryptor(key, iv):
+        """
+        Create an incremental AES-256-CBC decryptor that strips PKCS7 padding.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): 16-byte initialization vector
+
+        Returns:
+            StreamDecryptor: Decryptor with update() and finalize()
+        """
+        return StreamDecryptor(key, iv)
+
+    @staticmethod
+    def block_decryptor(key, iv):
+        """
+        Create a raw AES-256-CBC decryptor that leaves padding in place.
+
+        CBC decryption of a block only needs the ciphertext block before
+        it, so passing that block as the IV decrypts from any block
+        boundary onwards, which is what byte range requests rely on.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): IV, or the ciphertext block preceding the first one
+
+        Returns:
+            CipherContext: Decryptor with update() and finalize()
+        """
+        return Cipher(
+            algorithms.AES(key),
+            modes.CBC(iv),
+            backend=default_backend()
+        ).decryptor()
+
+    @staticmethod
+    def parallel_block_decryptor(key, iv, workers=None):
+        """
+        Create a raw AES-256-CBC decryptor that splits every update() over
+        the crypto thread pool (see parallel_decrypt), leaving padding in
+        place like block_decryptor().
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): IV, or the ciphertext block preceding the first one
+            workers (int): Pieces each update is split into, CRYPTO_WORKERS by default
+
+        Returns:
+            ParallelBlockDecryptor: Decryptor with update() and finalize()
+        """
+        return ParallelBlockDecryptor(key, iv, workers)
+
+    @staticmethod
+    def decrypted_size(encrypted_size, last_blocks, key, iv):
+        """
+        Work out the decrypted size of AES-256-CBC data from its tail.
+
+        Only the final block has to be decrypted to read the PKCS7 padding
+        length, using the block before it (or the IV) as its IV.
+
+        Args:
+            encrypted_size (int): Total size of the encrypted data
+            last_blocks (bytes): The last 32 bytes (or 16 for a single block)
+            key (bytes): 32-byte encryption key
+            iv (bytes): 16-byte initialization vector
+
+        Returns:
+            int: Size of the data once decrypted and unpadded
         """
+        block_size = algorithms.AES.block_size // 8
+        if encrypted_size == 0 or encrypted_size % block_size:
+            raise ValueError("Encrypted data is not a whole number of blocks")
+
+        previous = last_blocks[-2 * block_size:-block_size] or iv
+        decryptor = Cipher(
+            algorithms.AES(key),
+            modes.CBC(previous),
+            backend=default_backend()
+        ).decryptor()
+        last_block = decryptor.update(last_blocks[-block_size:]) + decryptor.finalize()
+
+        padding_length = last_block[-1]
+        if not 1 <= padding_length <= block_size:
+            raise ValueError("Invalid padding")
+        return encrypted_size - padding_length
+
+    @staticmethod
+    def block_encryptor(key, iv):
+        """
+        Create a raw AES-256-CBC encryptor that adds no padding.
+
+        Used to continue a CBC chain across separately received pieces of
+        a file: passing the last ciphertext block as the IV picks up
+        exactly where the previous piece left off.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): IV, or the last ciphertext block written so far
+
+        Returns:
+            CipherContext: Encryptor with update() and finalize()
+        """
+        return Cipher(
+            algorithms.AES(key),
+            modes.CBC(iv),
+            backend=default_backend()
+        ).encryptor()
+
+    @staticmethod
+    def stream_encryptor(key, iv):
+        """
+        Create an incremental AES-256-CBC encryptor with PKCS7 padding.
+
+        Produces exactly the same output as encrypt_file, but data can be
+        fed in chunks so the whole file never has to be held in memory.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): 16-byte initialization vector
+
+        Returns:
+            StreamEncryptor: Encryptor with update() and finalize()
+        """
+        return StreamEncryptor(key, iv)
+
+    @staticmethod
+    def segment_header(segment_size, iv):
+        """
+        Build the header of a segmented AES-256-GCM record.
+
+        Layout (16 bytes): magic 'SFSG', format version (1 byte), plaintext
+        segment size (4 bytes, big-endian) and the 7-byte nonce prefix,
+        taken from the file's server-side IV.
+
+        Args:
+            segment_size (int): Plaintext bytes per segment
+            iv (bytes): 16-byte server-side IV
+
+        Returns:
+            bytes: The header
+        """
+        return (
+            SEGMENT_MAGIC
+            + bytes([SEGMENT_VERSION])
+            + segment_size.to_bytes(4, 'big')
+            + bytes(iv[:SEGMENT_NONCE_PREFIX_SIZE])
+        )
+
+    @staticmethod
+    def parse_segment_header(header):
+        """
+        Read the segment size from a segmented AES-256-GCM record header.
+
+        Raises:
+            ValueError: If the header is missing, foreign or of an unknown version
+        """
+        if len(header) < SEGMENT_HEADER_SIZE or header[:4] != SEGMENT_MAGIC:
+            raise ValueError("Not a segmented encrypted record")
+        if header[4] != SEGMENT_VERSION:
+            raise ValueError(f"Unsupported segmented format version {header[4]}")
+        segment_size = int.from_bytes(header[5:9], 'big')
+        if not segment_size:
+            raise ValueError("Invalid segment size")
+        return segment_size
+
+    @staticmethod
+    def segmented_size(size, segment_size):
+        """
+        Get the stored size of data in the segmented format.
+
+        Args:
+            size (int): Plaintext size
+            segment_size (int): Plaintext bytes per segment
+
+        Returns:
+            int: Size including the header and one tag per segment
+        """
+        segments = max(-(-size // segment_size), 1)
+        return SEGMENT_HEADER_SIZE + size + segments * SEGMENT_TAG_SIZE
+
+    @staticmethod
+    def segmented_plaintext_size(stored_size, segment_size):
+        """
+        Get the plaintext size of a segmented record from its stored size.
+
+        Raises:
+            ValueError: If no valid record can have that size
+        """
+        body = stored_size - SEGMENT_HEADER_SIZE
+        full_segments, rest = divmod(body, segment_size + SEGMENT_TAG_SIZE)
+        if body < SEGMENT_TAG_SIZE or 0 < rest < SEGMENT_TAG_SIZE:
+            raise ValueError("Truncated segmented record")
+        return full_segments * segment_size + max(rest - SEGMENT_TAG_SIZE, 0)
+
+    @staticmethod
+    def segment_encryptor(key, iv, segment_size, first_segment=0, final=True, header=True):
+        """
+        Create an incremental encryptor for the segmented AES-256-GCM format.
+
+        Data is split into segment_size pieces, each sealed independently
+        with AES-256-GCM under the nonce prefix || segment index || final
+        flag, with the record header as associated data. Segments can
+        therefore be sealed in parallel and checked one at a time, and
+        dropping, reordering or truncating segments fails authentication.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            iv (bytes): 16-byte server-side IV
+            segment_size (int): Plaintext bytes per segment
+            first_segment (int): Index of the first segment produced
+            final (bool): Whether the data ends the record
+            header (bool): Whether to emit the record header first
+
+        Returns:
+            SegmentEncryptor: Encryptor with update() and finalize()
+        """
+        return SegmentEncryptor(key, iv, segment_size, first_segment, final, header)
+
+    @staticmethod
+    def segment_decryptor(key, header, first_segment, total_segments):
+        """
+        Create an incremental decryptor for the segmented AES-256-GCM format.
+
+        Args:
+            key (bytes): 32-byte encryption key
+            header (bytes): The record header
+            first_segment (int): Index of the first segment fed in
+            total_segments (int): Number of segments in the whole record
+
+        Returns:
+            SegmentDecryptor: Decryptor with update() and finalize()
+        """
+        return SegmentDecryptor(key, header, first_segment, total_segments)
+
+
+def segment_nonce(prefix, index, final):
+    """Build the 12-byte GCM nonce of a segment"""
+    return prefix + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+
+class SegmentEncryptor:
+    """Incremental sealing of fixed-size AES-256-GCM segments"""
+
+    def __init__(self, key, iv, segment_size, first_segment=0, final=True, header=True):
+        self._aead = AESGCM(key)
+        self._header = KeyManagement.segment_header(segment_size, iv)
+        self._prefix = self._header[-SEGMENT_NONCE_PREFIX_SIZE:]
+        self._segment_size = segment_size
+        self._index = first_segment
+        self._final = final
+        self._emit_header = header
+        self._batch = CRYPTO_WORKERS
+        self._buffer = bytearray()
+
+    def _seal(self, count, last_final=False):
+        size = self._segment_size
+        first = self._index
+        last = first + count - 1
+
+        def seal(index):
+            offset = (index - first) * size
+            nonce = segment_nonce(self._prefix, index, last_final and index == last)
+            return self._aead.encrypt(nonce, bytes(self._buffer[offset:offset + size]), self._header)
+
+        if count > 1:
+            sealed = list(_crypto_pool.map(seal, range(first, last + 1)))
+        else:
+            sealed = [seal(first)] if count else []
+        del self._buffer[:count * size]
+        self._index += count
+
+        output = b''.join(sealed)
+        if self._emit_header:
+            self._emit_header = False
+            output = self._header + output
+        return output
+
+    def update(self, data):
+        """Buffer the next chunk, returning any segments sealed so far"""
+        self._buffer += data
+        # Hold back the last segment, which may turn out to be the final one
+        count = (len(self._buffer) - 1) // self._segment_size
+        if count < self._batch:
+            return b''
+        return self._seal(count)
+
+    def finalize(self):
+        """Seal the buffered segments, flagging the last one as final"""
+        count = -(-len(self._buffer) // self._segment_size)
+        if self._final:
+            return self._seal(max(count, 1), last_final=True)
+        if len(self._buffer) % self._segment_size:
+            raise ValueError("Only the final piece may end with a partial segment")
+        return self._seal(count)
+
+    def encrypt_chunks(self, chunks):
+        """Encrypt an iterable of chunks, yielding ciphertext as it is produced"""
+        for chunk in chunks:
+            data = self.update(chunk)
+            if data:
+                yield data
+        yield self.finalize()
+
+
+class SegmentDecryptor:
+    """Incremental opening and verification of AES-256-GCM segments"""
+
+    def __init__(self, key, header, first_segment, total_segments):
+        self._aead = AESGCM(key)
+        self._header = bytes(header[:SEGMENT_HEADER_SIZE])
+        self._prefix = self._header[-SEGMENT_NONCE_PREFIX_SIZE:]
+        self._stored_segment_size = KeyManagement.parse_segment_header(self._header) + SEGMENT_TAG_SIZE
+        self._index = first_segment
+        self._total = total_segments
+        self._buffer = bytearray()
+
+    def _open(self, count):
+        size = self._stored_segment_size
+        first = self._index
+
+        def open_segment(index):
+            offset = (index - first) * size
+            nonce = segment_nonce(self._prefix, index, index == self._total - 1)
+            return self._aead.decrypt(nonce, bytes(self._buffer[offset:offset + size]), self._header)
+
+        if count > 1:
+            opened = list(_crypto_pool.map(open_segment, range(first, first + count)))
+        else:
+            opened = [open_segment(first)] if count else []
+        del self._buffer[:count * size]
+        self._index += count
+        return b''.join(opened)
+
+    def update(self, data):
+        """Decrypt the complete segments received so far"""
+        self._buffer += data
+        return self._open(len(self._buffer) // self._stored_segment_size)
+
+    def finalize(self):
+        """Decrypt the remaining, shorter final segment"""
+        if not self._buffer:
+            return b''
+        return self._open(1)
+
+
+class ParallelBlockDecryptor:
+    """Incremental AES-256-CBC decryption of whole blocks on the crypto thread pool"""
+
+    BLOCK_SIZE = 16
+
+    def __init__(self, key, iv, workers=None):
+        self._key = key
+        self._iv = iv
+        self._workers = workers
+        self._buffer = bytearray()
+
+    def update(self, data):
+        """Decrypt the whole blocks received so far, chaining on from the last one"""
+        if self._buffer or len(data) % self.BLOCK_SIZE:
+            self._buffer += data
+            whole = len(self._buffer) - len(self._buffer) % self.BLOCK_SIZE
+            data = bytes(self._buffer[:whole])
+            del self._buffer[:whole]
+        if not data:
+            return b''
+        decrypted = KeyManagement.parallel_decrypt(data, self._key, self._iv, self._workers)
+        self._iv = bytes(data[-self.BLOCK_SIZE:])
+        return bytes(decrypted)
+
+    def finalize(self):
+        if self._buffer:
+            raise ValueError("The length of the provided data is not a multiple of the block length.")
+        return b''
+
+
+class StreamEncryptor:
+    """Incremental AES-256-CBC encryption with PKCS7 padding"""
+
+    def __init__(self, key, iv):
         cipher = Cipher(
             algorithms.AES(key),
             modes.CBC(iv),
             backend=default_backend()
         )
-        decryptor = cipher.decryptor()
-        
-        # Decrypt the data
-        padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
-        
-        # Remove PKCS7 padding
-        padding_length = padded_data[-1]
-        return padded_data[:-padding_length] 
\ No newline at end of file
+        self._encryptor = cipher.encryptor()
+        self._padder = padding.PKCS7(algorithms.AES.block_size).padder()
+
+    def update(self, data):
+        """Encrypt the next chunk, returning the ciphertext available so far"""
+        return self._encryptor.update(self._padder.update(data))
+
+    def finalize(self):
+        """Pad and encrypt the final block"""
+        return self._encryptor.update(self._padder.finalize()) + self._encryptor.finalize()
+
+    def encrypt_chunks(self, chunks):
+        """Encrypt an iterable of chunks, yielding ciphertext as it is produced"""
+        for chunk in chunks:
+            yield self.update(chunk)
+        yield self.finalize()
+
+
+class StreamDecryptor:
+    """Incremental AES-256-CBC decryption that strips PKCS7 padding"""
+
+    def __init__(self, key, iv):
+        cipher = Cipher(
+            algorithms.AES(key),
+            modes.CBC(iv),
+            backend=default_backend()
+        )
+        self._decryptor = cipher.decryptor()
+        self._unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+
+    def update(self, data):
+        """Decrypt the next chunk, holding back the block that may carry padding"""
+        return self._unpadder.update(self._decryptor.update(data))
+
+    def finalize(self):
+        """Decrypt and unpad the final block"""
+        return self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+
+    def decrypt_chunks(self, chunks):
+        """Decrypt an iterable of chunks, yielding plaintext as it is produced"""
+        for chunk in chunks:
+            data = self.update(chunk)
+            if data:
+                yield data
+        yield self.finalize()
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from files.key_management import KeyManagement, CRYPTO_WORKERS
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks server-side decryption, single-threaded against parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[1, 16, 64, 256],
+            help='Payload sizes to benchmark, in MiB'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs per measurement, the best one is reported'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=CRYPTO_WORKERS,
+            help='Pieces the parallel decryption splits data into'
+        )
+
+    def best_of(self, repeat, func, *args):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        workers = options['workers']
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+
+        self.stdout.write(
+            f'CPUs: {os.cpu_count()}, workers: {workers}, '
+            f'parallel threshold: {settings.FILE_PARALLEL_DECRYPT_THRESHOLD // 2 ** 20} MiB'
+        )
+        for size in options['sizes']:
+            payload = os.urandom(size * 2 ** 20)
+            encrypted = KeyManagement.encrypt_file(payload, key, iv)
+            if KeyManagement.parallel_decrypt(encrypted, key, iv, workers)[:len(payload)] != payload:
+                raise AssertionError('Parallel decryption produced different plaintext')
+
+            single = self.best_of(repeat, KeyManagement.parallel_decrypt, encrypted, key, iv, 1)
+            parallel = self.best_of(repeat, KeyManagement.parallel_decrypt, encrypted, key, iv, workers)
+            self.stdout.write(
+                f'✓ AES-256-CBC {size} MiB: '
+                f'1 thread {size / single:.0f} MiB/s, '
+                f'{workers} threads {size / parallel:.0f} MiB/s '
+                f'({single / parallel:.2f}x)'
+            )
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished successfully!'))
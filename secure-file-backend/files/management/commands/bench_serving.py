@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.test import RequestFactory
+from files.key_management import KeyManagement
+from files.models import File, content_encryptor
+from files.serving import open_decrypted_content, accel_redirect_response
+from files.storage import LocalBlobStore
+from types import SimpleNamespace
+import os
+import tempfile
+import time
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks worker time per download for each storage format against X-Accel-Redirect'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[1, 16, 64, 256],
+            help='File sizes to benchmark, in MiB'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per measurement, the best one is reported'
+        )
+
+    def best_of(self, repeat, func, *args):
+        """Get the best (wall, CPU) seconds of a few runs; CPU time covers all threads"""
+        best_wall = best_cpu = None
+        for _ in range(repeat):
+            wall, cpu = time.perf_counter(), time.process_time()
+            func(*args)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            best_wall = wall if best_wall is None else min(best_wall, wall)
+            best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+        return best_wall, best_cpu
+
+    def stream(self, file_instance, store, file_key):
+        """Send a whole file the way file_content_response does, discarding the bytes"""
+        content = open_decrypted_content(file_instance, store.open(file_instance.encrypted_filename), file_key)
+        reader, chunks = content.chunks(settings.FILE_SERVE_CHUNK_SIZE)
+        try:
+            for _ in chunks:
+                pass
+        finally:
+            reader.close()
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        request = RequestFactory().get('/')
+        file_key = KeyManagement.generate_file_key()
+        server_iv = KeyManagement.generate_iv()
+
+        self.stdout.write(
+            f'CPUs: {os.cpu_count()}, serve chunk: {settings.FILE_SERVE_CHUNK_SIZE // 1024} KiB, '
+            f'segment: {settings.FILE_SEGMENT_SIZE // 1024} KiB'
+        )
+        with tempfile.TemporaryDirectory() as location:
+            store = LocalBlobStore(location, accel_redirect='/protected/blobs/')
+            for size in options['sizes']:
+                payload = os.urandom(size * 2 ** 20)
+                results = []
+                for storage_format, _ in File.STORAGE_FORMAT_CHOICES:
+                    file_instance = SimpleNamespace(
+                        encrypted_filename=f'bench-{storage_format}',
+                        storage_format=storage_format,
+                        server_side_iv=server_iv,
+                        filename='bench.bin',
+                        blob_store=store,
+                        content_sha256=None,
+                    )
+                    encryptor = content_encryptor(storage_format, file_key, server_iv)
+                    store.save(file_instance.encrypted_filename, encryptor.encrypt_chunks([payload]))
+
+                    results.append((f'{storage_format} streamed', self.best_of(
+                        repeat, self.stream, file_instance, store, file_key
+                    )))
+                    if storage_format == File.FORMAT_AT_REST:
+                        accel_path = store.accel_redirect_path(file_instance.encrypted_filename)
+                        results.append((f'{storage_format} X-Accel-Redirect', self.best_of(
+                            repeat, accel_redirect_response,
+                            file_instance, accel_path, 'application/octet-stream', 'attachment', request
+                        )))
+                    store.delete(file_instance.encrypted_filename)
+
+                for label, (wall, cpu) in results:
+                    self.stdout.write(
+                        f'✓ {size} MiB {label}: {wall * 1000:.2f} ms wall, {cpu * 1000:.2f} ms CPU'
+                    )
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished successfully!'))
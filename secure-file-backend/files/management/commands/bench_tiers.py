@@ -0,0 +1,155 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from files.key_management import KeyManagement
+from files.models import File, content_encryptor
+from files.storage import get_blob_store
+from files.views import FileContentView
+import io
+import os
+import tempfile
+import time
+import uuid
+
+User = get_user_model()
+
+# FILE_STORAGES alias of the scratch blob store
+BENCH_STORE = 'bench'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks downloads of files kept inline in the database against ones in a blob store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[1, 4, 16, 32, 64, 256],
+            help='File sizes to benchmark, in KiB'
+        )
+        parser.add_argument(
+            '--files',
+            type=int,
+            default=200,
+            help='Files downloaded per measurement'
+        )
+        parser.add_argument(
+            '--store',
+            help='FILE_STORAGES alias to compare against, defaults to a scratch local directory'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per measurement, the best one is reported'
+        )
+
+    def create_files(self, user, size, storage_backend, count):
+        """Store `count` files of `size` bytes in one tier"""
+        file_key = KeyManagement.generate_file_key()
+        encrypted_key = KeyManagement.encrypt_file_key(file_key)
+        files = []
+        for _ in range(count):
+            server_iv = KeyManagement.generate_iv()
+            encryptor = content_encryptor(settings.FILE_STORAGE_FORMAT, file_key, server_iv)
+            content = b''.join(encryptor.encrypt_chunks([os.urandom(size)]))
+            file_instance = File.objects.create(
+                user=user,
+                filename='bench.bin',
+                encrypted_filename=uuid.uuid4().hex,
+                encrypted_file_key=encrypted_key,
+                server_side_iv=server_iv,
+                storage_backend=storage_backend,
+                storage_format=settings.FILE_STORAGE_FORMAT,
+                original_file_size=size,
+            )
+            if storage_backend:
+                get_blob_store(storage_backend).save(file_instance.encrypted_filename, [content])
+                self.stored.append((storage_backend, file_instance.encrypted_filename))
+            else:
+                file_instance.save_inline_content(io.BytesIO(content))
+            files.append(file_instance)
+        return files
+
+    def download_all(self, user, files):
+        """Download every file through the content view, discarding the bytes"""
+        view = FileContentView.as_view()
+        factory = APIRequestFactory()
+        for file_instance in files:
+            request = factory.get(f'/api/files/{file_instance.pk}/content/')
+            force_authenticate(request, user)
+            response = view(request, file_id=file_instance.pk)
+            for _ in response.streaming_content:
+                pass
+            response.close()
+
+    def measure(self, user, files, repeat):
+        """Get the best time per download in ms and the queries one download takes"""
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            self.download_all(user, files)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            self.download_all(user, files[:1])
+        return best / len(files) * 1000, len(queries)
+
+    def handle(self, *args, **options):
+        sizes = [size * 1024 for size in options['sizes']]
+        self.stdout.write(
+            f'CPUs: {os.cpu_count()}, format: {settings.FILE_STORAGE_FORMAT}, '
+            f'{options["files"]} files per measurement'
+        )
+
+        with tempfile.TemporaryDirectory() as location, override_settings(
+            FILE_STORAGES={
+                **settings.FILE_STORAGES,
+                BENCH_STORE: {
+                    'BACKEND': 'files.storage.LocalBlobStore',
+                    'OPTIONS': {'location': location},
+                },
+            },
+            # Every inline size is loaded along with its row
+            FILE_INLINE_THRESHOLD=max(sizes) + 2 ** 20,
+            # Measure the tiers rather than the in-memory content cache
+            FILE_CONTENT_CACHE_SIZE=0,
+        ):
+            # Closing a response would otherwise close the connection holding
+            # the benchmark's transaction, as the test client also avoids
+            request_finished.disconnect(close_old_connections)
+            try:
+                self.benchmark(sizes, options)
+            finally:
+                request_finished.connect(close_old_connections)
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished successfully!'))
+
+    def benchmark(self, sizes, options):
+        """Measure both tiers for every size inside a transaction that is rolled back"""
+        store = options['store'] or BENCH_STORE
+        store_label = options['store'] or 'local'
+        self.stored = []
+        with transaction.atomic():
+            user = User.objects.create_user(
+                email=f'bench-{uuid.uuid4().hex}@example.com',
+                username=f'bench-{uuid.uuid4().hex}',
+            )
+            for size in sizes:
+                for label, storage_backend in (('inline', ''), (f'{store_label} store', store)):
+                    files = self.create_files(user, size, storage_backend, options['files'])
+                    per_download, queries = self.measure(user, files, options['repeat'])
+                    self.stdout.write(
+                        f'✓ {size // 1024} KiB {label}: {per_download:.3f} ms per download, '
+                        f'{queries} queries'
+                    )
+            # Nothing the benchmark created is kept
+            transaction.set_rollback(True)
+        for storage_backend, key in self.stored:
+            get_blob_store(storage_backend).delete(key)
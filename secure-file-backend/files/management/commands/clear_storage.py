@@ -1,6 +1,9 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth import get_user_model
-from files.models import File
+from django.db import router, transaction
+from django.db.models import Q
+from files.models import File, UploadSession, UploadPart, DirectUpload, UploadIdempotencyKey, StorageUsage
 from shares.models import SharePermission
 import os
 import shutil
@@ -8,13 +11,129 @@ from django.conf import settings
 
 User = get_user_model()
 
+
+def delete_file_blobs(files):
+    for file_instance in files:
+        if file_instance.blob_store is not None:
+            file_instance.blob_store.delete(file_instance.encrypted_filename)
+
+
+def delete_incoming_blobs(uploads):
+    for upload in uploads:
+        upload.blob_store.delete(upload.incoming_key)
+
+
+def discard_staging(objects):
+    for obj in objects:
+        obj.discard_staging()
+
+
 class Command(BaseCommand):
     help = 'Clears all stored files and resets the database'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Delete in batches of raw DELETEs instead of loading every object, in bounded memory'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows deleted per query in bulk mode'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count what would be deleted'
+        )
+        parser.add_argument(
+            '--user',
+            help='Only clear the files, shares and account of the user with this email'
+        )
+
+    def steps(self, user):
+        """
+        Get (label, queryset, fields, cleanup) for everything to delete,
+        in an order where nothing is deleted before the rows pointing at it.
+
+        fields are loaded for cleanup(), which removes the stored data
+        belonging to a batch once its deletion has committed.
+        """
+        def scoped(queryset, *lookups):
+            if user is None:
+                return queryset
+            condition = Q()
+            for lookup in lookups:
+                condition |= Q(**{lookup: user})
+            return queryset.filter(condition)
+
+        return [
+            ('share permissions', scoped(SharePermission.objects.all(), 'file__user', 'shared_by', 'shared_with'),
+             (), None),
+            ('upload parts', scoped(UploadPart.objects.all(), 'session__user'),
+             ('session_id', 'index'), discard_staging),
+            ('upload sessions', scoped(UploadSession.objects.all(), 'user'),
+             (), discard_staging),
+            ('direct uploads', scoped(DirectUpload.objects.all(), 'user'),
+             ('storage_backend',), delete_incoming_blobs),
+            ('idempotency keys', scoped(UploadIdempotencyKey.objects.all(), 'user'),
+             (), None),
+            ('files', scoped(File.all_objects.all(), 'user'),
+             ('storage_backend', 'encrypted_filename'), delete_file_blobs),
+            ('storage usage', scoped(StorageUsage.objects.all(), 'user'),
+             (), None),
+            ('admin log entries', scoped(LogEntry.objects.all(), 'user'),
+             (), None),
+            ('group memberships', scoped(User.groups.through.objects.all(), 'user'),
+             (), None),
+            ('user permissions', scoped(User.user_permissions.through.objects.all(), 'user'),
+             (), None),
+            ('users', User.objects.filter(pk=user.pk) if user else User.objects.all(),
+             (), None),
+        ]
+
+    def purge(self, label, queryset, fields, cleanup, batch_size):
+        """Delete a queryset in batches without loading more than a batch of rows"""
+        model = queryset.model
+        using = router.db_for_write(model)
+        total = queryset.count()
+        deleted = 0
+        while True:
+            batch = list(queryset.order_by('pk').only('pk', *fields)[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                # Skips the collector and signals; related rows were already deleted by earlier steps
+                model._base_manager.filter(pk__in=[obj.pk for obj in batch])._raw_delete(using)
+                if cleanup is not None:
+                    transaction.on_commit(lambda batch=batch: cleanup(batch), using=using)
+            deleted += len(batch)
+            self.stdout.write(f'\r  {label}: {deleted}/{total}', ending='')
+            self.stdout.flush()
+        if total:
+            self.stdout.write('')
+        return deleted
+
     def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(email=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user with email {options['user']}")
+        steps = self.steps(user)
+
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing will be deleted:')
+            for label, queryset, _, _ in steps:
+                self.stdout.write(f'  {queryset.count()} {label}')
+            return
+
         # 1. Delete all files from disk
         uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
-        if os.path.exists(uploads_dir):
+        if user is None and os.path.exists(uploads_dir):
             self.stdout.write('Removing all files from disk...')
             shutil.rmtree(uploads_dir)
             os.makedirs(uploads_dir)  # Recreate empty directory
@@ -22,20 +141,30 @@ class Command(BaseCommand):
 
         # 2. Clear database tables
         self.stdout.write('Clearing database...')
-        
+
+        if options['bulk']:
+            for label, queryset, fields, cleanup in steps:
+                deleted = self.purge(label, queryset, fields, cleanup, options['batch_size'])
+                self.stdout.write(f'✓ Removed {deleted} {label}')
+            self.stdout.write(self.style.SUCCESS('Storage cleared successfully!'))
+            return
+
         # Clear shares first (due to foreign key constraints)
-        share_count = SharePermission.objects.count()
-        SharePermission.objects.all().delete()
+        shares = steps[0][1]
+        share_count = shares.count()
+        shares.delete()
         self.stdout.write(f'✓ Removed {share_count} share permissions')
 
         # Clear files
-        file_count = File.objects.count()
-        File.objects.all().delete()
+        files = File.all_objects.filter(user=user) if user else File.all_objects.all()
+        file_count = files.count()
+        files.delete()
         self.stdout.write(f'✓ Removed {file_count} files')
 
         # Clear users (this will cascade delete everything else)
-        user_count = User.objects.count()
-        User.objects.all().delete()
+        users = steps[-1][1]
+        user_count = users.count()
+        users.delete()
         self.stdout.write(f'✓ Removed {user_count} users')
 
-        self.stdout.write(self.style.SUCCESS('Storage cleared successfully!')) 
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS('Storage cleared successfully!'))
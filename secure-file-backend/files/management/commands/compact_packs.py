@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from files.storage import PackedBlobStore, get_blob_store, DEFAULT_BLOB_STORE_ALIAS
+
+
+class Command(BaseCommand):
+    help = 'Reclaims the space deleted blobs leave in the pack files of a packed blob store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--store',
+            default=DEFAULT_BLOB_STORE_ALIAS,
+            help='FILE_STORAGES alias of the packed store'
+        )
+        parser.add_argument(
+            '--min-dead-ratio',
+            type=float,
+            default=0.5,
+            help='Share of a pack that must be deleted blobs before it is rewritten'
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to wait between packs, to leave room for other writers'
+        )
+
+    def handle(self, *args, **options):
+        store = get_blob_store(options['store'])
+        if not isinstance(store, PackedBlobStore):
+            raise CommandError(f"Storage {options['store']!r} doesn't pack blobs")
+
+        compacted, reclaimed = store.compact(options['min_dead_ratio'], options['pause'])
+        self.stdout.write(f'✓ Compacted {compacted} packs, reclaiming {reclaimed // 1024} KiB')
+        self.stdout.write(self.style.SUCCESS('Packs compacted successfully!'))
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+from files.models import UploadSession, DirectUpload, UploadIdempotencyKey
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired upload sessions, direct uploads and idempotency keys and their staged data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of sessions to delete per query'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # 1. Delete expired sessions, staging files go with them
+        deleted = 0
+        while True:
+            ids = list(
+                UploadSession.objects
+                .filter(expires_at__lte=timezone.now())
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            for session in UploadSession.objects.filter(id__in=ids).only('id'):
+                session.discard_staging()
+            UploadSession.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+        self.stdout.write(f'✓ Removed {deleted} expired upload sessions')
+
+        # 2. Delete expired direct uploads, incoming objects go with them
+        expired_uploads = 0
+        while True:
+            uploads = list(DirectUpload.objects.filter(expires_at__lte=timezone.now())[:batch_size])
+            if not uploads:
+                break
+            for upload in uploads:
+                upload.delete()
+            expired_uploads += len(uploads)
+        self.stdout.write(f'✓ Removed {expired_uploads} expired direct uploads')
+
+        # 3. Forget expired idempotency keys, the files they led to stay
+        expired_keys = 0
+        while True:
+            ids = list(
+                UploadIdempotencyKey.objects
+                .filter(created_at__lte=timezone.now() - settings.FILE_IDEMPOTENCY_KEY_LIFETIME)
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            UploadIdempotencyKey.objects.filter(id__in=ids).delete()
+            expired_keys += len(ids)
+        self.stdout.write(f'✓ Removed {expired_keys} expired idempotency keys')
+
+        # 4. Remove staging files left behind without a session
+        staging_dir = settings.FILE_UPLOAD_STAGING_DIR
+        orphans = 0
+        if os.path.isdir(staging_dir):
+            cutoff = time.time() - settings.FILE_UPLOAD_SESSION_LIFETIME.total_seconds()
+            live = {
+                str(session_id)
+                for session_id in UploadSession.objects.values_list('id', flat=True)
+            }
+            for entry in os.scandir(staging_dir):
+                session_id = entry.name.split('.', 1)[0]
+                if session_id not in live and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    orphans += 1
+        self.stdout.write(f'✓ Removed {orphans} orphaned staging files')
+
+        self.stdout.write(self.style.SUCCESS('Upload sessions cleaned up successfully!'))
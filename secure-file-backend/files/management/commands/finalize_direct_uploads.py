@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from files.models import DirectUpload
+from files.serializers import finalize_direct_upload
+
+
+class Command(BaseCommand):
+    help = (
+        'Finalizes completed direct uploads that no background worker has, '
+        'including ones whose worker stopped before FILE_DIRECT_UPLOAD_FINALIZE_TIMEOUT'
+    )
+
+    def handle(self, *args, **options):
+        pending = (
+            DirectUpload.objects
+            .filter(completed_at__isnull=False, file__isnull=True, error='')
+            .filter(
+                Q(claimed_at__isnull=True) |
+                Q(claimed_at__lte=timezone.now() - settings.FILE_DIRECT_UPLOAD_FINALIZE_TIMEOUT)
+            )
+            .order_by('completed_at')
+            .values_list('id', flat=True)
+        )
+
+        finalized = failed = 0
+        for upload_id in list(pending):
+            try:
+                if finalize_direct_upload(upload_id) is not None:
+                    finalized += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'✗ Direct upload {upload_id}: {e}')
+
+        self.stdout.write(f'✓ Finalized {finalized} direct uploads, {failed} failed')
+        self.stdout.write(self.style.SUCCESS('Direct uploads finalized successfully!'))
@@ -0,0 +1,313 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections, router, transaction
+from files.models import File
+from files.storage import get_blob_store, open_column, write_column, COPY_CHUNK_SIZE
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Name standing for inline content in File.encrypted_content
+DATABASE = 'database'
+
+
+class Command(BaseCommand):
+    help = 'Moves file content between storage backends in resumable, verified batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            default=DATABASE,
+            help=f'FILE_STORAGES alias to move content from, or "{DATABASE}" for inline content'
+        )
+        parser.add_argument(
+            '--target',
+            default=settings.FILE_UPLOAD_STORAGE or DATABASE,
+            help=f'FILE_STORAGES alias to move content to, or "{DATABASE}" for inline content'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of files moved per batch'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Files copied and verified at the same time'
+        )
+        parser.add_argument(
+            '--max-rate',
+            type=float,
+            default=0,
+            help='Average copy rate limit in MiB/s, 0 for no limit'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Checkpoint file recording progress, defaults to one per source and target in MEDIA_ROOT'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint and start over, retrying files that failed before'
+        )
+        parser.add_argument(
+            '--keep-source',
+            action='store_true',
+            help='Leave the source copy in place after a file is moved'
+        )
+        parser.add_argument(
+            '--vacuum',
+            action='store_true',
+            help=(
+                'Give the space freed in the SQLite database back to the filesystem, '
+                'in small incremental steps; needs auto_vacuum=INCREMENTAL'
+            )
+        )
+        parser.add_argument(
+            '--enable-incremental-vacuum',
+            action='store_true',
+            help=(
+                'Turn on auto_vacuum=INCREMENTAL with a one-off full VACUUM. That rewrites the whole '
+                'database under an exclusive lock, so only use it in a maintenance window'
+            )
+        )
+        parser.add_argument(
+            '--vacuum-pages',
+            type=int,
+            default=1000,
+            help='Pages released per incremental vacuum step'
+        )
+
+    def backend(self, name):
+        """Get the storage_backend value and blob store (None for inline) for a name"""
+        if name == DATABASE:
+            return '', None
+        return name, get_blob_store(name)
+
+    def load_checkpoint(self, path, restart):
+        if restart or not os.path.exists(path):
+            return {'last_pk': 0, 'moved': 0, 'bytes': 0, 'failed': 0}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_checkpoint(self, path, checkpoint):
+        # Written aside and moved into place, so an interruption never leaves it torn
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def open_target(self, file_instance):
+        if self.target_store is None:
+            return open_column(File, 'encrypted_content', file_instance.pk)
+        return self.target_store.open(file_instance.encrypted_filename)
+
+    def discard_target(self, file_instance):
+        if self.target_store is not None:
+            self.target_store.delete(file_instance.encrypted_filename)
+
+    def copy(self, file_instance):
+        """
+        Copy one file's content to the target and verify the stored copy.
+
+        Runs on a worker thread. The file row still points at the source
+        while this happens, so downloads keep working throughout.
+
+        Returns:
+            int: The number of bytes copied
+        """
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with file_instance.open_content() as source:
+                chunks = iter(lambda: source.read(COPY_CHUNK_SIZE), b'')
+                if self.target_store is None:
+                    with tempfile.SpooledTemporaryFile(max_size=COPY_CHUNK_SIZE) as spool:
+                        for chunk in chunks:
+                            spool.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                        with self.database_lock:
+                            write_column(File, 'encrypted_content', file_instance.pk, spool)
+                else:
+                    writer = self.target_store.writer(file_instance.encrypted_filename)
+                    try:
+                        for chunk in chunks:
+                            writer.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                    except BaseException:
+                        writer.abort()
+                        raise
+                    writer.commit()
+
+            # Read the copy back rather than trusting what was written
+            stored = hashlib.sha256()
+            stored_size = 0
+            with self.database_lock, self.open_target(file_instance) as target:
+                for chunk in iter(lambda: target.read(COPY_CHUNK_SIZE), b''):
+                    stored.update(chunk)
+                    stored_size += len(chunk)
+            if stored_size != size or stored.digest() != digest.digest():
+                self.discard_target(file_instance)
+                raise ValueError(f"Stored copy doesn't match ({stored_size} of {size} bytes)")
+            return size
+        finally:
+            connections.close_all()
+
+    def switch(self, file_instance):
+        """
+        Point a copied file at the target, if it is still at the source.
+
+        Returns:
+            bool: Whether the row was switched; files deleted meanwhile aren't
+        """
+        changes = {'storage_backend': self.target_alias}
+        if self.source_store is None and not self.keep_source:
+            changes['encrypted_content'] = None
+        with transaction.atomic():
+            switched = (
+                File._base_manager
+                .filter(pk=file_instance.pk, storage_backend=self.source_alias)
+                .update(**changes)
+            )
+            if switched and self.source_store is not None and not self.keep_source:
+                store, key = self.source_store, file_instance.encrypted_filename
+                transaction.on_commit(lambda: store.delete(key))
+        if not switched:
+            self.discard_target(file_instance)
+        return bool(switched)
+
+    def vacuum(self, pages, enable_incremental=False):
+        """
+        Release free SQLite pages in steps, keeping each write lock short.
+
+        Incremental vacuum needs auto_vacuum=INCREMENTAL, which only a full
+        VACUUM can turn on. That is never run unless asked for explicitly.
+        """
+        connection = connections[router.db_for_write(File)]
+        if connection.vendor != 'sqlite':
+            self.stdout.write(f'Skipping vacuum, not needed on {connection.vendor}')
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA page_size')
+            page_size = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_count')
+            before = cursor.fetchone()[0]
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                if not enable_incremental:
+                    self.stdout.write(self.style.WARNING(
+                        'Skipping vacuum: the database is not in incremental auto-vacuum mode. '
+                        'Turning it on takes a full VACUUM that locks the whole database; run '
+                        'with --enable-incremental-vacuum during a maintenance window to do it.'
+                    ))
+                    return
+                self.stdout.write('Enabling incremental auto-vacuum with a one-off full VACUUM...')
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+            else:
+                while True:
+                    cursor.execute('PRAGMA freelist_count')
+                    if not cursor.fetchone()[0]:
+                        break
+                    cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+                    cursor.fetchall()
+                    self.throttle_pause()
+            cursor.execute('PRAGMA page_count')
+            after = cursor.fetchone()[0]
+        self.stdout.write(f'✓ Database shrunk by {(before - after) * page_size // 2 ** 20} MiB')
+
+    def throttle_pause(self):
+        if self.throttle_delay:
+            time.sleep(self.throttle_delay)
+
+    def handle(self, *args, **options):
+        source, target = options['source'], options['target']
+        if source == target:
+            raise CommandError('Source and target must differ')
+        self.source_alias, self.source_store = self.backend(source)
+        self.target_alias, self.target_store = self.backend(target)
+        self.keep_source = options['keep_source']
+        # Workers take turns writing to and reading back from the database, which
+        # SQLite would otherwise fail as locked; blob store copies run in parallel
+        self.database_lock = threading.Lock() if self.target_store is None else contextlib.nullcontext()
+        batch_size = options['batch_size']
+        max_rate = options['max_rate'] * 2 ** 20
+        # Pause between vacuum steps, roughly matching the copy rate limit
+        self.throttle_delay = 0.1 if max_rate else 0
+
+        checkpoint_path = options['checkpoint'] or os.path.join(
+            settings.MEDIA_ROOT, f'migrate_storage-{source}-{target}.json'
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+        checkpoint = self.load_checkpoint(checkpoint_path, options['restart'])
+        if checkpoint['last_pk']:
+            self.stdout.write(f'Resuming after file {checkpoint["last_pk"]}')
+
+        started = time.monotonic()
+        copied_bytes = 0
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='migrate-storage') as pool:
+            while True:
+                batch = list(
+                    File._base_manager
+                    .filter(storage_backend=self.source_alias, pk__gt=checkpoint['last_pk'])
+                    .order_by('pk')
+                    .only('pk', 'encrypted_filename', 'storage_backend')[:batch_size]
+                )
+                if not batch:
+                    break
+
+                futures = [(file_instance, pool.submit(self.copy, file_instance)) for file_instance in batch]
+                copied = []
+                for file_instance, future in futures:
+                    try:
+                        copied.append((file_instance, future.result()))
+                    except Exception as e:
+                        # The file stays at the source; --restart retries it
+                        checkpoint['failed'] += 1
+                        self.stderr.write(f'✗ File {file_instance.pk}: {e}')
+
+                # Switched once the whole batch is copied, so the row updates
+                # never hold a write lock while workers read from the source
+                for file_instance, size in copied:
+                    if self.switch(file_instance):
+                        checkpoint['moved'] += 1
+                        checkpoint['bytes'] += size
+                    copied_bytes += size
+
+                checkpoint['last_pk'] = batch[-1].pk
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(
+                    f'✓ Up to file {checkpoint["last_pk"]}: {checkpoint["moved"]} moved, '
+                    f'{checkpoint["failed"]} failed'
+                )
+
+                if max_rate:
+                    # Sleep off whatever got ahead of the average rate
+                    ahead = copied_bytes / max_rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        self.stdout.write(
+            f'✓ Moved {checkpoint["moved"]} files ({checkpoint["bytes"] // 2 ** 20} MiB) '
+            f'from {source} to {target}'
+        )
+        if options['vacuum'] or options['enable_incremental_vacuum']:
+            self.vacuum(options['vacuum_pages'], options['enable_incremental_vacuum'])
+
+        if checkpoint['failed']:
+            raise CommandError(
+                f'{checkpoint["failed"]} files could not be moved, run again with --restart to retry them'
+            )
+        self.stdout.write(self.style.SUCCESS('Storage migrated successfully!'))
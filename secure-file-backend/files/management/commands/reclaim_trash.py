@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from files.models import File
+from shares.models import SharePermission
+import time
+
+
+class Command(BaseCommand):
+    help = 'Purges files that have been in the trash longer than FILE_TRASH_RETENTION'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of files purged per transaction'
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to wait between batches, to leave room for other writers'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        cutoff = timezone.now() - settings.FILE_TRASH_RETENTION
+
+        purged = shares = 0
+        while True:
+            ids = list(
+                File.all_objects
+                .filter(deleted_at__lte=cutoff)
+                .order_by('pk')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                # Shares first so the file delete has nothing left to cascade to;
+                # stored blobs are removed once the batch commits
+                shares += SharePermission.objects.filter(file_id__in=ids).delete()[0]
+                File.all_objects.filter(id__in=ids).delete()
+            purged += len(ids)
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(f'✓ Purged {purged} trashed files and {shares} of their shares')
+        self.stdout.write(self.style.SUCCESS('Trash reclaimed successfully!'))
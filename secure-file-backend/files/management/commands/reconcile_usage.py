@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from files.models import File, StorageUsage
+import time
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Rebuilds every user's storage usage counters from their files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Users recounted per transaction'
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to wait between batches, to leave room for other writers'
+        )
+
+    def reconcile(self, user_ids):
+        """
+        Recount a batch of users, returning how many counters were off.
+
+        The counters are locked before the files are counted, so uploads
+        and purges of these users either wait for the new totals and add
+        to them, or are already part of the count.
+        """
+        usages = {
+            usage.user_id: usage
+            for usage in StorageUsage.objects.select_for_update().filter(user_id__in=user_ids)
+        }
+        totals = {
+            row['user']: row
+            for row in File.all_objects.filter(user_id__in=user_ids).order_by().values('user').annotate(
+                bytes_used=Sum(Coalesce('content_size', 'original_file_size')), file_count=Count('id')
+            )
+        }
+
+        created, changed = [], []
+        for user_id in user_ids:
+            total = totals.get(user_id, {'bytes_used': 0, 'file_count': 0})
+            usage = usages.get(user_id)
+            if usage is None:
+                created.append(StorageUsage(
+                    user_id=user_id, bytes_used=total['bytes_used'], file_count=total['file_count']
+                ))
+            elif (usage.bytes_used, usage.file_count) != (total['bytes_used'], total['file_count']):
+                usage.bytes_used, usage.file_count = total['bytes_used'], total['file_count']
+                usage.updated_at = timezone.now()
+                changed.append(usage)
+        StorageUsage.objects.bulk_create(created)
+        StorageUsage.objects.bulk_update(changed, ['bytes_used', 'file_count', 'updated_at'])
+        return len(changed) + sum(1 for usage in created if usage.file_count)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        checked = corrected = 0
+        last_pk = 0
+        while True:
+            user_ids = list(
+                User.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not user_ids:
+                break
+            with transaction.atomic():
+                corrected += self.reconcile(user_ids)
+            checked += len(user_ids)
+            last_pk = user_ids[-1]
+            self.stdout.write(f'✓ Checked {checked} users, {corrected} corrected so far')
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS('Storage usage reconciled successfully!'))
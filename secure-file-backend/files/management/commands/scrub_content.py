@@ -0,0 +1,172 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from files.models import File, StorageUsage
+from files.serving import content_digests
+from files.storage import BlobNotFound, COPY_CHUNK_SIZE
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+import time
+
+
+class RateLimiter:
+    """Spread reads from any number of threads out to at most `rate` bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThrottledReader:
+    """File object wrapper that waits for the rate limiter after every read"""
+
+    def __init__(self, source, limiter):
+        self.source = source
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def seek(self, *args):
+        return self.source.seek(*args)
+
+    def close(self):
+        self.source.close()
+
+
+class Command(BaseCommand):
+    help = 'Re-verifies stored file content against its recorded digests'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=2,
+            help='Files verified at the same time'
+        )
+        parser.add_argument(
+            '--max-rate',
+            type=float,
+            default=32,
+            help='Read rate limit across all workers in MiB/s, 0 for no limit'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Files fetched from the database at a time'
+        )
+        parser.add_argument(
+            '--decrypt',
+            action='store_true',
+            help='Also decrypt each file and check the content digest downloads advertise'
+        )
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help='Record digests and sizes for files stored before they were computed'
+        )
+
+    def verify(self, file_instance):
+        """
+        Check one file, on a worker thread.
+
+        Returns:
+            tuple: (what is wrong with the file or None, fields to backfill or None)
+        """
+        try:
+            source = ThrottledReader(file_instance.open_content(), self.limiter)
+            missing_digest = file_instance.stored_sha256 is None
+            missing_size = file_instance.content_size is None
+            if self.decrypt or ((missing_digest or missing_size) and self.backfill):
+                content_sha256, stored_sha256, content_size = content_digests(
+                    file_instance, source, file_instance.get_file_key()
+                )
+            else:
+                digest = hashlib.sha256()
+                try:
+                    for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                finally:
+                    source.close()
+                content_sha256, stored_sha256 = None, digest.digest()
+
+            backfill = {}
+            if self.backfill:
+                if missing_digest:
+                    backfill.update(content_sha256=content_sha256, stored_sha256=stored_sha256)
+                if missing_size:
+                    backfill['content_size'] = content_size
+            if missing_digest:
+                return None, backfill or None
+            if stored_sha256 != bytes(file_instance.stored_sha256):
+                return 'stored object does not match its digest', None
+            if content_sha256 is not None and content_sha256 != bytes(file_instance.content_sha256 or b''):
+                return 'decrypted content does not match its digest', None
+            return None, backfill or None
+        except BlobNotFound:
+            return 'stored object is missing', None
+        except Exception as e:
+            # Authentication failures of the segmented format end up here
+            return f'could not be read: {e}', None
+        finally:
+            connections.close_all()
+
+    def record(self, file_instance, backfill):
+        """Save what was measured for a file, moving its owner's usage off the declared size"""
+        with transaction.atomic():
+            File.all_objects.filter(pk=file_instance.pk).update(**backfill)
+            if 'content_size' in backfill:
+                StorageUsage.record(
+                    file_instance.user_id, backfill['content_size'] - file_instance.original_file_size, 0
+                )
+
+    def handle(self, *args, **options):
+        self.limiter = RateLimiter(options['max_rate'] * 2 ** 20)
+        self.decrypt = options['decrypt']
+        self.backfill = options['backfill']
+        batch_size = options['batch_size']
+
+        files = File.all_objects.order_by('pk').only(
+            'pk', 'filename', 'encrypted_filename', 'storage_backend', 'storage_format',
+            'server_side_iv', 'encrypted_file_key', 'content_sha256', 'stored_sha256',
+            'content_size', 'original_file_size', 'user'
+        )
+        if not self.backfill:
+            files = files.filter(stored_sha256__isnull=False)
+
+        checked = 0
+        problems = []
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='scrub-content') as pool:
+            while True:
+                batch = list(files.filter(pk__gt=last_pk)[:batch_size])
+                if not batch:
+                    break
+                for file_instance, (problem, backfill) in zip(batch, pool.map(self.verify, batch)):
+                    # Written here rather than on the workers, one transaction at a time
+                    if backfill is not None:
+                        self.record(file_instance, backfill)
+                    if problem is not None:
+                        problems.append(file_instance.pk)
+                        self.stderr.write(f'✗ File {file_instance.pk} ({file_instance.filename}): {problem}')
+                checked += len(batch)
+                last_pk = batch[-1].pk
+                self.stdout.write(f'✓ Checked {checked} files, {len(problems)} problems so far')
+
+        if problems:
+            raise CommandError(f'{len(problems)} files failed verification: {problems}')
+        self.stdout.write(self.style.SUCCESS('Content verified successfully!'))
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='file',
+            options={'base_manager_name': 'objects', 'ordering': ['-upload_timestamp'], 'verbose_name': 'file', 'verbose_name_plural': 'files'},
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='storage_backend',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
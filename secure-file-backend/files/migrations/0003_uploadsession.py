@@ -0,0 +1,45 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:19
+
+import django.db.models.deletion
+import files.models
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_file_storage_backend'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('mime_type', models.CharField(default='application/octet-stream', max_length=100)),
+                ('original_file_size', models.BigIntegerField(default=0)),
+                ('encryption_iv', models.CharField(max_length=32)),
+                ('total_size', models.BigIntegerField()),
+                ('chunk_size', models.IntegerField()),
+                ('received_bytes', models.BigIntegerField(default=0)),
+                ('encrypted_filename', models.CharField(default=files.models.default_encrypted_filename, max_length=255, unique=True)),
+                ('encrypted_file_key', models.BinaryField(default=files.models.default_encrypted_key)),
+                ('server_side_iv', models.BinaryField(default=files.models.default_iv)),
+                ('chain_block', models.BinaryField(null=True)),
+                ('head', models.BinaryField(default=bytes)),
+                ('expires_at', models.DateTimeField(default=files.models.default_upload_session_expiry)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'upload session',
+                'verbose_name_plural': 'upload sessions',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
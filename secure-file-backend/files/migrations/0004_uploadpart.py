@@ -0,0 +1,32 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0003_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('state', models.CharField(choices=[('receiving', 'Receiving'), ('staged', 'Staged')], default='receiving', max_length=20)),
+                ('size', models.BigIntegerField(default=0)),
+                ('sha256', models.BinaryField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='files.uploadsession')),
+            ],
+            options={
+                'verbose_name': 'upload part',
+                'verbose_name_plural': 'upload parts',
+                'ordering': ['session', 'index'],
+                'unique_together': {('session', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_uploadpart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='storage_format',
+            field=models.CharField(choices=[('aes-256-cbc', 'AES-256-CBC'), ('aes-256-gcm-segmented', 'AES-256-GCM segments')], default='aes-256-cbc', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='segment_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='storage_format',
+            field=models.CharField(choices=[('aes-256-cbc', 'AES-256-CBC'), ('aes-256-gcm-segmented', 'AES-256-GCM segments')], default='aes-256-cbc', max_length=32),
+        ),
+    ]
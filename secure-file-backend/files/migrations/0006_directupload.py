@@ -0,0 +1,38 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:38
+
+import django.db.models.deletion
+import files.models
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_storage_format'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('mime_type', models.CharField(default='application/octet-stream', max_length=100)),
+                ('original_file_size', models.BigIntegerField(default=0)),
+                ('encryption_iv', models.CharField(max_length=32)),
+                ('total_size', models.BigIntegerField()),
+                ('storage_backend', models.CharField(max_length=32)),
+                ('expires_at', models.DateTimeField(default=files.models.default_direct_upload_expiry)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='direct_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'direct upload',
+                'verbose_name_plural': 'direct uploads',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_directupload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='storage_format',
+            field=models.CharField(choices=[('aes-256-cbc', 'AES-256-CBC'), ('aes-256-gcm-segmented', 'AES-256-GCM segments'), ('at-rest', 'Storage-layer encryption at rest')], default='aes-256-cbc', max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='storage_format',
+            field=models.CharField(choices=[('aes-256-cbc', 'AES-256-CBC'), ('aes-256-gcm-segmented', 'AES-256-GCM segments'), ('at-rest', 'Storage-layer encryption at rest')], default='aes-256-cbc', max_length=32),
+        ),
+    ]
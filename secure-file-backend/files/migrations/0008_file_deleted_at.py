@@ -0,0 +1,30 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:50
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_at_rest_format'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='file',
+            options={'base_manager_name': 'all_objects', 'ordering': ['-upload_timestamp'], 'verbose_name': 'file', 'verbose_name_plural': 'files'},
+        ),
+        migrations.AlterModelManagers(
+            name='file',
+            managers=[
+                ('objects', django.db.models.manager.Manager()),
+                ('all_objects', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
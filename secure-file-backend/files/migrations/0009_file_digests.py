@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_file_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='content_sha256',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='stored_sha256',
+            field=models.BinaryField(null=True),
+        ),
+    ]
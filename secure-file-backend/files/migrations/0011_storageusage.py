@@ -0,0 +1,48 @@
+# Generated by Django 5.0.2 on 2026-10-17 00:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def count_existing_files(apps, schema_editor):
+    # The counters only follow changes from here on, start them off with the files so far
+    File = apps.get_model('files', 'File')
+    StorageUsage = apps.get_model('files', 'StorageUsage')
+    totals = (
+        File.objects.order_by().values('user')
+        .annotate(bytes_used=Sum('original_file_size'), file_count=Count('id'))
+    )
+    StorageUsage.objects.bulk_create(
+        [StorageUsage(user_id=row['user'], bytes_used=row['bytes_used'], file_count=row['file_count'])
+         for row in totals.iterator()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('files', '0010_uploadidempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes_used', models.BigIntegerField(default=0)),
+                ('file_count', models.IntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('quota_files', models.IntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'storage usage',
+                'verbose_name_plural': 'storage usage',
+            },
+        ),
+        migrations.RunPython(count_existing_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_storageusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='content_size',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -1,8 +1,26 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Length
+from django.db.models.lookups import LessThan
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
+from django.core import signing
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+import hashlib
+import io
+import os
 import uuid
 import time
+from .content_cache import invalidate_content
 from .key_management import KeyManagement
+from .storage import get_blob_store, open_column, write_column, DEFAULT_BLOB_STORE_ALIAS
+
+# Bytes kept from the start of an upload for content sniffing
+SNIFF_SIZE = 1024
+# Bytes read from the request body at a time when staging chunks
+STAGING_CHUNK_SIZE = 64 * 1024
 
 def default_encrypted_key():
     """Generate a default encrypted key for existing records"""
@@ -18,7 +36,48 @@ def default_encrypted_filename():
     # Include timestamp to ensure uniqueness
     return f"{uuid.uuid4()}_{int(time.time())}"
 
+class FileQuerySet(models.QuerySet):
+    def with_inline_content(self):
+        """
+        Load small inline content along with the rows.
+
+        Content below FILE_INLINE_THRESHOLD is read in the same query as
+        the file itself, so serving it takes no further queries; larger
+        inline content (stored before the threshold applied) stays deferred
+        and is streamed from the column as before.
+        """
+        return self.annotate(inline_content=Case(
+            When(
+                Q(storage_backend='') & LessThan(Length('encrypted_content'), settings.FILE_INLINE_THRESHOLD),
+                then='encrypted_content'
+            ),
+            default=None,
+            output_field=models.BinaryField()
+        ))
+
+
+class FileManager(models.Manager.from_queryset(FileQuerySet)):
+    def get_queryset(self):
+        # Never pull legacy inline content along with metadata queries
+        return super().get_queryset().defer('encrypted_content')
+
+
+class LiveFileManager(FileManager):
+    def get_queryset(self):
+        # Trashed files stay hidden until they are restored or reclaimed
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class File(models.Model):
+    FORMAT_CBC = 'aes-256-cbc'
+    FORMAT_SEGMENTED_GCM = 'aes-256-gcm-segmented'
+    FORMAT_AT_REST = 'at-rest'  # Client ciphertext as uploaded, the storage layer encrypts at rest
+    STORAGE_FORMAT_CHOICES = [
+        (FORMAT_CBC, 'AES-256-CBC'),
+        (FORMAT_SEGMENTED_GCM, 'AES-256-GCM segments'),
+        (FORMAT_AT_REST, 'Storage-layer encryption at rest'),
+    ]
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -36,11 +95,30 @@ class File(models.Model):
     encrypted_file_key = models.BinaryField(default=default_encrypted_key)  # Encrypted key for server-side encryption
     server_side_iv = models.BinaryField(default=default_iv)  # IV for server-side encryption
     mime_type = models.CharField(max_length=100, default='application/octet-stream')
-    encrypted_content = models.BinaryField(null=True)  # Actual encrypted file content
+    encrypted_content = models.BinaryField(null=True)  # Inline content, when storage_backend is empty
+    storage_backend = models.CharField(
+        max_length=32,
+        blank=True,
+        default=''
+    )  # FILE_STORAGES alias holding the content, empty for inline content
+    storage_format = models.CharField(
+        max_length=32,
+        choices=STORAGE_FORMAT_CHOICES,
+        default=FORMAT_CBC
+    )  # How the server-side encryption is laid out
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    content_sha256 = models.BinaryField(null=True)  # Digest of the client-encrypted content, as downloads send it
+    stored_sha256 = models.BinaryField(null=True)  # Digest of the stored object, checked by scrub_content
+    content_size = models.BigIntegerField(null=True)  # Bytes of client-encrypted content as received, counted against the owner's quota
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)  # Set while the file is in the trash
+
+    objects = LiveFileManager()
+    all_objects = FileManager()  # Includes trashed files
 
     class Meta:
+        # Related lookups (share.file) and cascades must still see trashed files
+        base_manager_name = 'all_objects'
         ordering = ['-upload_timestamp']
         verbose_name = 'file'
         verbose_name_plural = 'files'
@@ -51,3 +129,730 @@ class File(models.Model):
     def get_file_key(self):
         """Get the decrypted file key for server-side operations"""
         return KeyManagement.decrypt_file_key(self.encrypted_file_key)
+
+    @property
+    def is_trashed(self):
+        return self.deleted_at is not None
+
+    @property
+    def purge_after(self):
+        """Get when a trashed file can no longer be restored"""
+        if self.deleted_at is None:
+            return None
+        return self.deleted_at + settings.FILE_TRASH_RETENTION
+
+    def trash(self):
+        """
+        Move the file to the trash.
+
+        Only the deletion time is written, so this takes the same time
+        whatever the file's size or number of shares; the content, shares
+        and row are purged later by the reclaim_trash command.
+        """
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['deleted_at'])
+        invalidate_content(self.pk)
+
+    def restore(self):
+        """Take the file back out of the trash"""
+        self.deleted_at = None
+        self.save(update_fields=['deleted_at'])
+
+    @property
+    def counted_size(self):
+        """Get the bytes this file counts against its owner's quota"""
+        if self.content_size is None:
+            # Stored before sizes were recorded, until scrub_content --backfill measures it
+            return self.original_file_size
+        return self.content_size
+
+    @property
+    def blob_store(self):
+        """Get the blob store holding this file's content, if any"""
+        if not self.storage_backend:
+            return None
+        return get_blob_store(self.storage_backend)
+
+    def has_content(self):
+        """Check if server-side encrypted content is stored for this file"""
+        if self.blob_store is not None:
+            return self.blob_store.exists(self.encrypted_filename)
+        if getattr(self, 'inline_content', None):
+            return True
+        return (
+            File._base_manager
+            .filter(pk=self.pk)
+            .annotate(inline_size=Length('encrypted_content'))
+            .filter(inline_size__gt=0)
+            .exists()
+        )
+
+    def open_content(self):
+        """Open the server-side encrypted content for binary reading"""
+        if self.blob_store is not None:
+            return self.blob_store.open(self.encrypted_filename)
+        if 'encrypted_content' in self.__dict__:
+            # Already loaded with the row
+            return io.BytesIO(bytes(self.encrypted_content or b''))
+        if getattr(self, 'inline_content', None) is not None:
+            # Small enough to have come with the row, see with_inline_content()
+            return io.BytesIO(bytes(self.inline_content))
+        return open_column(File, 'encrypted_content', self.pk)
+
+    def save_inline_content(self, source):
+        """Store server-side encrypted content from a file object in the database"""
+        write_column(File, 'encrypted_content', self.pk, source)
+        self.__dict__.pop('encrypted_content', None)
+        self.__dict__.pop('inline_content', None)
+
+    def read_content(self):
+        """Read the whole server-side encrypted content"""
+        with self.open_content() as f:
+            return f.read()
+
+
+def content_encryptor(storage_format, file_key, server_iv):
+    """
+    Create an incremental server-side encryptor for a whole file.
+
+    Args:
+        storage_format (str): One of File.STORAGE_FORMAT_CHOICES
+        file_key (bytes): 32-byte file key
+        server_iv (bytes): 16-byte server-side IV
+
+    Returns:
+        DigestingEncryptor: Encryptor with update(), finalize(),
+        encrypt_chunks() and digests()
+    """
+    if storage_format == File.FORMAT_SEGMENTED_GCM:
+        encryptor = KeyManagement.segment_encryptor(file_key, server_iv, settings.FILE_SEGMENT_SIZE)
+    elif storage_format == File.FORMAT_CBC:
+        encryptor = KeyManagement.stream_encryptor(file_key, server_iv)
+    elif storage_format == File.FORMAT_AT_REST:
+        encryptor = PassthroughEncryptor()
+    else:
+        raise ValueError(f"Unknown storage format {storage_format!r}")
+    return DigestingEncryptor(encryptor)
+
+
+class DigestingEncryptor:
+    """Hash the content going into an encryptor and the ciphertext coming out"""
+
+    def __init__(self, encryptor):
+        self.encryptor = encryptor
+        self.content_digest = hashlib.sha256()
+        self.stored_digest = hashlib.sha256()
+
+    def update(self, data):
+        self.content_digest.update(data)
+        ciphertext = self.encryptor.update(data)
+        self.stored_digest.update(ciphertext)
+        return ciphertext
+
+    def finalize(self):
+        ciphertext = self.encryptor.finalize()
+        self.stored_digest.update(ciphertext)
+        return ciphertext
+
+    def encrypt_chunks(self, chunks):
+        for chunk in chunks:
+            ciphertext = self.update(chunk)
+            if ciphertext:
+                yield ciphertext
+        yield self.finalize()
+
+    def digests(self):
+        """Get the File digest fields for everything encrypted so far"""
+        return {
+            'content_sha256': self.content_digest.digest(),
+            'stored_sha256': self.stored_digest.digest(),
+        }
+
+
+class PassthroughEncryptor:
+    """
+    Encryptor for the at-rest format, which stores the client's
+    ciphertext unchanged and leaves encryption at rest to the
+    storage layer (an encrypted volume or bucket).
+    """
+
+    def update(self, data):
+        return bytes(data)
+
+    def finalize(self):
+        return b''
+
+    def encrypt_chunks(self, chunks):
+        for chunk in chunks:
+            yield bytes(chunk)
+
+
+@receiver(post_delete, sender=File)
+def delete_file_content(sender, instance, **kwargs):
+    """Remove the stored blob and any cached content once the file row is gone for good"""
+    invalidate_content(instance.pk)
+    store = instance.blob_store
+    if store is not None:
+        key = instance.encrypted_filename
+        transaction.on_commit(lambda: store.delete(key))
+
+
+def discard_staging_file(path):
+    """Remove a staging file if it is still there"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def default_upload_session_expiry():
+    """Expiry for an upload session that just saw activity"""
+    return timezone.now() + settings.FILE_UPLOAD_SESSION_LIFETIME
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload, received as numbered chunks over several requests.
+
+    Chunks may arrive in any order and in parallel. Each one lands in its
+    own part file (see UploadPart); as soon as every chunk before it is in,
+    it is server-side encrypted and appended to the session's staging file,
+    one chunk per transaction. In the segmented format every chunk is a
+    whole number of segments and is sealed on its own; in the CBC format
+    the chain is carried across chunks through the last ciphertext block.
+    Finalizing then only has to validate the upload and move the staged
+    ciphertext into the blob store.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    filename = models.CharField(max_length=255)
+    mime_type = models.CharField(max_length=100, default='application/octet-stream')
+    original_file_size = models.BigIntegerField(default=0)
+    encryption_iv = models.CharField(max_length=32)  # Client-side IV, hex
+    total_size = models.BigIntegerField()  # Size of the client-encrypted upload
+    chunk_size = models.IntegerField()  # Every chunk but the last has exactly this size
+    received_bytes = models.BigIntegerField(default=0)
+    encrypted_filename = models.CharField(max_length=255, unique=True, default=default_encrypted_filename)
+    encrypted_file_key = models.BinaryField(default=default_encrypted_key)
+    server_side_iv = models.BinaryField(default=default_iv)
+    storage_format = models.CharField(
+        max_length=32,
+        choices=File.STORAGE_FORMAT_CHOICES,
+        default=File.FORMAT_CBC
+    )
+    segment_size = models.IntegerField(null=True)  # Plaintext bytes per segment, segmented format only
+    chain_block = models.BinaryField(null=True)  # Last ciphertext block written so far
+    head = models.BinaryField(default=bytes)  # Start of the upload, for content sniffing
+    expires_at = models.DateTimeField(default=default_upload_session_expiry)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'upload session'
+        verbose_name_plural = 'upload sessions'
+
+    def __str__(self):
+        return f"Upload of {self.filename} by {self.user.email}"
+
+    @property
+    def total_chunks(self):
+        return max(-(-self.total_size // self.chunk_size), 1)
+
+    @property
+    def is_complete(self):
+        return self.chain_block is not None and self.received_bytes >= self.total_size
+
+    @property
+    def next_chunk(self):
+        if self.is_complete:
+            return self.total_chunks
+        return self.received_bytes // self.chunk_size
+
+    @property
+    def staging_path(self):
+        return os.path.join(settings.FILE_UPLOAD_STAGING_DIR, f"{self.id}.part")
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def expected_chunk_size(self, index):
+        """Get the number of bytes chunk `index` must contain"""
+        return min(self.chunk_size, self.total_size - index * self.chunk_size)
+
+    def append_chunk(self, index, stream):
+        """
+        Encrypt the next chunk from a stream and append it to the staging file.
+
+        Must be called on a row locked for update. The ciphertext produced
+        is the same as encrypting the whole upload in one go. Segmented
+        chunks start on a segment boundary and only the final one closes
+        the record; CBC chunks continue the chain from the previous chunk's
+        last block, and only the final one is padded. At-rest chunks are
+        appended as they are.
+
+        Raises:
+            ValueError: If the chunk doesn't have the expected size
+        """
+        expected = self.expected_chunk_size(index)
+        file_key = self.get_file_key()
+        is_last = index == self.total_chunks - 1
+        if self.storage_format == File.FORMAT_SEGMENTED_GCM:
+            encryptor = KeyManagement.segment_encryptor(
+                file_key,
+                bytes(self.server_side_iv),
+                self.segment_size,
+                first_segment=index * self.chunk_size // self.segment_size,
+                final=is_last,
+                header=index == 0
+            )
+            staged_size = 0
+            if self.received_bytes:
+                staged_size = KeyManagement.segmented_size(self.received_bytes, self.segment_size)
+        elif self.storage_format == File.FORMAT_AT_REST:
+            encryptor = PassthroughEncryptor()
+            staged_size = self.received_bytes
+        else:
+            chain_iv = bytes(self.chain_block) if self.chain_block else bytes(self.server_side_iv)
+            if is_last:
+                encryptor = KeyManagement.stream_encryptor(file_key, chain_iv)
+            else:
+                encryptor = KeyManagement.block_encryptor(file_key, chain_iv)
+            staged_size = self.received_bytes  # Non-final chunks encrypt to the same size
+
+        os.makedirs(os.path.dirname(self.staging_path), exist_ok=True)
+        head = bytearray(self.head or b'')
+        received = 0
+        tail = b''
+
+        with open(self.staging_path, 'ab') as f:
+            # Drop anything written by an earlier attempt that never got recorded
+            f.truncate(staged_size)
+            for data in iter(lambda: stream.read(STAGING_CHUNK_SIZE), b''):
+                received += len(data)
+                if received > expected:
+                    raise ValueError(f"Chunk {index} must be {expected} bytes")
+                if len(head) < SNIFF_SIZE:
+                    head += data[:SNIFF_SIZE - len(head)]
+                ciphertext = encryptor.update(data)
+                f.write(ciphertext)
+                tail = (tail + ciphertext)[-16:]
+            if received != expected:
+                raise ValueError(f"Chunk {index} must be {expected} bytes")
+            ciphertext = encryptor.finalize()
+            f.write(ciphertext)
+            tail = (tail + ciphertext)[-16:]
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.received_bytes += received
+        self.chain_block = tail
+        self.head = bytes(head)
+        self.expires_at = default_upload_session_expiry()
+        self.save(update_fields=['received_bytes', 'chain_block', 'head', 'expires_at', 'updated_at'])
+
+    def assemble_parts(self):
+        """
+        Append staged parts that continue the encrypted stream, in order.
+
+        Every part is appended in a transaction of its own, on the row
+        locked again for it, so parts that waited for an earlier chunk never
+        hold the database for longer than one part takes; this must not be
+        called inside a transaction. Parts that still have a gap before them
+        stay staged until the missing chunks arrive.
+        """
+        while True:
+            with transaction.atomic():
+                session = UploadSession.objects.select_for_update().filter(pk=self.pk).first()
+                if session is None:
+                    return  # Aborted meanwhile
+                part = session.parts.filter(state=UploadPart.STAGED, index=session.next_chunk).first()
+                if part is None:
+                    break
+                with open(part.staging_path, 'rb') as f:
+                    session.append_chunk(part.index, f)
+                part.delete()
+        self.refresh_from_db()
+
+    def get_file_key(self):
+        """Get the decrypted file key for server-side operations"""
+        return KeyManagement.decrypt_file_key(self.encrypted_file_key)
+
+    def discard_staging(self):
+        """Remove the staging file"""
+        discard_staging_file(self.staging_path)
+
+
+class UploadPart(models.Model):
+    """
+    One chunk of an upload session received ahead of the encrypted stream.
+
+    A part is reserved (RECEIVING) before its body is read, which stops the
+    same chunk from being uploaded twice at once and lets the number of
+    parts a user uploads concurrently be capped, then STAGED once its
+    size and digest have been verified.
+    """
+    RECEIVING = 'receiving'
+    STAGED = 'staged'
+    STATE_CHOICES = [
+        (RECEIVING, 'Receiving'),
+        (STAGED, 'Staged'),
+    ]
+
+    session = models.ForeignKey(
+        UploadSession,
+        on_delete=models.CASCADE,
+        related_name='parts'
+    )
+    index = models.IntegerField()
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=RECEIVING)
+    size = models.BigIntegerField(default=0)
+    sha256 = models.BinaryField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['session', 'index']
+        unique_together = [('session', 'index')]
+        verbose_name = 'upload part'
+        verbose_name_plural = 'upload parts'
+
+    def __str__(self):
+        return f"Part {self.index} of upload {self.session_id}"
+
+    @property
+    def staging_path(self):
+        return os.path.join(settings.FILE_UPLOAD_STAGING_DIR, f"{self.session_id}.{self.index}.part")
+
+    def is_stale(self):
+        """Check if a reservation was abandoned, e.g. by a worker that died"""
+        return (
+            self.state == self.RECEIVING
+            and timezone.now() - self.created_at > settings.FILE_UPLOAD_PART_TIMEOUT
+        )
+
+    def receive(self, stream, expected_size, expected_sha256=None):
+        """
+        Write the part's data from a stream to its part file.
+
+        Raises:
+            ValueError: If the size or the SHA-256 digest don't match
+        """
+        digest = hashlib.sha256()
+        received = 0
+        os.makedirs(os.path.dirname(self.staging_path), exist_ok=True)
+
+        with open(self.staging_path, 'wb') as f:
+            for data in iter(lambda: stream.read(STAGING_CHUNK_SIZE), b''):
+                received += len(data)
+                if received > expected_size:
+                    raise ValueError(f"Chunk {self.index} must be {expected_size} bytes")
+                digest.update(data)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if received != expected_size:
+            raise ValueError(f"Chunk {self.index} must be {expected_size} bytes")
+        if expected_sha256 is not None and digest.digest() != expected_sha256:
+            raise ValueError(f"Chunk {self.index} doesn't match its digest")
+
+        self.size = received
+        self.sha256 = digest.digest()
+        self.state = self.STAGED
+
+    def discard_staging(self):
+        """Remove the part file"""
+        discard_staging_file(self.staging_path)
+
+
+@receiver(post_delete, sender=UploadPart)
+def delete_part_staging(sender, instance, **kwargs):
+    """Remove a part's data once it is assembled or its session is gone"""
+    staging_path = instance.staging_path
+    transaction.on_commit(lambda: discard_staging_file(staging_path))
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_staging(sender, instance, **kwargs):
+    """Remove staged data when a session is finalized, aborted or expired"""
+    # Resolve the path now, the instance loses its primary key once deleted
+    staging_path = instance.staging_path
+    transaction.on_commit(lambda: discard_staging_file(staging_path))
+
+
+def default_direct_upload_expiry():
+    """Expiry for a newly created direct upload"""
+    return timezone.now() + settings.FILE_DIRECT_UPLOAD_LIFETIME
+
+
+class DirectUpload(models.Model):
+    """
+    An upload sent straight to the storage tier through a signed URL.
+
+    The client PUTs its client-encrypted data, as is, to a short-lived
+    upload URL: a pre-signed URL for stores that support them (S3), or the
+    token-protected upload receiver otherwise. It lands under incoming_key
+    in the blob store. Completing it only marks it pending; the
+    server-side encryption into a new File runs in the background (see
+    finalize_direct_upload), and the client polls the upload for its
+    status and file. Finalizers that never finish are abandoned after
+    FILE_DIRECT_UPLOAD_FINALIZE_TIMEOUT and retried.
+    """
+    SIGNING_SALT = 'files.DirectUpload'
+
+    STATUS_UPLOADING = 'uploading'
+    STATUS_PENDING = 'pending'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='direct_uploads'
+    )
+    filename = models.CharField(max_length=255)
+    mime_type = models.CharField(max_length=100, default='application/octet-stream')
+    original_file_size = models.BigIntegerField(default=0)
+    encryption_iv = models.CharField(max_length=32)  # Client-side IV, hex
+    total_size = models.BigIntegerField()  # Size of the client-encrypted upload
+    storage_backend = models.CharField(max_length=32)  # FILE_STORAGES alias receiving the upload
+    completed_at = models.DateTimeField(null=True, blank=True)  # When the client completed it
+    claimed_at = models.DateTimeField(null=True, blank=True)  # When a finalizer last started on it
+    file = models.ForeignKey(
+        File,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+'
+    )  # Set once it has been finalized
+    error = models.TextField(blank=True)  # Why finalizing failed
+    expires_at = models.DateTimeField(default=default_direct_upload_expiry)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'direct upload'
+        verbose_name_plural = 'direct uploads'
+
+    def __str__(self):
+        return f"Direct upload of {self.filename} by {self.user.email}"
+
+    @property
+    def incoming_key(self):
+        return f"incoming-{self.id.hex}"
+
+    @property
+    def blob_store(self):
+        return get_blob_store(self.storage_backend or DEFAULT_BLOB_STORE_ALIAS)
+
+    @property
+    def status(self):
+        if self.completed_at is None:
+            return self.STATUS_UPLOADING
+        if self.file_id is not None:
+            return self.STATUS_COMPLETE
+        if self.error:
+            return self.STATUS_FAILED
+        return self.STATUS_PENDING
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def mark_completed(self):
+        """Queue it for finalizing, keeping it long enough for the client to see the result"""
+        self.completed_at = timezone.now()
+        self.expires_at = self.completed_at + settings.FILE_DIRECT_UPLOAD_RESULT_LIFETIME
+        self.save(update_fields=['completed_at', 'expires_at'])
+
+    @classmethod
+    def claim(cls, upload_id):
+        """
+        Take a pending upload for finalizing, unless another finalizer is
+        already working on it.
+
+        Returns:
+            DirectUpload or None: The upload, if it was claimed
+        """
+        now = timezone.now()
+        claimed = cls.objects.filter(
+            Q(claimed_at__isnull=True) | Q(claimed_at__lte=now - settings.FILE_DIRECT_UPLOAD_FINALIZE_TIMEOUT),
+            id=upload_id,
+            completed_at__isnull=False,
+            file__isnull=True,
+            error='',
+        ).update(claimed_at=now)
+        return cls.objects.filter(id=upload_id).first() if claimed else None
+
+    def sign(self):
+        """Get a token authorizing uploads to this direct upload until it expires"""
+        return signing.dumps(str(self.id), salt=self.SIGNING_SALT)
+
+    @classmethod
+    def unsign(cls, token):
+        """
+        Get the direct upload id a token was issued for.
+
+        Raises:
+            signing.BadSignature: If the token is invalid or has expired
+        """
+        return signing.loads(token, salt=cls.SIGNING_SALT, max_age=settings.FILE_DIRECT_UPLOAD_LIFETIME)
+
+
+@receiver(post_delete, sender=DirectUpload)
+def delete_incoming_upload(sender, instance, **kwargs):
+    """Remove the raw upload once it is finalized, aborted or expired"""
+    store = instance.blob_store
+    key = instance.incoming_key
+    transaction.on_commit(lambda: store.delete(key))
+
+
+class UploadIdempotencyKey(models.Model):
+    """
+    A client's Idempotency-Key for a single-request upload.
+
+    The key is claimed before the request body is read. Retries of a
+    completed upload get the original file back without sending it again,
+    and duplicates arriving while the first attempt still runs are turned
+    away instead of storing a second copy. Claims that never complete are
+    abandoned after FILE_IDEMPOTENCY_CLAIM_TIMEOUT.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_idempotency_keys'
+    )
+    key = models.CharField(max_length=255)
+    content_sha256 = models.BinaryField()  # Client-supplied digest of the client-encrypted upload
+    file = models.ForeignKey(
+        File,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+'
+    )  # Set once the upload has completed
+    created_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
+        unique_together = [('user', 'key')]
+        verbose_name = 'upload idempotency key'
+        verbose_name_plural = 'upload idempotency keys'
+
+    def __str__(self):
+        return f"Idempotency key {self.key} of {self.user.email}"
+
+    def is_expired(self):
+        return timezone.now() - self.created_at > settings.FILE_IDEMPOTENCY_KEY_LIFETIME
+
+    def is_abandoned(self):
+        return self.file_id is None and timezone.now() - self.claimed_at > settings.FILE_IDEMPOTENCY_CLAIM_TIMEOUT
+
+    def reset(self, content_sha256):
+        """Reuse the key for a new upload, as if it had just been created"""
+        self.content_sha256 = content_sha256
+        self.file = None
+        self.created_at = self.claimed_at = timezone.now()
+        self.save(update_fields=['content_sha256', 'file', 'created_at', 'claimed_at'])
+
+
+class StorageUsage(models.Model):
+    """
+    Running totals of a user's files, so usage never has to be summed
+    over every file they own.
+
+    The totals change in the same transaction as the files they count:
+    creating a file adds to them and purging one takes it off again.
+    Files in the trash still count, as their content is still stored.
+    Files count with the client-encrypted bytes actually received rather
+    than the original_file_size clients declare (see File.counted_size).
+    reconcile_usage rebuilds the totals from the files themselves.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='storage_usage'
+    )
+    bytes_used = models.BigIntegerField(default=0)  # Sum of File.counted_size
+    file_count = models.IntegerField(default=0)
+    quota_bytes = models.BigIntegerField(null=True, blank=True)  # Overrides FILE_QUOTA_BYTES when set
+    quota_files = models.IntegerField(null=True, blank=True)  # Overrides FILE_QUOTA_FILES when set
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'storage usage'
+        verbose_name_plural = 'storage usage'
+
+    def __str__(self):
+        return f"Storage usage of {self.user.email}"
+
+    @classmethod
+    def for_user(cls, user):
+        usage, _ = cls.objects.get_or_create(user=user)
+        return usage
+
+    @classmethod
+    def lock(cls, user):
+        """Lock a user's row for the rest of the transaction, to check per-user limits one request at a time"""
+        cls.for_user(user)
+        return cls.objects.select_for_update().get(user=user)
+
+    @classmethod
+    def record(cls, user_id, size, count):
+        """Add to a user's totals (negative to take off) in the current transaction"""
+        changes = {
+            'bytes_used': F('bytes_used') + size,
+            'file_count': F('file_count') + count,
+            'updated_at': timezone.now(),
+        }
+        if cls.objects.filter(user_id=user_id).update(**changes) or count < 0:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, bytes_used=size, file_count=count)
+        except IntegrityError:
+            # Created by a concurrent upload meanwhile
+            cls.objects.filter(user_id=user_id).update(**changes)
+
+    def effective_quota_bytes(self):
+        return self.quota_bytes if self.quota_bytes is not None else settings.FILE_QUOTA_BYTES
+
+    def effective_quota_files(self):
+        return self.quota_files if self.quota_files is not None else settings.FILE_QUOTA_FILES
+
+    def quota_error(self, size):
+        """
+        Check whether one more file of `size` bytes fits in the user's quota.
+
+        Returns:
+            str | None: Why it doesn't fit, or None
+        """
+        quota_bytes = self.effective_quota_bytes()
+        if quota_bytes is not None and self.bytes_used + size > quota_bytes:
+            return (
+                f"Storage quota exceeded: {filesizeformat(self.bytes_used)} of "
+                f"{filesizeformat(quota_bytes)} used, this file needs {filesizeformat(size)}."
+            )
+        quota_files = self.effective_quota_files()
+        if quota_files is not None and self.file_count + 1 > quota_files:
+            return f"File quota exceeded: {self.file_count} of {quota_files} files stored."
+        return None
+
+
+@receiver(post_save, sender=File)
+def count_created_file(sender, instance, created, **kwargs):
+    """Add a new file to its owner's storage usage"""
+    if created:
+        StorageUsage.record(instance.user_id, instance.counted_size, 1)
+
+
+@receiver(post_delete, sender=File)
+def count_purged_file(sender, instance, **kwargs):
+    """Take a purged file off its owner's storage usage"""
+    StorageUsage.record(instance.user_id, -instance.counted_size, -1)
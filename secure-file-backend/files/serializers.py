@@ -1,11 +1,103 @@
 from rest_framework import serializers
-from .models import File
+from .models import File, UploadSession, UploadPart, DirectUpload, StorageUsage, SNIFF_SIZE, content_encryptor
 from .key_management import KeyManagement
+from .storage import get_blob_store, content_tier, TieredBlobWriter, BlobNotFound, COPY_CHUNK_SIZE, DEFAULT_BLOB_STORE_ALIAS
+from .upload_handlers import EncryptedUploadedFile
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import magic
 import os
 from django.conf import settings
+from django.db import connections, transaction
+from django.template.defaultfilters import filesizeformat
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# Finalizes completed direct uploads outside the requests completing them
+_finalize_pool = ThreadPoolExecutor(
+    max_workers=max(getattr(settings, 'FILE_DIRECT_UPLOAD_WORKERS', 2), 1),
+    thread_name_prefix='direct-upload-finalize'
+)
+
+def check_upload_size(size, max_size):
+    """Reject uploads larger than max_size"""
+    if size > max_size:
+        raise serializers.ValidationError(
+            f"File size cannot exceed {filesizeformat(max_size)}."
+        )
+
+
+def check_quota(user, size):
+    """Reject uploads that would take the user past their storage quota"""
+    error = StorageUsage.for_user(user).quota_error(size)
+    if error is not None:
+        raise serializers.ValidationError(error)
+
+
+def check_encrypted_content(head):
+    """Basic check that the start of an upload looks encrypted"""
+    # Encrypted files should appear as binary/random data
+    mime = magic.Magic(mime=True)
+    file_type = mime.from_buffer(bytes(head))
+
+    # Encrypted files should typically appear as application/octet-stream
+    if file_type != 'application/octet-stream':
+        raise serializers.ValidationError(
+            "File doesn't appear to be encrypted. Please encrypt the file before uploading."
+        )
+
+
+def check_filename(value):
+    """Keep only the last path component of a client-supplied name"""
+    value = os.path.basename(value.replace('\\', '/')).strip()
+    if value in ('', '.', '..'):
+        raise serializers.ValidationError("Invalid filename.")
+    return value
+
+
+def save_encrypted_content(encrypted_filename, chunks):
+    """
+    Store server-side encrypted content for a file about to be created.
+
+    Content of FILE_INLINE_THRESHOLD bytes or more is saved under
+    encrypted_filename in the FILE_UPLOAD_STORAGE blob store right away.
+    Smaller content (or all of it, when FILE_UPLOAD_STORAGE is empty)
+    belongs in the database, which can only be written once the row
+    exists, so it is spooled and returned for File.save_inline_content();
+    the caller must close it.
+
+    Returns:
+        tuple: (storage_backend, file object with the spooled content or None)
+    """
+    writer = TieredBlobWriter(encrypted_filename)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    return writer.storage_backend, writer.file
+
+
+def check_encryption_iv(value):
+    """Validate the encryption IV format"""
+    try:
+        # IV should be a hex string of 32 characters (16 bytes)
+        if len(value) != 32:
+            raise serializers.ValidationError(
+                "Invalid IV format. Must be 32 characters hex string."
+            )
+        # Try converting to bytes to ensure it's valid hex
+        bytes.fromhex(value)
+        return value
+    except ValueError:
+        raise serializers.ValidationError(
+            "Invalid IV format. Must be a valid hex string."
+        )
+
+
 class FileUploadSerializer(serializers.ModelSerializer):
     file = serializers.FileField(write_only=True)
     encryption_iv = serializers.CharField(required=True, write_only=True)
@@ -21,81 +113,399 @@ class FileUploadSerializer(serializers.ModelSerializer):
     def validate_file(self, value):
         """
         Validate the uploaded file:
-        1. Check file size (max 10MB as per settings)
-        2. Verify file is actually encrypted (basic check)
+        1. Check file size (FILE_UPLOAD_MAX_SIZE, 10MB by default)
+        2. Check it fits in the user's quota, now that its real size is known
+        3. Verify file is actually encrypted (basic check)
         """
-        # Check file size
-        if value.size > 10 * 1024 * 1024:  # 10MB
-            raise serializers.ValidationError("File size cannot exceed 10MB.")
-
-        # Basic check for encrypted content (should appear as binary/random data)
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_buffer(value.read(1024))
+        check_upload_size(value.size, settings.FILE_UPLOAD_MAX_SIZE)
+        check_quota(self.context['request'].user, value.size)
+        check_encrypted_content(value.read(SNIFF_SIZE))
         value.seek(0)  # Reset file pointer
-
-        # Encrypted files should typically appear as application/octet-stream
-        if file_type != 'application/octet-stream':
-            raise serializers.ValidationError(
-                "File doesn't appear to be encrypted. Please encrypt the file before uploading."
-            )
-
         return value
 
     def validate_encryption_iv(self, value):
         """Validate the encryption IV format"""
-        try:
-            # IV should be a hex string of 32 characters (16 bytes)
-            if len(value) != 32:
-                raise serializers.ValidationError(
-                    "Invalid IV format. Must be 32 characters hex string."
-                )
-            # Try converting to bytes to ensure it's valid hex
-            bytes.fromhex(value)
-            return value
-        except ValueError:
-            raise serializers.ValidationError(
-                "Invalid IV format. Must be a valid hex string."
-            )
+        return check_encryption_iv(value)
 
     def create(self, validated_data):
         uploaded_file = validated_data.pop('file')
         encryption_iv = validated_data.pop('encryption_iv')
-        
-        # Generate a unique identifier for reference
-        encrypted_filename = f"{uuid.uuid4().hex}"
-
-        # Read the client-side encrypted file
-        client_encrypted_data = uploaded_file.read()
-
-        # Generate server-side encryption key and IV
-        file_key = KeyManagement.generate_file_key()
-        server_iv = KeyManagement.generate_iv()
-
-        # Encrypt the already client-encrypted data with server-side encryption
-        server_encrypted_data = KeyManagement.encrypt_file(
-            client_encrypted_data,
-            file_key,
-            server_iv
-        )
+
+        if isinstance(uploaded_file, EncryptedUploadedFile):
+            # Already encrypted and stored by EncryptingUploadHandler
+            encrypted_filename = uploaded_file.encrypted_filename
+            file_key = uploaded_file.file_key
+            server_iv = uploaded_file.server_iv
+            store_alias = uploaded_file.storage_backend
+            storage_format = uploaded_file.storage_format
+            pending_content = uploaded_file.pending_content
+            digests = uploaded_file.digests
+        else:
+            # Generate a unique identifier for reference
+            encrypted_filename = f"{uuid.uuid4().hex}"
+
+            # Generate server-side encryption key and IV
+            file_key = KeyManagement.generate_file_key()
+            server_iv = KeyManagement.generate_iv()
+
+            # Encrypt the already client-encrypted data chunk by chunk
+            # and store it in the blob store, keyed by encrypted filename,
+            # or spool it for the database row
+            storage_format = settings.FILE_STORAGE_FORMAT
+            encryptor = content_encryptor(storage_format, file_key, server_iv)
+            store_alias, pending_content = save_encrypted_content(
+                encrypted_filename,
+                encryptor.encrypt_chunks(uploaded_file.chunks())
+            )
+            digests = encryptor.digests()
 
         # Encrypt the file key with the master key
         encrypted_key = KeyManagement.encrypt_file_key(file_key)
 
-        # Create the file instance with encrypted content in database
-        file_instance = File.objects.create(
+        try:
+            with transaction.atomic():
+                file_instance = File.objects.create(
+                    user=self.context['request'].user,
+                    filename=uploaded_file.name,
+                    encrypted_filename=encrypted_filename,
+                    encryption_iv=bytes.fromhex(encryption_iv),  # Client-side IV
+                    encrypted_file_key=encrypted_key,  # Server-side encrypted key
+                    server_side_iv=server_iv,  # Server-side IV
+                    storage_backend=store_alias,
+                    storage_format=storage_format,
+                    content_size=uploaded_file.size,
+                    **digests,
+                    **validated_data
+                )
+                if pending_content is not None:
+                    file_instance.save_inline_content(pending_content)
+        except Exception:
+            # Don't leave orphaned content behind if the row can't be created
+            if store_alias:
+                get_blob_store(store_alias).delete(encrypted_filename)
+            raise
+        finally:
+            if pending_content is not None:
+                pending_content.close()
+
+        return file_instance
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Serializer for creating and reporting on resumable upload sessions"""
+    encryption_iv = serializers.CharField(required=True, write_only=True)
+    original_file_size = serializers.IntegerField(required=True)
+    mime_type = serializers.CharField(required=True)
+    total_size = serializers.IntegerField(required=True, min_value=0)
+    total_chunks = serializers.IntegerField(read_only=True)
+    next_chunk = serializers.IntegerField(read_only=True)
+    staged_chunks = serializers.SerializerMethodField()
+    is_complete = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'filename', 'mime_type', 'original_file_size', 'encryption_iv',
+                 'total_size', 'chunk_size', 'total_chunks', 'received_bytes',
+                 'next_chunk', 'staged_chunks', 'is_complete', 'expires_at', 'created_at')
+        read_only_fields = ('id', 'chunk_size', 'received_bytes', 'expires_at', 'created_at')
+
+    def get_staged_chunks(self, obj):
+        """Chunks received ahead of next_chunk, waiting for the ones before them"""
+        return list(
+            obj.parts.filter(state=UploadPart.STAGED).values_list('index', flat=True)
+        )
+
+    def validate_filename(self, value):
+        """Keep only the last path component of the client-supplied name"""
+        return check_filename(value)
+
+    def validate_encryption_iv(self, value):
+        """Validate the encryption IV format"""
+        return check_encryption_iv(value)
+
+    def validate_total_size(self, value):
+        """Reject sessions for uploads over FILE_UPLOAD_SESSION_MAX_SIZE or the quota up front"""
+        check_upload_size(value, settings.FILE_UPLOAD_SESSION_MAX_SIZE)
+        check_quota(self.context['request'].user, value)
+        return value
+
+    def create(self, validated_data):
+        storage_format = settings.FILE_STORAGE_FORMAT
+        if storage_format == File.FORMAT_SEGMENTED_GCM:
+            # Chunks must be whole segments so each can be sealed on its own
+            segment_size = settings.FILE_SEGMENT_SIZE
+        else:
+            # Chunks must be whole AES blocks to continue the CBC chain
+            segment_size = None
+        alignment = segment_size or 16
+
+        return UploadSession.objects.create(
             user=self.context['request'].user,
-            filename=uploaded_file.name,
-            encrypted_filename=encrypted_filename,
-            encryption_iv=bytes.fromhex(encryption_iv),  # Client-side IV
-            encrypted_file_key=encrypted_key,  # Server-side encrypted key
-            server_side_iv=server_iv,  # Server-side IV
-            encrypted_content=server_encrypted_data,  # Store encrypted file in database
+            chunk_size=max(settings.FILE_UPLOAD_CHUNK_SIZE // alignment * alignment, alignment),
+            storage_format=storage_format,
+            segment_size=segment_size,
             **validated_data
         )
 
+
+class UploadSessionCompleteSerializer(serializers.Serializer):
+    """
+    Finalize an upload session into a File.
+
+    Runs the same IV, content and size checks as a single-request upload,
+    then moves the staged ciphertext into the blob store, or the database
+    when it is smaller than FILE_INLINE_THRESHOLD (see content_tier()).
+
+    The staged file is never read again here. Its chunks were hashed in
+    separate requests, so the file starts without digests and
+    scrub_content --backfill records them later.
+    """
+
+    def validate(self, attrs):
+        session = self.instance
+        if not session.is_complete:
+            raise serializers.ValidationError(
+                f"Upload is incomplete: {session.received_bytes} of {session.total_size} bytes received."
+            )
+
+        errors = {}
+        try:
+            check_encryption_iv(session.encryption_iv)
+        except serializers.ValidationError as e:
+            errors['encryption_iv'] = e.detail
+        try:
+            check_upload_size(session.received_bytes, settings.FILE_UPLOAD_SESSION_MAX_SIZE)
+            check_encrypted_content(session.head)
+            # Other uploads may have used up the quota since the session started
+            check_quota(session.user, session.received_bytes)
+        except serializers.ValidationError as e:
+            errors['file'] = e.detail
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def save(self):
+        session = self.instance
+        store_alias = content_tier(os.path.getsize(session.staging_path))
+        if store_alias:
+            get_blob_store(store_alias).save_file(session.encrypted_filename, session.staging_path)
+
+        try:
+            with transaction.atomic():
+                file_instance = File.objects.create(
+                    user=session.user,
+                    filename=session.filename,
+                    encrypted_filename=session.encrypted_filename,
+                    encryption_iv=bytes.fromhex(session.encryption_iv),  # Client-side IV
+                    encrypted_file_key=session.encrypted_file_key,  # Server-side encrypted key
+                    server_side_iv=session.server_side_iv,  # Server-side IV
+                    storage_backend=store_alias,
+                    storage_format=session.storage_format,
+                    original_file_size=session.original_file_size,
+                    content_size=session.received_bytes,
+                    mime_type=session.mime_type,
+                )
+                if not store_alias:
+                    # The staging file goes away with the session
+                    with open(session.staging_path, 'rb') as f:
+                        file_instance.save_inline_content(f)
+                session.delete()
+        except Exception:
+            # Don't leave orphaned content behind if the row can't be created
+            if store_alias:
+                get_blob_store(store_alias).delete(session.encrypted_filename)
+            raise
+
         return file_instance
 
 
+class DirectUploadSerializer(serializers.ModelSerializer):
+    """Serializer for creating direct uploads and handing out their upload URL"""
+    encryption_iv = serializers.CharField(required=True, write_only=True)
+    original_file_size = serializers.IntegerField(required=True)
+    mime_type = serializers.CharField(required=True)
+    total_size = serializers.IntegerField(required=True, min_value=0)
+    upload_url = serializers.SerializerMethodField()
+    upload_method = serializers.SerializerMethodField()
+    status = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = DirectUpload
+        fields = ('id', 'filename', 'mime_type', 'original_file_size', 'encryption_iv',
+                 'total_size', 'upload_url', 'upload_method', 'status', 'file', 'error',
+                 'expires_at', 'created_at')
+        read_only_fields = ('id', 'file', 'error', 'expires_at', 'created_at')
+
+    def get_upload_url(self, obj):
+        """Pre-signed storage URL, or the signed upload receiver URL"""
+        if obj.completed_at is not None:
+            return None
+        url = obj.blob_store.signed_upload_url(obj.incoming_key, settings.FILE_DIRECT_UPLOAD_LIFETIME)
+        if url is None:
+            url = f"/api/files/direct-uploads/{obj.id}/data/?token={obj.sign()}"
+        return url
+
+    def get_upload_method(self, obj):
+        return 'PUT'
+
+    def validate_filename(self, value):
+        """Keep only the last path component of the client-supplied name"""
+        return check_filename(value)
+
+    def validate_encryption_iv(self, value):
+        """Validate the encryption IV format"""
+        return check_encryption_iv(value)
+
+    def validate_total_size(self, value):
+        """Reject uploads over FILE_UPLOAD_SESSION_MAX_SIZE or the quota up front"""
+        check_upload_size(value, settings.FILE_UPLOAD_SESSION_MAX_SIZE)
+        check_quota(self.context['request'].user, value)
+        return value
+
+    def create(self, validated_data):
+        return DirectUpload.objects.create(
+            user=self.context['request'].user,
+            # The database can't take uploads directly, use the default store then
+            storage_backend=settings.FILE_UPLOAD_STORAGE or DEFAULT_BLOB_STORE_ALIAS,
+            **validated_data
+        )
+
+
+class DirectUploadCompleteSerializer(serializers.Serializer):
+    """
+    Complete a direct upload, queueing it to be finalized into a File.
+
+    Runs the same IV, content and size checks as a single-request upload.
+    The server-side encryption of the uploaded object is left to
+    finalize_direct_upload, which runs on FILE_DIRECT_UPLOAD_WORKERS
+    background threads once the completing transaction commits, or in
+    finalize_direct_uploads.
+    """
+
+    def validate(self, attrs):
+        upload = self.instance
+        store = upload.blob_store
+        try:
+            with store.open(upload.incoming_key) as source:
+                size = source.seek(0, os.SEEK_END)
+                source.seek(0)
+                head = source.read(SNIFF_SIZE)
+        except BlobNotFound:
+            raise serializers.ValidationError("Nothing has been uploaded yet.")
+
+        if size != upload.total_size:
+            raise serializers.ValidationError(
+                f"Upload is incomplete: {size} of {upload.total_size} bytes received."
+            )
+
+        errors = {}
+        try:
+            check_encryption_iv(upload.encryption_iv)
+        except serializers.ValidationError as e:
+            errors['encryption_iv'] = e.detail
+        try:
+            check_upload_size(size, settings.FILE_UPLOAD_SESSION_MAX_SIZE)
+            check_encrypted_content(head)
+            # Other uploads may have used up the quota since this one started
+            check_quota(upload.user, size)
+        except serializers.ValidationError as e:
+            errors['file'] = e.detail
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def save(self):
+        upload = self.instance
+        upload.mark_completed()
+        if settings.FILE_DIRECT_UPLOAD_WORKERS:
+            transaction.on_commit(lambda: _finalize_pool.submit(finalize_in_background, upload.id))
+        return upload
+
+
+def finalize_direct_upload(upload_id):
+    """
+    Apply the server-side encryption to a completed direct upload,
+    storing the result like any other upload.
+
+    The upload is claimed first so only one finalizer works on it. The
+    incoming object is read and encrypted outside any transaction; only
+    the File row is created in one, and only if the claim still holds.
+
+    Returns:
+        File or None: The new file, or None if the upload wasn't claimed
+    """
+    upload = DirectUpload.claim(upload_id)
+    if upload is None:
+        return None
+
+    encrypted_filename = uuid.uuid4().hex
+    file_key = KeyManagement.generate_file_key()
+    server_iv = KeyManagement.generate_iv()
+    storage_format = settings.FILE_STORAGE_FORMAT
+    store_alias = pending_content = None
+
+    try:
+        # The server-side encryption step, streamed from the uploaded object
+        encryptor = content_encryptor(storage_format, file_key, server_iv)
+        with upload.blob_store.open(upload.incoming_key) as source:
+            store_alias, pending_content = save_encrypted_content(
+                encrypted_filename,
+                encryptor.encrypt_chunks(iter(lambda: source.read(COPY_CHUNK_SIZE), b''))
+            )
+
+        with transaction.atomic():
+            # Aborted, or taken over by another finalizer, meanwhile
+            if not DirectUpload.objects.select_for_update().filter(
+                id=upload.id, claimed_at=upload.claimed_at, file__isnull=True
+            ).exists():
+                if store_alias:
+                    get_blob_store(store_alias).delete(encrypted_filename)
+                return None
+
+            file_instance = File.objects.create(
+                user=upload.user,
+                filename=upload.filename,
+                encrypted_filename=encrypted_filename,
+                encryption_iv=bytes.fromhex(upload.encryption_iv),  # Client-side IV
+                encrypted_file_key=KeyManagement.encrypt_file_key(file_key),  # Server-side encrypted key
+                server_side_iv=server_iv,  # Server-side IV
+                storage_backend=store_alias,
+                storage_format=storage_format,
+                original_file_size=upload.original_file_size,
+                content_size=upload.total_size,  # Checked against the object when completing
+                mime_type=upload.mime_type,
+                **encryptor.digests(),
+            )
+            if pending_content is not None:
+                file_instance.save_inline_content(pending_content)
+            DirectUpload.objects.filter(id=upload.id).update(file=file_instance)
+            # The upload stays for the client to poll, its data isn't needed anymore
+            store, key = upload.blob_store, upload.incoming_key
+            transaction.on_commit(lambda: store.delete(key))
+    except Exception as e:
+        logger.error(f"Error finalizing direct upload {upload.id}: {str(e)}")
+        # Don't leave orphaned content behind if the row can't be created
+        if store_alias:
+            get_blob_store(store_alias).delete(encrypted_filename)
+        DirectUpload.objects.filter(id=upload.id, claimed_at=upload.claimed_at).update(error=str(e))
+        raise
+    finally:
+        if pending_content is not None:
+            pending_content.close()
+
+    return file_instance
+
+
+def finalize_in_background(upload_id):
+    """Run finalize_direct_upload on a pool thread, with its own connection"""
+    try:
+        finalize_direct_upload(upload_id)
+    except Exception:
+        pass  # Recorded on the upload
+    finally:
+        connections.close_all()
+
+
 class FileDownloadSerializer(serializers.ModelSerializer):
     """Serializer for file download responses"""
     download_url = serializers.SerializerMethodField()
@@ -113,4 +523,40 @@ class FileDownloadSerializer(serializers.ModelSerializer):
 
     def get_encryption_iv(self, obj):
         """Convert IV from bytes to hex string"""
-        return obj.encryption_iv.hex() 
\ No newline at end of file
+        return obj.encryption_iv.hex()
+
+
+class TrashedFileSerializer(FileDownloadSerializer):
+    """Serializer for files in the trash"""
+    restore_url = serializers.SerializerMethodField()
+
+    class Meta(FileDownloadSerializer.Meta):
+        fields = FileDownloadSerializer.Meta.fields + ('deleted_at', 'purge_after', 'restore_url')
+
+    def get_restore_url(self, obj):
+        return f"/api/files/{obj.id}/restore/"
+
+
+class StorageUsageSerializer(serializers.ModelSerializer):
+    """A user's storage usage and the quotas that apply to them"""
+    quota_bytes = serializers.IntegerField(source='effective_quota_bytes', read_only=True)
+    quota_files = serializers.IntegerField(source='effective_quota_files', read_only=True)
+
+    class Meta:
+        model = StorageUsage
+        fields = ('bytes_used', 'file_count', 'quota_bytes', 'quota_files', 'updated_at')
+        read_only_fields = fields
+
+
+class FileArchiveSerializer(serializers.Serializer):
+    """Files to download together as one archive"""
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_ids(self, value):
+        """Drop repeated IDs, keeping the requested order"""
+        value = list(dict.fromkeys(value))
+        if len(value) > settings.FILE_ARCHIVE_MAX_FILES:
+            raise serializers.ValidationError(
+                f"An archive can hold at most {settings.FILE_ARCHIVE_MAX_FILES} files."
+            )
+        return value
@@ -0,0 +1,805 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from .content_cache import FellBehind, get_content_cache, get_content_flights
+from .key_management import KeyManagement, SEGMENT_HEADER_SIZE, SEGMENT_TAG_SIZE
+from .models import File
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 16
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Shared pool for read-ahead; each stream keeps at most one read in flight
+_read_ahead_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'FILE_READ_AHEAD_WORKERS', 8),
+    thread_name_prefix='file-read-ahead'
+)
+
+
+class ReadAhead:
+    """
+    Iterate over a file in chunks, fetching the next chunk while the
+    current one is being processed. Closes the source when exhausted
+    or closed, even if iteration never started.
+    """
+
+    def __init__(self, source, chunk_size, limit=None):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.remaining = limit
+        self._pending = None
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        if self._pending is None:
+            self._pending = self._submit()
+
+        chunk = self._pending.result()
+        if not chunk:
+            self.close()
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self._pending = self._submit()
+        return chunk
+
+    def _submit(self):
+        size = self.chunk_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if size <= 0:
+            return _read_ahead_pool.submit(bytes)
+        return _read_ahead_pool.submit(self.source.read, size)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._pending is None:
+            self.source.close()
+        else:
+            # Let any in-flight read finish before closing the source under it
+            self._pending.add_done_callback(lambda _: self.source.close())
+
+
+def decrypted_content_length(source, file_key, server_iv):
+    """Get the decrypted size of an open server-side encrypted file"""
+    encrypted_size = source.seek(0, os.SEEK_END)
+    source.seek(max(encrypted_size - 32, 0))
+    last_blocks = source.read(32)
+    source.seek(0)
+    return KeyManagement.decrypted_size(encrypted_size, last_blocks, file_key, server_iv)
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a requested byte range lies outside the content"""
+
+
+def parse_range_header(header, length):
+    """
+    Parse a Range header against content of the given length.
+
+    Only a single byte range is supported; anything else (missing,
+    malformed or multi-range headers) returns None so the full content
+    is served, as RFC 9110 allows.
+
+    Returns:
+        tuple | None: Inclusive (start, end) offsets, or None
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= length:
+            raise RangeNotSatisfiable()
+        end = int(last) if last else length - 1
+        return start, min(end, length - 1)
+    if last:
+        suffix_length = int(last)
+        if suffix_length == 0 or length == 0:
+            raise RangeNotSatisfiable()
+        return max(length - suffix_length, 0), length - 1
+    return None
+
+
+def if_range_matches(request, etag, last_modified):
+    """Check an If-Range precondition; ranges are only honored when it holds"""
+    value = request.META.get('HTTP_IF_RANGE')
+    if value is None:
+        return True
+    if value.startswith(('"', 'W/')):
+        # Strong comparison, weak validators never match
+        return value == etag
+    timestamp = parse_http_date_safe(value)
+    return timestamp is not None and timestamp == int(last_modified.timestamp())
+
+
+def decrypt_range(chunks, decryptor, skip, length):
+    """Decrypt ciphertext chunks, trimming the output to the requested bytes"""
+    def decrypted():
+        for chunk in chunks:
+            yield decryptor.update(chunk)
+        # Lets the segmented format verify a shorter final segment
+        yield decryptor.finalize()
+
+    remaining = length
+    for data in decrypted():
+        if skip:
+            data, skip = data[skip:], max(skip - len(data), 0)
+        if len(data) > remaining:
+            data = data[:remaining]
+        remaining -= len(data)
+        if data:
+            yield data
+
+
+class CBCContent:
+    """
+    Decrypting reader for content stored as one AES-256-CBC stream.
+
+    Reads of at least FILE_PARALLEL_DECRYPT_THRESHOLD bytes of ciphertext
+    decrypt each read-ahead window in pieces on the crypto thread pool.
+    """
+
+    def __init__(self, source, file_key, server_iv):
+        self.source = source
+        self.file_key = file_key
+        self.server_iv = server_iv
+        self.length = decrypted_content_length(source, file_key, server_iv)
+        self.stored_size = source.seek(0, os.SEEK_END)
+        source.seek(0)
+
+    def read(self):
+        """Decrypt the whole content into one buffer, see KeyManagement.decrypt_file"""
+        self.source.seek(0)
+        return KeyManagement.decrypt_file(self.source.read(), self.file_key, self.server_iv)
+
+    def block_decryptor(self, iv, stored_length):
+        """Get a raw decryptor for reading stored_length bytes of ciphertext"""
+        if stored_length >= settings.FILE_PARALLEL_DECRYPT_THRESHOLD:
+            return KeyManagement.parallel_block_decryptor(self.file_key, iv)
+        return KeyManagement.block_decryptor(self.file_key, iv)
+
+    def chunks(self, chunk_size):
+        """Get a (reader, plaintext chunks) pair for the whole content"""
+        if self.stored_size >= settings.FILE_PARALLEL_DECRYPT_THRESHOLD and self.length:
+            # The range ends before the padding, which is trimmed rather than checked again
+            return self.range_chunks(0, self.length - 1, chunk_size)
+        reader = ReadAhead(self.source, chunk_size)
+        decryptor = KeyManagement.stream_decryptor(self.file_key, self.server_iv)
+        return reader, decryptor.decrypt_chunks(reader)
+
+    def range_chunks(self, start, end, chunk_size):
+        """Get a (reader, plaintext chunks) pair for bytes start to end inclusive"""
+        first_block = start // BLOCK_SIZE
+        last_block = end // BLOCK_SIZE
+        if first_block:
+            # The previous ciphertext block is the IV for the first one
+            self.source.seek((first_block - 1) * BLOCK_SIZE)
+            block_iv = self.source.read(BLOCK_SIZE)
+        else:
+            block_iv = self.server_iv
+
+        stored_length = (last_block - first_block + 1) * BLOCK_SIZE
+        reader = ReadAhead(self.source, chunk_size, limit=stored_length)
+        decryptor = self.block_decryptor(block_iv, stored_length)
+        return reader, decrypt_range(reader, decryptor, start - first_block * BLOCK_SIZE, end - start + 1)
+
+
+class SegmentedContent:
+    """Decrypting reader for content stored as AES-256-GCM segments"""
+
+    def __init__(self, source, file_key, server_iv=None):
+        self.source = source
+        self.file_key = file_key
+        self.header = source.read(SEGMENT_HEADER_SIZE)
+        self.segment_size = KeyManagement.parse_segment_header(self.header)
+        stored_size = source.seek(0, os.SEEK_END)
+        self.length = KeyManagement.segmented_plaintext_size(stored_size, self.segment_size)
+        self.total_segments = max(-(-self.length // self.segment_size), 1)
+
+    def read(self):
+        """Decrypt the whole content, opening its segments in parallel"""
+        self.source.seek(SEGMENT_HEADER_SIZE)
+        decryptor = KeyManagement.segment_decryptor(self.file_key, self.header, 0, self.total_segments)
+        return decryptor.update(self.source.read()) + decryptor.finalize()
+
+    def chunks(self, chunk_size):
+        """Get a (reader, plaintext chunks) pair for the whole content"""
+        return self.range_chunks(0, self.length - 1, chunk_size)
+
+    def range_chunks(self, start, end, chunk_size):
+        """Get a (reader, plaintext chunks) pair for bytes start to end inclusive"""
+        stored_segment_size = self.segment_size + SEGMENT_TAG_SIZE
+        first_segment = start // self.segment_size
+        last_segment = max(end, start) // self.segment_size
+        self.source.seek(SEGMENT_HEADER_SIZE + first_segment * stored_segment_size)
+
+        # Read whole segments at a time so each read can be opened in parallel
+        reader = ReadAhead(
+            self.source,
+            max(chunk_size // stored_segment_size, 1) * stored_segment_size,
+            limit=(last_segment - first_segment + 1) * stored_segment_size
+        )
+        decryptor = KeyManagement.segment_decryptor(
+            self.file_key, self.header, first_segment, self.total_segments
+        )
+        skip = start - first_segment * self.segment_size
+        return reader, decrypt_range(reader, decryptor, skip, end - start + 1)
+
+
+class AtRestContent:
+    """Reader for at-rest content, which is served exactly as stored"""
+
+    def __init__(self, source, file_key=None, server_iv=None):
+        self.source = source
+        self.length = source.seek(0, os.SEEK_END)
+
+    def read(self):
+        """Read the whole content"""
+        self.source.seek(0)
+        return self.source.read()
+
+    def chunks(self, chunk_size):
+        """Get a (reader, chunks) pair for the whole content"""
+        return self.range_chunks(0, self.length - 1, chunk_size)
+
+    def range_chunks(self, start, end, chunk_size):
+        """Get a (reader, chunks) pair for bytes start to end inclusive"""
+        self.source.seek(start)
+        reader = ReadAhead(self.source, chunk_size, limit=max(end - start + 1, 0))
+        return reader, reader
+
+
+CONTENT_READERS = {
+    File.FORMAT_CBC: CBCContent,
+    File.FORMAT_SEGMENTED_GCM: SegmentedContent,
+    File.FORMAT_AT_REST: AtRestContent,
+}
+
+
+def open_decrypted_content(file_instance, source, file_key):
+    """Wrap a file's open server-side encrypted content in the reader for its format"""
+    try:
+        reader_class = CONTENT_READERS[file_instance.storage_format]
+    except KeyError:
+        raise ValueError(f"Unknown storage format {file_instance.storage_format!r}")
+    return reader_class(source, file_key, bytes(file_instance.server_side_iv))
+
+
+def content_digests(file_instance, source, file_key):
+    """
+    Hash an open stored object and the content it decrypts to.
+
+    Reads the object twice, once as stored and once decrypted, and closes
+    it afterwards. file_instance only needs storage_format and
+    server_side_iv, so upload sessions can be passed too.
+
+    Returns:
+        tuple: (content_sha256, stored_sha256, content length)
+    """
+    try:
+        stored = hashlib.sha256()
+        for chunk in iter(lambda: source.read(settings.FILE_SERVE_CHUNK_SIZE), b''):
+            stored.update(chunk)
+        source.seek(0)
+        content = open_decrypted_content(file_instance, source, file_key)
+        reader, chunks = content.chunks(settings.FILE_SERVE_CHUNK_SIZE)
+    except BaseException:
+        source.close()
+        raise
+
+    digest = hashlib.sha256()
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+    finally:
+        reader.close()
+    return digest.digest(), stored.digest(), content.length
+
+
+class CoalescedContent:
+    """
+    Content reader whose whole-content reads are shared with concurrent downloads.
+
+    The download leading the SharedStream decrypts the content as usual,
+    and its followers are handed the chunks it decrypts instead of reading
+    storage themselves. A follower that falls behind the stream's buffer
+    reads the rest on its own, from where it is, and one that asks for a
+    range leaves the stream before reading anything. A leader that asks for
+    a range lets its followers read on their own.
+
+    It is also the object to close in place of a source, and the reader
+    returned by chunks() and range_chunks().
+    """
+
+    def __init__(self, file_instance, stream, subscriber, opened=None, cache=None):
+        self.file_instance = file_instance
+        self.stream = stream
+        self.subscriber = subscriber
+        self.opened = opened  # The leader's (content, source) until it starts the stream
+        self.cache = cache
+        self.length = opened[0].length if opened is not None else stream.wait_length()
+        self._reader = None
+
+    def _abandon(self):
+        """Hand the leader's open content to the caller, letting the followers read on their own"""
+        content, source = self.opened
+        self.opened = None
+        self.stream.fail(FellBehind('The leading download is not reading the whole content'))
+        return content, source
+
+    def chunks(self, chunk_size):
+        """Get a (reader, plaintext chunks) pair for the whole content"""
+        if self.opened is not None:
+            content, source = self.opened
+            try:
+                if self.cache is not None and self.length <= settings.FILE_CONTENT_CACHE_MAX_ENTRY_SIZE:
+                    # Small enough for the cache, decrypted whole and offered to it
+                    payload = content.read()
+                    source.close()
+                    self.cache.put(self.file_instance.pk, self.file_instance.encrypted_filename, payload)
+                    content = AtRestContent(io.BytesIO(payload))
+                reader, chunks = content.chunks(chunk_size)
+            except Exception as e:
+                self.opened = None
+                self.stream.fail(e)
+                source.close()
+                raise
+            except BaseException:
+                self._abandon()
+                source.close()
+                raise
+            self.opened = None
+            self.stream.start(chunks, reader.close)
+        return self, self._shared_chunks(chunk_size)
+
+    def _shared_chunks(self, chunk_size):
+        try:
+            yield from self.subscriber
+            return
+        except FellBehind:
+            pass
+        offset = self.subscriber.offset
+        if offset < self.length:
+            yield from self.range_chunks(offset, self.length - 1, chunk_size)[1]
+
+    def range_chunks(self, start, end, chunk_size):
+        """Get a (reader, plaintext chunks) pair for bytes start to end inclusive, read on its own"""
+        if self.opened is not None:
+            content, source = self._abandon()
+        else:
+            content, source = open_streamed_content(self.file_instance)
+        self.subscriber.close()
+        try:
+            self._reader, chunks = content.range_chunks(start, end, chunk_size)
+        except BaseException:
+            source.close()
+            raise
+        return self, chunks
+
+    def close(self):
+        if self.opened is not None:
+            self._abandon()[1].close()
+        self.subscriber.close()
+        if self._reader is not None:
+            self._reader.close()
+
+
+def open_served_content(file_instance):
+    """
+    Open a file's client-encrypted content for serving.
+
+    Content in this process's content cache is served from memory. Other
+    content small enough for the cache (FILE_CONTENT_CACHE_MAX_ENTRY_SIZE)
+    is decrypted whole and offered to it, so later downloads of a popular
+    file skip the storage read, the key unwrapping and the decryption;
+    larger content, and everything while the cache is off, is decrypted as
+    it streams. Either way, downloads of the same content that start while
+    another one is reading it share that one read and decryption through a
+    SharedStream, see CoalescedContent.
+
+    Returns:
+        tuple: (content reader with length, chunks() and range_chunks(), what to close if it isn't read)
+    """
+    cache = get_content_cache()
+    key, version = file_instance.pk, file_instance.encrypted_filename
+    if cache is not None:
+        payload = cache.get(key, version)
+        if payload is not None:
+            source = io.BytesIO(payload)
+            return AtRestContent(source), source
+
+    stream, subscriber, leading = get_content_flights().join((key, version))
+    if not leading:
+        try:
+            content = CoalescedContent(file_instance, stream, subscriber)
+        except FellBehind:
+            subscriber.close()
+            return open_streamed_content(file_instance)
+        except BaseException:
+            subscriber.close()
+            raise
+        return content, content
+
+    try:
+        opened = open_streamed_content(file_instance)
+    except Exception as e:
+        stream.fail(e)
+        subscriber.close()
+        raise
+    except BaseException:
+        stream.fail(FellBehind('The leading download was interrupted'))
+        subscriber.close()
+        raise
+    content = CoalescedContent(file_instance, stream, subscriber, opened, cache)
+    stream.announce(content.length)
+    return content, content
+
+
+def open_streamed_content(file_instance):
+    """Open a file's content to be decrypted as it streams, bypassing the content cache"""
+    source = file_instance.open_content()
+    try:
+        return open_decrypted_content(file_instance, source, file_instance.get_file_key()), source
+    except BaseException:
+        source.close()
+        raise
+
+
+def set_digest_headers(response, file_instance):
+    """Advertise the digest of the whole content, which partial responses are part of"""
+    if not file_instance.content_sha256:
+        return
+    value = base64.b64encode(bytes(file_instance.content_sha256)).decode()
+    response['Repr-Digest'] = f'sha-256=:{value}:'  # RFC 9530
+    response['Digest'] = f'SHA-256={value}'  # RFC 3230, for older clients
+
+
+class ContentStream:
+    """Response iterator that releases its source when the response is closed"""
+
+    def __init__(self, file_instance, chunks, source):
+        self.file_instance = file_instance
+        self.chunks = chunks
+        self.source = source
+
+    def __iter__(self):
+        try:
+            yield from self.chunks
+        except Exception as e:
+            # Headers are already sent, all we can do is cut the response short
+            logger.error(f"Error while streaming file {self.file_instance.id}: {str(e)}", exc_info=True)
+            raise
+
+    def close(self):
+        self.source.close()
+
+
+def accel_range_matches(file_instance, request):
+    """
+    Check the If-Range of a Range request for content nginx would send.
+
+    Clients hold the validators nginx sent, so those are what If-Range is
+    compared with. Requests it doesn't hold for get the whole content
+    streamed by file_content_response instead, so the range the caller
+    sees in response.byte_range is never one nginx ignores.
+    """
+    if request is None or 'HTTP_RANGE' not in request.META:
+        return True
+    etag, last_modified = file_instance.blob_store.accel_redirect_validators(file_instance.encrypted_filename)
+    return if_range_matches(request, etag, last_modified)
+
+
+def accel_redirect_response(file_instance, accel_path, content_type, disposition, request):
+    """
+    Hand an at-rest file over to nginx with X-Accel-Redirect.
+
+    nginx serves the body, Content-Length, validators and Range itself;
+    the range is still parsed here, once accel_range_matches() has
+    checked If-Range, so callers see the same response.byte_range and
+    response.content_length as with streamed content.
+    """
+    byte_range = content_length = None
+    if request is not None:
+        content_length = file_instance.blob_store.size(file_instance.encrypted_filename)
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), content_length)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{content_length}'
+            response.byte_range = None
+            response.content_length = content_length
+            return response
+
+    response = HttpResponse(content_type=content_type)
+    response['X-Accel-Redirect'] = accel_path
+    response['Content-Disposition'] = f'{disposition}; filename="{file_instance.filename}"'
+    set_digest_headers(response, file_instance)
+    response.byte_range = byte_range
+    response.content_length = content_length
+    return response
+
+
+def file_content_response(file_instance, content_type, disposition='attachment', request=None):
+    """
+    Build a streaming response with a file's client-encrypted content.
+
+    The server-side encryption is removed chunk by chunk as the response
+    is sent, with the next chunk read from storage while the current one
+    is decrypted, so memory use per download stays constant and the first
+    bytes go out without waiting for the whole file.
+
+    When a request is given, a single-range Range header (guarded by
+    If-Range) is answered with 206 Partial Content. Both storage formats
+    decrypt from near the first requested byte rather than the start of
+    the file: AES-CBC only needs the preceding ciphertext block as IV, and
+    GCM segments are sealed independently, so only the segments overlapping
+    the range are read and authenticated. The served range is exposed as
+    response.byte_range, and the length of the whole content as
+    response.content_length.
+
+    At-rest content is stored exactly as the client sent it. When its blob
+    store is readable by nginx (see BlobStore.accel_redirect_path) the
+    response is an empty X-Accel-Redirect and nginx sends the file, so no
+    content passes through the worker at all. Only a Range request whose
+    If-Range doesn't match is streamed here, as a whole.
+
+    Small files are served from and kept in this process's content cache,
+    and concurrent downloads of a file share a single read, see
+    open_served_content().
+
+    Files with a recorded content digest get Repr-Digest and Digest
+    headers, which always describe the whole content.
+
+    Args:
+        file_instance (File): The file to serve
+        content_type (str): Content type of the response
+        disposition (str): 'attachment' or 'inline'
+        request (HttpRequest): Request to honor Range headers from
+
+    Returns:
+        HttpResponse: The response streaming (or redirecting to) the content
+    """
+    if file_instance.storage_format == File.FORMAT_AT_REST and file_instance.blob_store is not None:
+        accel_path = file_instance.blob_store.accel_redirect_path(file_instance.encrypted_filename)
+        if accel_path is not None and accel_range_matches(file_instance, request):
+            return accel_redirect_response(file_instance, accel_path, content_type, disposition, request)
+
+    chunk_size = settings.FILE_SERVE_CHUNK_SIZE
+    etag = f'"{file_instance.encrypted_filename}"'
+
+    content, source = open_served_content(file_instance)
+    try:
+        content_length = content.length
+
+        byte_range = None
+        if request is not None and if_range_matches(request, etag, file_instance.updated_at):
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), content_length)
+
+        if byte_range is None:
+            reader, chunks = content.chunks(chunk_size)
+        else:
+            reader, chunks = content.range_chunks(*byte_range, chunk_size)
+    except RangeNotSatisfiable:
+        source.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{content_length}'
+        response.byte_range = None
+        response.content_length = content_length
+        return response
+    except Exception:
+        source.close()
+        raise
+
+    if byte_range is None:
+        response = StreamingHttpResponse(
+            ContentStream(file_instance, chunks, reader),
+            content_type=content_type
+        )
+        response['Content-Length'] = content_length
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            ContentStream(file_instance, chunks, reader),
+            status=206,
+            content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{content_length}'
+
+    response.byte_range = byte_range
+    response.content_length = content_length
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(file_instance.updated_at.timestamp())
+    response['Content-Disposition'] = f'{disposition}; filename="{file_instance.filename}"'
+    set_digest_headers(response, file_instance)
+    return response
+
+
+ARCHIVE_MANIFEST_NAME = 'manifest.json'
+
+
+class ArchiveBuffer:
+    """
+    Write-only target for zipfile that hands out what was written so far.
+
+    It can't seek, so ZipFile writes each member's sizes and CRC in a data
+    descriptor after its content instead of going back to its header.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Get and forget everything written since the last call"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def open_archived_content(file_instance):
+    """
+    Open a file's client-encrypted content for an archive.
+
+    Unlike open_served_content(), content that isn't already cached is
+    never read whole, so an archive holds at most a chunk of each member.
+
+    Returns:
+        tuple: (content reader with length and chunks(), its source)
+    """
+    cache = get_content_cache()
+    if cache is not None:
+        payload = cache.get(file_instance.pk, file_instance.encrypted_filename)
+        if payload is not None:
+            source = io.BytesIO(payload)
+            return AtRestContent(source), source
+
+    source = file_instance.open_content()
+    try:
+        return open_decrypted_content(file_instance, source, file_instance.get_file_key()), source
+    except BaseException:
+        source.close()
+        raise
+
+
+def archive_member_name(file_instance, taken):
+    """Pick a unique name for a file in an archive, adding ' (n)' to repeated filenames"""
+    filename = os.path.basename(file_instance.filename.replace('\\', '/')).strip() or str(file_instance.pk)
+    stem, extension = os.path.splitext(filename)
+    name, n = filename, 1
+    while name in taken:
+        n += 1
+        name = f'{stem} ({n}){extension}'
+    taken.add(name)
+    return name
+
+
+class ArchiveStream:
+    """
+    Response iterator writing a store-only ZIP of several files as it is sent.
+
+    Every member is written chunk by chunk as its content is decrypted, and
+    each step hands out just what it added to the archive. ZIP64 records
+    are used wherever sizes or offsets need them.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self._reader = None
+
+    def manifest_entry(self, file_instance):
+        return {
+            'id': file_instance.id,
+            'name': None,
+            'filename': file_instance.filename,
+            'mime_type': file_instance.mime_type,
+            'original_file_size': file_instance.original_file_size,
+            'encryption_iv': bytes(file_instance.encryption_iv).hex(),
+            'content_sha256': (
+                bytes(file_instance.content_sha256).hex() if file_instance.content_sha256 else None
+            ),
+            'upload_timestamp': file_instance.upload_timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+
+    def __iter__(self):
+        buffer = ArchiveBuffer()
+        manifest = []
+        taken = {ARCHIVE_MANIFEST_NAME}
+        try:
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for file_instance in self.files:
+                    entry = self.manifest_entry(file_instance)
+                    manifest.append(entry)
+                    try:
+                        content, source = open_archived_content(file_instance)
+                        try:
+                            self._reader, chunks = content.chunks(settings.FILE_SERVE_CHUNK_SIZE)
+                        except BaseException:
+                            source.close()
+                            raise
+                    except Exception as e:
+                        # Nothing of this member is written yet, leave it out
+                        logger.error(f"Error while archiving file {file_instance.id}: {str(e)}", exc_info=True)
+                        entry['error'] = 'The file content could not be read'
+                        continue
+
+                    entry['name'] = archive_member_name(file_instance, taken)
+                    member = zipfile.ZipInfo(entry['name'], date_time=file_instance.upload_timestamp.timetuple()[:6])
+                    # Only decides whether the member needs ZIP64 records, the written size is counted
+                    member.file_size = content.length
+                    try:
+                        with archive.open(member, 'w') as destination:
+                            for chunk in chunks:
+                                destination.write(chunk)
+                                yield buffer.take()
+                    finally:
+                        self._reader.close()
+                        self._reader = None
+                    entry['size'] = member.file_size
+
+                archive.writestr(
+                    zipfile.ZipInfo(ARCHIVE_MANIFEST_NAME, date_time=time.localtime()[:6]),
+                    json.dumps({'files': manifest}, indent=2)
+                )
+            yield buffer.take()
+        except Exception as e:
+            # Headers are already sent, all we can do is cut the archive short
+            logger.error(f"Error while streaming archive: {str(e)}", exc_info=True)
+            raise
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+
+
+def file_archive_response(files, archive_name='files.zip'):
+    """
+    Build a streaming response with a ZIP archive of several files.
+
+    Members hold the client-encrypted content exactly as single downloads
+    send it, stored without compression (the content doesn't compress).
+    The archive ends with manifest.json listing every requested file with
+    its member name, client-side IV and metadata; a file whose content
+    could not be opened has no member and an 'error' instead. An error in
+    the middle of a member cuts the response short, like single downloads.
+
+    Args:
+        files (Iterable[File]): The files to archive, in order
+        archive_name (str): Filename offered to the client
+
+    Returns:
+        StreamingHttpResponse: The response streaming the archive
+    """
+    response = StreamingHttpResponse(ArchiveStream(files), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{archive_name}"'
+    return response
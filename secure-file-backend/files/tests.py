@@ -1,3 +1,2598 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from .models import File, UploadIdempotencyKey
+from .storage import LocalBlobStore, PackedBlobStore, CachedBlobStore, S3BlobStore, BlobNotFound, get_blob_store
+from datetime import timedelta
+from django.utils import timezone
+import base64
+import hashlib
+import io
+import json
+import logging
+import magic
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import zipfile
 
-# Create your tests here.
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+User = get_user_model()
+
+
+def random_payload(size):
+    """Random bytes standing in for client-encrypted data"""
+    # libmagic now and then recognizes a file type in random bytes,
+    # which the upload validation would reject
+    sniffer = magic.Magic(mime=True)
+    while True:
+        payload = os.urandom(size)
+        if sniffer.from_buffer(payload[:1024]) == 'application/octet-stream':
+            return payload
+
+
+class BlobStoreMixin:
+    """Isolated blob store location and an authenticated client"""
+
+    def setUp(self):
+        super().setUp()
+        self.storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_dir, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.storage_dir,
+            FILE_INLINE_THRESHOLD=0,  # Tests pick the inline tier explicitly
+            FILE_CONTENT_CACHE_SIZE=0,  # Tests turn the cache on explicitly
+            FILE_STORAGES={
+                'default': {
+                    'BACKEND': 'files.storage.LocalBlobStore',
+                    'OPTIONS': {'location': os.path.join(self.storage_dir, 'blobs')},
+                },
+            },
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(
+            email='owner@test.com',
+            username='owner',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, payload, name='secret.bin'):
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile(name, payload),
+            'encryption_iv': '0' * 32,
+            'original_file_size': len(payload),
+            'mime_type': 'application/pdf',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return File.objects.get(id=response.data['file']['id'])
+
+    def assertDigests(self, file, payload):
+        """Check a file's recorded digests against its content and stored object"""
+        self.assertEqual(bytes(file.content_sha256), hashlib.sha256(payload).digest())
+        self.assertEqual(bytes(file.stored_sha256), hashlib.sha256(file.read_content()).digest())
+
+
+class BlobStoreTestCase(BlobStoreMixin, TestCase):
+    """Base test case with an isolated blob store location"""
+
+
+class LocalBlobStoreTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.store = LocalBlobStore(self.location)
+
+    def test_round_trip(self):
+        """Test saving and reading back a blob"""
+        self.store.save('abc', [b'hello ', b'world'])
+        self.assertTrue(self.store.exists('abc'))
+        self.assertEqual(self.store.size('abc'), 11)
+        self.assertEqual(self.store.read('abc'), b'hello world')
+
+    def test_fan_out_layout(self):
+        """Test that blobs are spread over hashed subdirectories"""
+        path = self.store.path('abc')
+        relative = os.path.relpath(path, self.location).split(os.sep)
+        self.assertEqual(len(relative), 3)
+        self.assertEqual(relative[-1], 'abc')
+
+    def test_missing_and_invalid_keys(self):
+        """Test missing keys raise BlobNotFound and path-like keys are rejected"""
+        with self.assertRaises(BlobNotFound):
+            self.store.open('missing')
+        self.store.delete('missing')  # No error
+        with self.assertRaises(ValueError):
+            self.store.path('../escape')
+
+
+class PackedBlobStoreTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.store = PackedBlobStore(self.location, max_packed_size=100, max_pack_size=1000)
+
+    def loose_files(self):
+        return [
+            name for root, _, names in os.walk(self.location)
+            if root != self.store.pack_dir for name in names
+        ]
+
+    def test_small_blobs_share_packs(self):
+        """Test that small blobs are packed and read back, and large ones stay loose"""
+        blobs = {f'small-{i}': os.urandom(50) for i in range(30)}
+        for key, data in blobs.items():
+            self.store.save(key, [data[:20], data[20:]])
+        self.store.save('large', os.urandom(100))
+
+        self.assertEqual(self.loose_files(), ['large'])
+        # 50-byte blobs fill a 1000-byte pack after 20
+        self.assertEqual(self.store.packs(), [1, 2])
+        for key, data in blobs.items():
+            self.assertTrue(self.store.exists(key))
+            self.assertEqual(self.store.size(key), 50)
+            self.assertEqual(self.store.read(key), data)
+        self.assertEqual(self.store.size('large'), 100)
+        self.assertIsNone(self.store.locate('large'))
+
+        # Replacing a blob moves it between packs and loose files
+        self.store.save('large', b'now small')
+        self.assertEqual(self.loose_files(), [])
+        self.store.save('small-0', os.urandom(200))
+        self.assertIsNone(self.store.locate('small-0'))
+        self.assertEqual(self.store.size('small-0'), 200)
+
+        self.store.delete('small-1')
+        self.assertFalse(self.store.exists('small-1'))
+        with self.assertRaises(BlobNotFound):
+            self.store.open('small-1')
+        with self.assertRaises(ValueError):
+            self.store.save('../escape', b'x')
+
+    def test_loose_blobs_stay_readable(self):
+        """Test that blobs stored before packing was turned on are still served"""
+        LocalBlobStore(self.location).save('old', b'stored loose')
+        self.assertEqual(self.store.read('old'), b'stored loose')
+        self.store.delete('old')
+        self.assertFalse(self.store.exists('old'))
+
+    def test_compaction(self):
+        """Test that packs with enough holes are rewritten without losing live blobs"""
+        blobs = {f'blob-{i}': os.urandom(50) for i in range(45)}
+        for key, data in blobs.items():
+            self.store.save(key, data)
+        self.assertEqual(self.store.packs(), [1, 2, 3])
+
+        # Pack 1 loses most of its blobs, pack 2 just a few
+        for i in list(range(0, 15)) + [20, 21]:
+            self.store.delete(f'blob-{i}')
+            del blobs[f'blob-{i}']
+
+        compacted, reclaimed = self.store.compact(min_dead_ratio=0.5)
+        self.assertEqual((compacted, reclaimed), (1, 750))
+        self.assertNotIn(1, self.store.packs())
+        self.assertIn(2, self.store.packs())
+        for key, data in blobs.items():
+            self.assertEqual(self.store.read(key), data)
+
+        # Nothing left to do at the same ratio
+        self.assertEqual(self.store.compact(min_dead_ratio=0.5), (0, 0))
+
+    def test_reads_follow_compaction(self):
+        """Test that a read racing a compaction finds the blob's new place"""
+        from unittest import mock
+
+        for i in range(25):
+            self.store.save(f'blob-{i}', bytes([i]) * 50)
+        for i in range(1, 20):
+            self.store.delete(f'blob-{i}')
+
+        stale = self.store.locate('blob-0')
+        self.store.compact()
+        with mock.patch.object(self.store, 'locate', side_effect=[stale, self.store.locate('blob-0')]):
+            self.assertEqual(self.store.read('blob-0'), bytes([0]) * 50)
+
+
+class CachedBlobStoreTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.store = CachedBlobStore(
+            {'BACKEND': 'files.storage.LocalBlobStore', 'OPTIONS': {'location': os.path.join(self.location, 'origin')}},
+            location=os.path.join(self.location, 'cache'),
+            max_size=2500,
+            block_size=1000,
+        )
+
+    def cached_blocks(self, key):
+        path = self.store.blob_dir(key)
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def test_blocks_are_fetched_once(self):
+        """Test that ranges fill only the blocks they cover, and cached blobs don't touch the origin"""
+        from unittest import mock
+
+        data = os.urandom(2500)
+        self.store.save('blob', data)
+        self.assertEqual(self.cached_blocks('blob'), [])
+
+        with self.store.open('blob') as f:
+            f.seek(1500)
+            self.assertEqual(f.read(600), data[1500:2100])
+        self.assertEqual(self.cached_blocks('blob'), ['1', '2'])
+        self.assertEqual(self.store.read('blob'), data)
+        self.assertEqual(self.cached_blocks('blob'), ['0', '1', '2'])
+
+        with mock.patch.object(self.store, 'origin', None):  # Any use of the origin fails
+            self.assertEqual(self.store.read('blob'), data)
+            self.assertTrue(self.store.exists('blob'))
+            self.assertEqual(self.store.size('blob'), 2500)
+            with self.store.open('blob') as f:
+                f.seek(-10, os.SEEK_END)
+                self.assertEqual(f.read(), data[-10:])
+
+        # Writes and deletes go to the origin and drop the cached copy
+        self.store.save('blob', b'replaced')
+        self.assertEqual(self.cached_blocks('blob'), [])
+        self.assertEqual(self.store.read('blob'), b'replaced')
+        self.store.delete('blob')
+        self.assertFalse(self.store.exists('blob'))
+        with self.assertRaises(BlobNotFound):
+            self.store.open('blob')
+
+    def test_least_recently_used_are_evicted(self):
+        """Test that the cache stays within max_size by dropping the oldest blobs whole"""
+        blobs = {key: os.urandom(1000) for key in ('a', 'b', 'c')}
+        for key, data in blobs.items():
+            self.store.save(key, data)
+            self.assertEqual(self.store.read(key), data)
+        self.assertEqual(self.cached_blocks('a'), [])
+        self.assertEqual(self.cached_blocks('b'), ['0'])
+        self.assertEqual(self.cached_blocks('c'), ['0'])
+
+        # Evicted blobs are read from the origin again
+        self.assertEqual(self.store.read('a'), blobs['a'])
+        self.assertEqual(self.cached_blocks('a'), ['0'])
+        self.assertEqual(self.cached_blocks('b'), [])
+
+    def test_concurrent_reads_fill_once(self):
+        """Test that concurrent reads of a missing block fetch it from the origin once"""
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        import time
+
+        data = os.urandom(1000)
+        self.store.save('blob', data)
+        origin_open = self.store.origin.open
+
+        def slow_open(key):
+            time.sleep(0.1)
+            return origin_open(key)
+
+        with mock.patch.object(self.store.origin, 'open', side_effect=slow_open) as opened, \
+                ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(self.store.read, ['blob'] * 4))
+        self.assertEqual(results, [data] * 4)
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(self.cached_blocks('blob'), ['0'])
+
+
+@unittest.skipIf(ThreadedMotoServer is None, 'moto is not installed')
+class S3BlobStoreTestCase(BlobStoreTestCase):
+    """Base test case running an S3 stand-in (moto server) on localhost"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        # Keep the stand-in's request log out of the test output
+        werkzeug_logger = logging.getLogger('werkzeug')
+        cls.addClassCleanup(werkzeug_logger.setLevel, werkzeug_logger.level)
+        werkzeug_logger.setLevel(logging.ERROR)
+        cls.moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        cls.moto_server.start()
+        cls.addClassCleanup(cls.moto_server.stop)
+        cls.s3_options = {
+            'bucket': 'secure-files',
+            'endpoint_url': f'http://127.0.0.1:{port}',
+            'region_name': 'us-east-1',
+            'access_key_id': 'testing',
+            'secret_access_key': 'testing',
+            'part_size': 5 * 1024 * 1024,
+            'read_window': 64 * 1024,
+        }
+
+    def setUp(self):
+        super().setUp()
+        self.store = S3BlobStore(**self.s3_options)
+        self.store.client.create_bucket(Bucket='secure-files')
+        self.addCleanup(self.empty_bucket)
+
+    def empty_bucket(self):
+        client = self.store.client
+        for upload in client.list_multipart_uploads(Bucket='secure-files').get('Uploads', []):
+            client.abort_multipart_upload(Bucket='secure-files', Key=upload['Key'], UploadId=upload['UploadId'])
+        for item in client.list_objects_v2(Bucket='secure-files').get('Contents', []):
+            client.delete_object(Bucket='secure-files', Key=item['Key'])
+        client.delete_bucket(Bucket='secure-files')
+
+
+class S3BlobStoreTest(S3BlobStoreTestCase):
+    def test_round_trip(self):
+        """Test small blobs, existence, size and deletion"""
+        self.store.save('abc', [b'hello ', b'world'])
+        self.assertTrue(self.store.exists('abc'))
+        self.assertEqual(self.store.size('abc'), 11)
+        self.assertEqual(self.store.read('abc'), b'hello world')
+
+        self.store.delete('abc')
+        self.store.delete('abc')  # No error
+        self.assertFalse(self.store.exists('abc'))
+        with self.assertRaises(BlobNotFound):
+            self.store.open('abc')
+        with self.assertRaises(ValueError):
+            self.store.object_key('a/b')
+
+    def test_multipart_upload_and_ranged_reads(self):
+        """Test that large blobs go up in parts and can be read from any offset"""
+        payload = os.urandom(11 * 1024 * 1024 + 123)
+        writer = self.store.writer('big')
+        for i in range(0, len(payload), 1024 * 1024):
+            writer.write(payload[i:i + 1024 * 1024])
+        self.assertEqual(len(writer._parts), 2)
+        self.assertFalse(self.store.exists('big'))
+        writer.commit()
+        self.assertEqual(len(writer._parts), 3)
+        self.assertEqual(self.store.size('big'), len(payload))
+
+        with self.store.open('big') as f:
+            self.assertEqual(f.seek(0, os.SEEK_END), len(payload))
+            f.seek(len(payload) - 32)
+            self.assertEqual(f.read(32), payload[-32:])
+            f.seek(5_000_000)
+            self.assertEqual(f.read(200_000), payload[5_000_000:5_200_000])
+            self.assertEqual(f.read(10), payload[5_200_000:5_200_010])
+
+    def test_aborted_writes_leave_nothing_behind(self):
+        """Test that aborting a multipart upload discards its parts"""
+        writer = self.store.writer('gone')
+        writer.write(os.urandom(6 * 1024 * 1024))
+        writer.abort()
+        self.assertFalse(self.store.exists('gone'))
+        self.assertEqual(
+            self.store.client.list_multipart_uploads(Bucket='secure-files').get('Uploads', []),
+            []
+        )
+
+    def test_files_are_stored_and_served_from_s3(self):
+        """Test uploads, downloads and range requests against the S3 backend"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        storages = {
+            'default': {'BACKEND': 'files.storage.LocalBlobStore', 'OPTIONS': {'location': self.storage_dir}},
+            's3': {'BACKEND': 'files.storage.S3BlobStore', 'OPTIONS': self.s3_options},
+        }
+        with override_settings(FILE_STORAGES=storages, FILE_UPLOAD_STORAGE='s3', FILE_SERVE_CHUNK_SIZE=4096):
+            payload = random_payload(100_000)
+            file = self.upload(payload)
+            self.assertEqual(file.storage_backend, 's3')
+            self.assertTrue(self.store.exists(file.encrypted_filename))
+
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            self.assertEqual(b''.join(response.streaming_content), payload)
+            response = self.client.get(f'/api/files/{file.id}/content/', HTTP_RANGE='bytes=70000-70099')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), payload[70_000:70_100])
+
+            self.client.delete(f'/api/files/{file.id}/')
+            with override_settings(FILE_TRASH_RETENTION=timedelta(0)), self.captureOnCommitCallbacks(execute=True):
+                call_command('reclaim_trash', stdout=StringIO())
+            self.assertFalse(self.store.exists(file.encrypted_filename))
+
+    def test_direct_upload_to_presigned_url(self):
+        """Test that direct uploads go straight to S3 through a pre-signed URL"""
+        from django.core.management import call_command
+        from io import StringIO
+        import urllib.request
+
+        storages = {
+            'default': {'BACKEND': 'files.storage.LocalBlobStore', 'OPTIONS': {'location': self.storage_dir}},
+            's3': {'BACKEND': 'files.storage.S3BlobStore', 'OPTIONS': self.s3_options},
+        }
+        with override_settings(FILE_STORAGES=storages, FILE_UPLOAD_STORAGE='s3', FILE_DIRECT_UPLOAD_WORKERS=0):
+            payload = random_payload(20_000)
+            upload = self.client.post('/api/files/direct-uploads/', {
+                'filename': 'direct.bin',
+                'mime_type': 'application/pdf',
+                'original_file_size': len(payload),
+                'encryption_iv': 'ab' * 16,
+                'total_size': len(payload),
+            }, format='json').data
+            self.assertTrue(upload['upload_url'].startswith(self.s3_options['endpoint_url']))
+
+            request = urllib.request.Request(
+                upload['upload_url'],
+                data=payload,
+                method='PUT',
+                headers={'Content-Type': 'application/octet-stream'}
+            )
+            with urllib.request.urlopen(request, timeout=30) as response:
+                self.assertEqual(response.status, 200)
+
+            response = self.client.post(f"/api/files/direct-uploads/{upload['id']}/complete/")
+            self.assertEqual(response.status_code, 202, response.content)
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('finalize_direct_uploads', stdout=StringIO())
+            file = File.objects.get()
+            self.assertEqual(file.storage_backend, 's3')
+            self.assertFalse(self.store.exists(f"incoming-{upload['id'].replace('-', '')}"))
+            self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+
+
+class FileStorageTest(BlobStoreTestCase):
+    def test_upload_stores_content_in_blob_store(self):
+        """Test that uploads keep content out of the database row"""
+        payload = random_payload(5000)
+        file = self.upload(payload)
+
+        self.assertEqual(file.storage_backend, 'default')
+        self.assertIsNone(File.objects.values_list('encrypted_content', flat=True).get(id=file.id))
+        self.assertTrue(get_blob_store().exists(file.encrypted_filename))
+
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response), payload)
+
+    def test_downloads_carry_content_digest(self):
+        """Test that digests are recorded on upload and sent with full and partial content"""
+        import base64
+
+        payload = random_payload(5000)
+        file = self.upload(payload)
+        self.assertDigests(file, payload)
+
+        digest = base64.b64encode(hashlib.sha256(payload).digest()).decode()
+        for extra in ({}, {'HTTP_RANGE': 'bytes=10-19'}):
+            response = self.client.get(f'/api/files/{file.id}/content/', **extra)
+            self.assertEqual(response['Repr-Digest'], f'sha-256=:{digest}:')
+            self.assertEqual(response['Digest'], f'SHA-256={digest}')
+
+        # Files stored before digests existed just go without
+        File.objects.filter(id=file.id).update(content_sha256=None)
+        self.assertNotIn('Repr-Digest', self.client.get(f'/api/files/{file.id}/content/'))
+
+    def test_metadata_queries_skip_content(self):
+        """Test that listing files never selects the content column"""
+        self.upload(random_payload(100))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/files/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('encrypted_content' in q['sql'] for q in queries.captured_queries))
+
+    def test_legacy_inline_content_is_readable(self):
+        """Test that rows created before the blob store still serve content"""
+        from .key_management import KeyManagement
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        payload = random_payload(300)
+        file = File.objects.create(
+            user=self.user,
+            filename='legacy.bin',
+            encrypted_file_key=KeyManagement.encrypt_file_key(key),
+            server_side_iv=iv,
+            encrypted_content=KeyManagement.encrypt_file(payload, key, iv),
+        )
+
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response), payload)
+
+    def test_delete_removes_blob(self):
+        """Test that deleting a file removes its stored content once the trash is reclaimed"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        file = self.upload(random_payload(100))
+        response = self.client.delete(f'/api/files/{file.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(get_blob_store().exists(file.encrypted_filename))
+        with override_settings(FILE_TRASH_RETENTION=timedelta(0)), self.captureOnCommitCallbacks(execute=True):
+            call_command('reclaim_trash', stdout=StringIO())
+        self.assertFalse(get_blob_store().exists(file.encrypted_filename))
+
+
+class PackedStorageTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        storage_override = override_settings(FILE_STORAGES={
+            'default': {
+                'BACKEND': 'files.storage.PackedBlobStore',
+                'OPTIONS': {'location': os.path.join(self.storage_dir, 'blobs'), 'max_packed_size': 8192},
+            },
+        })
+        storage_override.enable()
+        self.addCleanup(storage_override.disable)
+
+    def test_small_uploads_are_packed(self):
+        """Test that small uploads land in a pack and are served from it, including ranges"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        payloads = [random_payload(3000) for _ in range(3)]
+        files = [self.upload(payload, name=f'{i}.bin') for i, payload in enumerate(payloads)]
+        store = get_blob_store()
+        self.assertEqual(store.packs(), [1])
+        for file, payload in zip(files, payloads):
+            self.assertIsNotNone(store.locate(file.encrypted_filename))
+            self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/').streaming_content), payload)
+            response = self.client.get(f'/api/files/{file.id}/content/', HTTP_RANGE='bytes=1000-1999')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), payload[1000:2000])
+
+        # The compaction command works on the configured store
+        out = StringIO()
+        call_command('compact_packs', stdout=out)
+        self.assertIn('Compacted 0 packs', out.getvalue())
+
+
+class CachedStorageTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        storage_override = override_settings(FILE_STORAGES={
+            'default': {
+                'BACKEND': 'files.storage.CachedBlobStore',
+                'OPTIONS': {
+                    'origin': {
+                        'BACKEND': 'files.storage.LocalBlobStore',
+                        'OPTIONS': {'location': os.path.join(self.storage_dir, 'blobs')},
+                    },
+                    'location': os.path.join(self.storage_dir, 'cache'),
+                    'block_size': 16 * 1024,
+                },
+            },
+        })
+        storage_override.enable()
+        self.addCleanup(storage_override.disable)
+
+    def test_downloads_are_served_from_the_cache(self):
+        """Test that repeat downloads and ranges don't read the origin once cached"""
+        from unittest import mock
+
+        payload = random_payload(50_000)
+        file = self.upload(payload)
+        store = get_blob_store()
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/').streaming_content), payload)
+
+        with mock.patch.object(LocalBlobStore, 'open', side_effect=AssertionError('origin read')), \
+                mock.patch.object(LocalBlobStore, 'size', side_effect=AssertionError('origin read')):
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            self.assertEqual(b''.join(response.streaming_content), payload)
+            response = self.client.get(f'/api/files/{file.id}/content/', HTTP_RANGE='bytes=20000-29999')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), payload[20000:30000])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
+        self.assertFalse(store.exists(file.encrypted_filename))
+        self.assertFalse(os.path.exists(store.blob_dir(file.encrypted_filename)))
+
+
+class StreamingUploadTest(BlobStoreTestCase):
+    def stored_blobs(self):
+        blobs_dir = os.path.join(self.storage_dir, 'blobs')
+        return [name for _, _, names in os.walk(blobs_dir) for name in names]
+
+    def test_stream_encryptor_matches_encrypt_file(self):
+        """Test that chunked encryption produces the same ciphertext"""
+        from .key_management import KeyManagement
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        payload = os.urandom(100_003)
+        encryptor = KeyManagement.stream_encryptor(key, iv)
+        chunks = [payload[i:i + 7000] for i in range(0, len(payload), 7000)]
+
+        self.assertEqual(
+            b''.join(encryptor.encrypt_chunks(chunks)),
+            KeyManagement.encrypt_file(payload, key, iv)
+        )
+
+    def test_crypto_allocates_one_buffer(self):
+        """Test that encrypting or decrypting a file allocates about one payload"""
+        from .key_management import KeyManagement
+        import tracemalloc
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        payload = os.urandom(4 * 2 ** 20)
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        for threshold in (2 ** 40, 0):  # Single-threaded and parallel decryption
+            with override_settings(FILE_PARALLEL_DECRYPT_THRESHOLD=threshold):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                encrypted = KeyManagement.encrypt_file(payload, key, iv)
+                self.assertLess(tracemalloc.get_traced_memory()[1] - baseline, 1.1 * len(payload))
+
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                decrypted = KeyManagement.decrypt_file(encrypted, key, iv)
+                self.assertLess(tracemalloc.get_traced_memory()[1] - baseline, 1.1 * len(payload))
+                self.assertEqual(decrypted, payload)
+                del encrypted, decrypted
+
+    def test_large_upload_round_trip(self):
+        """Test an upload spanning many handler chunks"""
+        payload = random_payload(300_000)
+        file = self.upload(payload)
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(b''.join(response), payload)
+        self.assertEqual(self.stored_blobs(), [file.encrypted_filename])
+
+    @override_settings(FILE_UPLOAD_MAX_SIZE=1000)
+    def test_oversized_upload_is_not_stored(self):
+        """Test that uploads over the limit are rejected without leftovers"""
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('big.bin', random_payload(5000)),
+            'encryption_iv': '0' * 32,
+            'original_file_size': 5000,
+            'mime_type': 'application/pdf',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('file', response.data['details'])
+        self.assertEqual(self.stored_blobs(), [])
+
+    def test_rejected_upload_is_discarded(self):
+        """Test that content failing validation is removed from storage"""
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('plain.txt', b'not encrypted at all\n' * 50),
+            'encryption_iv': '0' * 32,
+            'original_file_size': 1050,
+            'mime_type': 'text/plain',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_blobs(), [])
+        self.assertFalse(File.objects.exists())
+
+
+@override_settings(FILE_SERVE_CHUNK_SIZE=4096)
+class ContentServingTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payload = random_payload(50_000)
+        self.file = self.upload(self.payload)
+
+    def create_share(self, **kwargs):
+        from shares.models import SharePermission
+        return SharePermission.objects.create(
+            file=self.file,
+            shared_by=self.user,
+            is_download_enabled=True,
+            **kwargs
+        )
+
+    def assertStreams(self, response, content_type):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], content_type)
+        self.assertEqual(int(response['Content-Length']), len(self.payload))
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+    def test_decrypted_size_from_tail(self):
+        """Test that the decrypted size only needs the last blocks"""
+        from .key_management import KeyManagement
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        for size in (0, 1, 15, 16, 17, 4095):
+            encrypted = KeyManagement.encrypt_file(os.urandom(size), key, iv)
+            self.assertEqual(
+                KeyManagement.decrypted_size(len(encrypted), encrypted[-32:], key, iv),
+                size
+            )
+
+    def test_parallel_decrypt_matches_single_threaded(self):
+        """Test that decrypting CBC data in pieces stitches back the same plaintext"""
+        from .key_management import KeyManagement
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        for size in (0, 15, 16, 100_003):
+            payload = os.urandom(size)
+            encrypted = KeyManagement.encrypt_file(payload, key, iv)
+            for workers in (1, 3, 8):
+                decrypted = KeyManagement.parallel_decrypt(encrypted, key, iv, workers)
+                self.assertEqual(decrypted[:size], payload)
+
+        with override_settings(FILE_PARALLEL_DECRYPT_THRESHOLD=0):
+            self.assertEqual(KeyManagement.decrypt_file(encrypted, key, iv), payload)
+
+    def test_all_endpoints_stream(self):
+        """Test that every content endpoint streams the decrypted content"""
+        share = self.create_share()
+        self.assertStreams(self.client.get(f'/api/files/{self.file.id}/content/'), 'application/octet-stream')
+        self.assertStreams(self.client.get(f'/api/files/{self.file.id}/preview/'), 'application/pdf')
+
+        # shares.views.FilePreviewView is not routed, call it directly
+        from shares.views import FilePreviewView as SharesFilePreviewView
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, self.user)
+        self.assertStreams(SharesFilePreviewView.as_view()(request, file_id=self.file.id), 'application/pdf')
+
+        anonymous = APIClient()
+        self.assertStreams(
+            anonymous.get(f'/api/shares/shares/share/{share.share_link_token}/preview/'),
+            'application/octet-stream'
+        )
+        self.assertStreams(
+            anonymous.get(f'/api/shares/shares/share/{share.share_link_token}/download/'),
+            'application/octet-stream'
+        )
+
+    def test_share_download_counts_once(self):
+        """Test that a streamed share download is recorded"""
+        share = self.create_share(max_downloads=1)
+        url = f'/api/shares/shares/share/{share.share_link_token}/download/'
+        self.assertStreams(APIClient().get(url), 'application/octet-stream')
+        share.refresh_from_db()
+        self.assertEqual(share.downloads_used, 1)
+        self.assertEqual(APIClient().get(url).status_code, 403)
+
+
+@override_settings(FILE_SERVE_CHUNK_SIZE=4096, FILE_SEGMENT_SIZE=1024)
+class RangeRequestTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payload = random_payload(20_000)
+        self.file = self.upload(self.payload)
+        self.url = f'/api/files/{self.file.id}/content/'
+
+    def get_range(self, value, **extra):
+        return self.client.get(self.url, HTTP_RANGE=value, **extra)
+
+    def test_ranges_decrypt_from_any_offset(self):
+        """Test ranges starting and ending inside and on block boundaries"""
+        for start, end in [(0, 0), (1, 30), (16, 31), (4095, 4097), (19_990, 19_999), (5, 19_999)]:
+            response = self.get_range(f'bytes={start}-{end}')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/20000')
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+            self.assertEqual(b''.join(response.streaming_content), self.payload[start:end + 1])
+
+    def test_open_and_suffix_ranges(self):
+        """Test open-ended and suffix byte ranges"""
+        response = self.get_range('bytes=19000-')
+        self.assertEqual(b''.join(response.streaming_content), self.payload[19_000:])
+        response = self.get_range('bytes=-100')
+        self.assertEqual(response['Content-Range'], 'bytes 19900-19999/20000')
+        self.assertEqual(b''.join(response.streaming_content), self.payload[-100:])
+
+    def test_unsatisfiable_and_ignored_ranges(self):
+        """Test 416 for out-of-bounds ranges and full content for unsupported ones"""
+        response = self.get_range('bytes=20000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */20000')
+
+        for value in ('bytes=0-1,5-9', 'items=0-1', 'bytes=9-1'):
+            response = self.get_range(value)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+    def test_if_range(self):
+        """Test that ranges only apply while If-Range still matches"""
+        etag = self.client.get(self.url)['ETag']
+        response = self.get_range('bytes=10-19', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.get_range('bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+    def test_resumed_share_download_is_not_counted_again(self):
+        """Test that resuming a share download doesn't use up another one, for every recipient of a link"""
+        from shares.models import SharePermission
+
+        share = SharePermission.objects.create(
+            file=self.file,
+            shared_by=self.user,
+            is_download_enabled=True,
+            max_downloads=3
+        )
+        url = f'/api/shares/shares/share/{share.share_link_token}/download/'
+        first, second, third = APIClient(), APIClient(), APIClient()
+
+        # Resuming before any recorded download counts as a download, with a token per recipient
+        response = first.get(url, HTTP_RANGE='bytes=0-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.payload[:2000])
+        first_token = response['Resume-Token']
+        response = second.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+        second_token = response['Resume-Token']
+        self.assertNotEqual(first_token, second_token)
+
+        # Resumes anywhere up to what their download was sent are free, however early in the file
+        response = first.get(url, HTTP_RANGE='bytes=2000-', HTTP_RESUME_TOKEN=first_token)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.payload[2000:])
+        self.assertNotIn('Resume-Token', response)
+        response = second.get(url, HTTP_RANGE='bytes=1-100', HTTP_RESUME_TOKEN=second_token)
+        self.assertEqual(b''.join(response.streaming_content), self.payload[1:101])
+        share.refresh_from_db()
+        self.assertEqual(share.downloads_used, 2)
+
+        response = third.get(url, HTTP_RANGE='bytes=0-999')
+        self.assertEqual(b''.join(response.streaming_content), self.payload[:1000])
+        third_token = response['Resume-Token']
+
+        # A fresh download needs a remaining download
+        self.assertEqual(third.get(url).status_code, 403)
+        self.assertEqual(third.get(url, HTTP_RANGE='bytes=0-10').status_code, 403)
+
+        # Resumes must come from a recorded download and can't skip past what it was sent
+        self.assertEqual(third.get(url, HTTP_RANGE='bytes=1000-', HTTP_RESUME_TOKEN='forged').status_code, 403)
+        self.assertEqual(third.get(url, HTTP_RANGE='bytes=5000-', HTTP_RESUME_TOKEN=third_token).status_code, 403)
+        response = third.get(url, HTTP_RANGE='bytes=1000-', HTTP_RESUME_TOKEN=third_token)
+        self.assertEqual(b''.join(response.streaming_content), self.payload[1000:])
+        share.refresh_from_db()
+        self.assertEqual(share.downloads_used, 3)
+
+        # Resumes past the window count as new downloads
+        with override_settings(SHARE_DOWNLOAD_RESUME_WINDOW=timedelta(0)):
+            response = first.get(url, HTTP_RANGE='bytes=2000-', HTTP_RESUME_TOKEN=first_token)
+            self.assertEqual(response.status_code, 403)
+
+
+@override_settings(FILE_STORAGE_FORMAT=File.FORMAT_CBC)
+class CBCRangeRequestTest(RangeRequestTest):
+    """The same range requests against content in the AES-CBC format"""
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.file.storage_format, File.FORMAT_CBC)
+
+    def test_whole_reads_decrypt_into_one_buffer(self):
+        """Test that content read whole for the content cache goes through decrypt_file"""
+        from unittest import mock
+        from .key_management import KeyManagement
+
+        with override_settings(FILE_CONTENT_CACHE_SIZE=2 ** 20), mock.patch.object(
+            KeyManagement, 'decrypt_file', wraps=KeyManagement.decrypt_file
+        ) as decrypt_file:
+            for _ in range(2):
+                self.assertEqual(b''.join(self.client.get(self.url).streaming_content), self.payload)
+        decrypt_file.assert_called_once()
+
+    def test_large_reads_decrypt_in_parallel(self):
+        """Test that downloads and ranges past FILE_PARALLEL_DECRYPT_THRESHOLD decrypt on the crypto pool"""
+        from unittest import mock
+        from .key_management import KeyManagement
+
+        with override_settings(FILE_PARALLEL_DECRYPT_THRESHOLD=8192), mock.patch.object(
+            KeyManagement, 'parallel_decrypt', wraps=KeyManagement.parallel_decrypt
+        ) as parallel_decrypt:
+            self.assertEqual(b''.join(self.client.get(self.url).streaming_content), self.payload)
+            # A call per read-ahead window rather than one for the whole file
+            self.assertGreater(parallel_decrypt.call_count, 1)
+            calls = parallel_decrypt.call_count
+            response = self.get_range('bytes=1000-15000')
+            self.assertEqual(b''.join(response.streaming_content), self.payload[1000:15001])
+            self.assertGreater(parallel_decrypt.call_count, calls)
+
+            # Shorter reads aren't worth the hand-off
+            calls = parallel_decrypt.call_count
+            response = self.get_range('bytes=100-4999')
+            self.assertEqual(b''.join(response.streaming_content), self.payload[100:5000])
+        self.assertEqual(parallel_decrypt.call_count, calls)
+
+
+@override_settings(FILE_UPLOAD_STORAGE='')
+class DatabaseRangeRequestTest(RangeRequestTest):
+    """The same range requests against content kept in the database"""
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.file.storage_backend, '')
+
+
+@override_settings(FILE_STORAGE_FORMAT=File.FORMAT_AT_REST)
+class AtRestRangeRequestTest(RangeRequestTest):
+    """The same range requests against at-rest content streamed by the application"""
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.file.storage_format, File.FORMAT_AT_REST)
+        self.assertEqual(self.file.read_content(), self.payload)
+
+
+@override_settings(FILE_STORAGE_FORMAT=File.FORMAT_AT_REST)
+class AccelRedirectTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        storages_override = override_settings(FILE_STORAGES={
+            'default': {
+                'BACKEND': 'files.storage.LocalBlobStore',
+                'OPTIONS': {
+                    'location': os.path.join(self.storage_dir, 'blobs'),
+                    'accel_redirect': '/protected/blobs',
+                },
+            },
+        })
+        storages_override.enable()
+        self.addCleanup(storages_override.disable)
+        self.payload = random_payload(5000)
+        self.file = self.upload(self.payload)
+        self.url = f'/api/files/{self.file.id}/content/'
+
+    def test_content_is_handed_to_nginx(self):
+        """Test that at-rest content is sent by nginx rather than streamed"""
+        store = self.file.blob_store
+        relative_path = store.relative_path(self.file.encrypted_filename)
+        self.assertEqual(store.read(self.file.encrypted_filename), self.payload)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/blobs/{relative_path}')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="secret.bin"')
+        # Readable by nginx's workers, which don't run as the backend's user
+        self.assertEqual(os.stat(store.path(self.file.encrypted_filename)).st_mode & 0o777, 0o644)
+
+        # nginx answers ranges itself; only unsatisfiable ones stop here
+        self.assertIn('X-Accel-Redirect', self.client.get(self.url, HTTP_RANGE='bytes=10-19'))
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */5000')
+
+    def test_other_formats_are_still_streamed(self):
+        """Test that server-side encrypted content never bypasses decryption"""
+        with override_settings(FILE_STORAGE_FORMAT=File.FORMAT_SEGMENTED_GCM):
+            encrypted = self.upload(self.payload, name='other.bin')
+        response = self.client.get(f'/api/files/{encrypted.id}/content/')
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+    def test_if_range_is_checked_before_handing_over(self):
+        """Test that a stale If-Range gets the whole content rather than nginx's judgement"""
+        from django.utils.http import http_date
+
+        path = self.file.blob_store.path(self.file.encrypted_filename)
+        os.utime(path, (1_700_000_000, 1_700_000_000))
+        etag = f'"{1_700_000_000:x}-{5000:x}"'
+
+        # The validators nginx sends for the blob keep ranges
+        for if_range in (etag, http_date(1_700_000_000)):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=if_range)
+            self.assertIn('X-Accel-Redirect', response)
+            self.assertEqual(response.byte_range, (10, 19))
+
+        for if_range in ('"stale"', f'W/{etag}', http_date(1_600_000_000)):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+        # An If-Range without a Range is nginx's business
+        self.assertIn('X-Accel-Redirect', self.client.get(self.url, HTTP_IF_RANGE='"stale"'))
+
+    def test_stale_if_range_counts_as_a_share_download(self):
+        """Test that a resume with a stale If-Range is counted like the whole download it gets"""
+        from shares.models import SharePermission
+
+        share = SharePermission.objects.create(
+            file=self.file,
+            shared_by=self.user,
+            is_download_enabled=True,
+            max_downloads=2
+        )
+        url = f'/api/shares/shares/share/{share.share_link_token}/download/'
+        anonymous = APIClient()
+        resume_token = anonymous.get(url)['Resume-Token']
+        response = anonymous.get(
+            url, HTTP_RANGE='bytes=4000-', HTTP_IF_RANGE='"stale"', HTTP_RESUME_TOKEN=resume_token
+        )
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+        share.refresh_from_db()
+        self.assertEqual(share.downloads_used, 2)
+
+    def test_resumed_share_download_is_not_counted_again(self):
+        """Test that share downloads still see the requested range"""
+        from shares.models import SharePermission
+
+        share = SharePermission.objects.create(
+            file=self.file,
+            shared_by=self.user,
+            is_download_enabled=True,
+            max_downloads=1
+        )
+        url = f'/api/shares/shares/share/{share.share_link_token}/download/'
+        anonymous = APIClient()
+        response = anonymous.get(url)
+        self.assertIn('X-Accel-Redirect', response)
+        response = anonymous.get(url, HTTP_RANGE='bytes=4000-', HTTP_RESUME_TOKEN=response['Resume-Token'])
+        self.assertIn('X-Accel-Redirect', response)
+        self.assertEqual(anonymous.get(url, HTTP_RANGE='bytes=1000-').status_code, 403)
+        share.refresh_from_db()
+        self.assertEqual(share.downloads_used, 1)
+        self.assertEqual(anonymous.get(url).status_code, 403)
+
+
+@override_settings(FILE_SERVE_CHUNK_SIZE=4096, FILE_SEGMENT_SIZE=1024)
+class SegmentedFormatTest(BlobStoreTestCase):
+    def test_segment_round_trip(self):
+        """Test sealing and opening segments with any chunking"""
+        from .key_management import KeyManagement
+
+        key = KeyManagement.generate_file_key()
+        iv = KeyManagement.generate_iv()
+        header = KeyManagement.segment_header(1024, iv)
+        self.assertEqual(KeyManagement.parse_segment_header(header), 1024)
+
+        for size in (0, 1, 1023, 1024, 1025, 50_000):
+            payload = os.urandom(size)
+            encryptor = KeyManagement.segment_encryptor(key, iv, 1024)
+            chunks = [payload[i:i + 3000] for i in range(0, size, 3000)]
+            stored = b''.join(encryptor.encrypt_chunks(chunks))
+            self.assertEqual(len(stored), KeyManagement.segmented_size(size, 1024))
+            self.assertEqual(KeyManagement.segmented_plaintext_size(len(stored), 1024), size)
+
+            segments = max(-(-size // 1024), 1)
+            decryptor = KeyManagement.segment_decryptor(key, stored[:16], 0, segments)
+            self.assertEqual(decryptor.update(stored[16:]) + decryptor.finalize(), payload)
+
+    def test_uploads_use_segmented_format(self):
+        """Test that new uploads record and use the segmented format"""
+        payload = random_payload(10_000)
+        file = self.upload(payload)
+        self.assertEqual(file.storage_format, File.FORMAT_SEGMENTED_GCM)
+        self.assertEqual(file.read_content()[:5], b'SFSG\x01')
+
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(int(response['Content-Length']), len(payload))
+        self.assertEqual(b''.join(response.streaming_content), payload)
+
+    def test_tampering_is_detected(self):
+        """Test that modified, dropped or truncated segments fail to decrypt"""
+        from cryptography.exceptions import InvalidTag
+
+        payload = random_payload(10_000)
+        file = self.upload(payload)
+        stored = file.read_content()
+        store = get_blob_store()
+        stored_segment = 1024 + 16
+
+        tampered = bytearray(stored)
+        tampered[16 + 2 * stored_segment + 5] ^= 1
+        dropped = stored[:16 + stored_segment] + stored[16 + 2 * stored_segment:]
+        truncated = stored[:16 + 3 * stored_segment]
+
+        for content in (bytes(tampered), dropped, truncated):
+            store.save(file.encrypted_filename, content)
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            with self.assertRaises(InvalidTag):
+                b''.join(response.streaming_content)
+
+        # Segments before a damaged one are still served on their own
+        store.save(file.encrypted_filename, bytes(tampered))
+        response = self.client.get(f'/api/files/{file.id}/content/', HTTP_RANGE='bytes=0-2047')
+        self.assertEqual(b''.join(response.streaming_content), payload[:2048])
+
+        # Read whole for the cache, the download fails before anything is sent
+        with override_settings(FILE_CONTENT_CACHE_SIZE=2 ** 20), self.assertLogs('files.views', 'ERROR'):
+            self.assertEqual(self.client.get(f'/api/files/{file.id}/content/').status_code, 500)
+
+
+@override_settings(FILE_UPLOAD_CHUNK_SIZE=4096, FILE_SEGMENT_SIZE=1024)
+class UploadSessionTestCase(BlobStoreTestCase):
+    """Base test case for upload sessions with a 4 KiB chunk size"""
+
+    def setUp(self):
+        super().setUp()
+        staging_override = override_settings(FILE_UPLOAD_STAGING_DIR=os.path.join(self.storage_dir, 'staging'))
+        staging_override.enable()
+        self.addCleanup(staging_override.disable)
+
+    def start_session(self, payload):
+        response = self.client.post('/api/files/uploads/', {
+            'filename': 'big.bin',
+            'mime_type': 'application/pdf',
+            'original_file_size': len(payload),
+            'encryption_iv': 'ab' * 16,
+            'total_size': len(payload),
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.data
+
+    def put_chunk(self, session_id, index, data, **extra):
+        # Assembled part files are removed once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.put(
+                f'/api/files/uploads/{session_id}/chunks/{index}/',
+                data,
+                content_type='application/octet-stream',
+                **extra
+            )
+
+    def complete(self, session_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/files/uploads/{session_id}/complete/')
+
+
+class UploadSessionTest(UploadSessionTestCase):
+    def test_chunked_upload_round_trip(self):
+        """Test that a chunked upload serves the same content as a single one"""
+        payload = random_payload(10_000)
+        session = self.start_session(payload)
+        self.assertEqual(session['chunk_size'], 4096)
+        self.assertEqual(session['total_chunks'], 3)
+
+        for index in range(3):
+            response = self.put_chunk(session['id'], index, payload[index * 4096:(index + 1) * 4096])
+            self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.data['is_complete'])
+
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201, response.content)
+        file = File.objects.get(id=response.data['file']['id'])
+        self.assertEqual(file.encryption_iv, bytes.fromhex('ab' * 16))
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'staging')), [])
+        # Completing doesn't read the upload again to hash it, that is left to scrub_content --backfill
+        self.assertIsNone(file.content_sha256)
+        self.assertNotIn('Repr-Digest', self.client.get(f'/api/files/{file.id}/content/'))
+
+    def test_resume_after_interruption(self):
+        """Test retried and out-of-order chunks and progress reporting"""
+        payload = random_payload(9000)
+        session = self.start_session(payload)
+        url = f"/api/files/uploads/{session['id']}/"
+
+        self.assertEqual(self.put_chunk(session['id'], 0, payload[:4096]).status_code, 200)
+        # Retrying a received chunk is acknowledged
+        self.assertEqual(self.put_chunk(session['id'], 0, payload[:4096]).status_code, 200)
+        # Chunks must have the expected size
+        self.assertEqual(self.put_chunk(session['id'], 1, payload[4096:5000]).status_code, 400)
+        self.assertEqual(self.put_chunk(session['id'], 3, b'').status_code, 400)
+
+        status = self.client.get(url).data
+        self.assertEqual(status['received_bytes'], 4096)
+        self.assertEqual(status['next_chunk'], 1)
+        self.assertEqual(self.complete(session['id']).status_code, 400)
+
+        self.put_chunk(session['id'], 1, payload[4096:8192])
+        self.put_chunk(session['id'], 2, payload[8192:])
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201)
+        file = File.objects.get(id=response.data['file']['id'])
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+
+    def test_finalize_validates_content(self):
+        """Test that unencrypted content is rejected at finalize"""
+        payload = b'plain text, not encrypted\n' * 100
+        session = self.start_session(payload)
+        for index in range(session['total_chunks']):
+            self.put_chunk(session['id'], index, payload[index * 4096:(index + 1) * 4096])
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('file', response.data['details'])
+        self.assertFalse(File.objects.exists())
+
+    @override_settings(FILE_UPLOAD_SESSION_MAX_SIZE=5000)
+    def test_session_size_limit(self):
+        """Test that sessions over the size limit are refused up front"""
+        response = self.client.post('/api/files/uploads/', {
+            'filename': 'big.bin',
+            'mime_type': 'application/pdf',
+            'original_file_size': 6000,
+            'encryption_iv': 'ab' * 16,
+            'total_size': 6000,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_sessions_are_cleaned_up(self):
+        """Test that expired sessions are refused and removed with their staging file"""
+        from django.core.management import call_command
+        from django.utils import timezone
+        from io import StringIO
+        from .models import UploadSession
+
+        payload = random_payload(9000)
+        session = self.start_session(payload)
+        self.put_chunk(session['id'], 0, payload[:4096])
+        UploadSession.objects.filter(id=session['id']).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.put_chunk(session['id'], 1, payload[4096:8192]).status_code, 410)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('expire_upload_sessions', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'staging')), [])
+
+
+class ParallelUploadTest(UploadSessionTestCase):
+    def test_out_of_order_parts_are_assembled(self):
+        """Test that parts arriving in any order are chained as soon as possible"""
+        payload = random_payload(4096 * 4 + 100)
+        session = self.start_session(payload)
+        chunks = [payload[i:i + 4096] for i in range(0, len(payload), 4096)]
+
+        for index in (3, 1, 4):
+            response = self.put_chunk(session['id'], index, chunks[index])
+            self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['next_chunk'], 0)
+        self.assertEqual(response.data['staged_chunks'], [1, 3, 4])
+
+        response = self.put_chunk(session['id'], 0, chunks[0])
+        self.assertEqual(response.data['next_chunk'], 2)
+        self.assertEqual(response.data['staged_chunks'], [3, 4])
+
+        response = self.put_chunk(session['id'], 2, chunks[2])
+        self.assertTrue(response.data['is_complete'])
+        self.assertEqual(response.data['staged_chunks'], [])
+
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201, response.content)
+        file = File.objects.get(id=response.data['file']['id'])
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+
+    def test_parts_are_committed_one_at_a_time(self):
+        """Test that each assembled part is committed on its own, and retries finish the rest"""
+        from unittest import mock
+        from .models import UploadSession
+
+        payload = random_payload(4096 * 3 + 100)
+        session = self.start_session(payload)
+        chunks = [payload[i:i + 4096] for i in range(0, len(payload), 4096)]
+        for index in (1, 2, 3):
+            self.assertEqual(self.put_chunk(session['id'], index, chunks[index]).status_code, 200)
+
+        append_chunk = UploadSession.append_chunk
+
+        def fail_on_third(instance, index, stream):
+            if index == 2:
+                raise OSError('disk full')
+            return append_chunk(instance, index, stream)
+
+        with mock.patch.object(UploadSession, 'append_chunk', autospec=True, side_effect=fail_on_third), \
+                self.assertLogs('files.views', 'ERROR'):
+            self.assertEqual(self.put_chunk(session['id'], 0, chunks[0]).status_code, 500)
+        upload = UploadSession.objects.get(id=session['id'])
+        self.assertEqual(upload.next_chunk, 2)
+
+        response = self.put_chunk(session['id'], 2, chunks[2])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_complete'])
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201, response.content)
+
+    def test_part_digest_is_verified(self):
+        """Test that a part not matching its Content-Digest is rejected"""
+        import base64
+        import hashlib
+
+        payload = random_payload(5000)
+        session = self.start_session(payload)
+
+        def digest_header(data):
+            return 'sha-256=:' + base64.b64encode(hashlib.sha256(data).digest()).decode() + ':'
+
+        response = self.put_chunk(session['id'], 0, payload[:4096],
+                                  HTTP_CONTENT_DIGEST=digest_header(b'something else'))
+        self.assertEqual(response.status_code, 400)
+        response = self.put_chunk(session['id'], 0, payload[:4096],
+                                  HTTP_CONTENT_DIGEST=digest_header(payload[:4096]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['next_chunk'], 1)
+
+    @override_settings(FILE_UPLOAD_MAX_CONCURRENT_PARTS=2)
+    def test_concurrent_parts_are_capped(self):
+        """Test the per-user cap on parts being received at once"""
+        from unittest import mock
+        from .models import StorageUsage, UploadPart, UploadSession
+
+        payload = random_payload(4096 * 4)
+        session = self.start_session(payload)
+        upload = UploadSession.objects.get(id=session['id'])
+        in_flight = [UploadPart.objects.create(session=upload, index=i) for i in (0, 1)]
+
+        self.assertEqual(self.put_chunk(session['id'], 1, payload[4096:8192]).status_code, 409)
+        # Counted under the lock of the user's row, shared by all of their sessions
+        with mock.patch.object(StorageUsage, 'lock', wraps=StorageUsage.lock) as lock:
+            self.assertEqual(self.put_chunk(session['id'], 2, payload[8192:12288]).status_code, 429)
+        lock.assert_called_once_with(self.user)
+
+        # Abandoned reservations stop counting once they time out
+        UploadPart.objects.filter(id__in=[p.id for p in in_flight]).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(self.put_chunk(session['id'], 2, payload[8192:12288]).status_code, 200)
+        self.assertEqual(self.put_chunk(session['id'], 0, payload[:4096]).status_code, 200)
+
+
+@override_settings(FILE_DIRECT_UPLOAD_WORKERS=0)
+class DirectUploadTest(BlobStoreTestCase):
+    def start_upload(self, payload):
+        response = self.client.post('/api/files/direct-uploads/', {
+            'filename': '../direct.bin',
+            'mime_type': 'application/pdf',
+            'original_file_size': len(payload),
+            'encryption_iv': 'ab' * 16,
+            'total_size': len(payload),
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.data['filename'], 'direct.bin')
+        self.assertEqual(response.data['upload_method'], 'PUT')
+        return response.data
+
+    def put_data(self, url, data):
+        # The upload URL carries its own authorization
+        return APIClient().put(url, data, content_type='application/octet-stream')
+
+    def test_direct_upload_round_trip(self):
+        """Test uploading through the signed receiver URL and completing"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        payload = random_payload(30_000)
+        upload = self.start_upload(payload)
+        self.assertEqual(self.put_data(upload['upload_url'], payload).status_code, 204)
+
+        complete_url = f"/api/files/direct-uploads/{upload['id']}/complete/"
+        response = self.client.post(complete_url)
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(response.data['upload']['status'], 'pending')
+        self.assertIsNone(response.data['upload']['upload_url'])
+        self.assertFalse(File.objects.exists())
+        # Its data can't change once completed, and completing again only reports the status
+        self.assertEqual(self.put_data(upload['upload_url'], payload).status_code, 409)
+        self.assertEqual(self.client.post(complete_url).data['upload']['status'], 'pending')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('finalize_direct_uploads', stdout=StringIO())
+        response = self.client.get(f"/api/files/direct-uploads/{upload['id']}/")
+        self.assertEqual(response.data['status'], 'complete')
+
+        file = File.objects.get(id=response.data['file'])
+        self.assertEqual(file.filename, 'direct.bin')
+        self.assertEqual(file.encryption_iv, bytes.fromhex('ab' * 16))
+        self.assertEqual(file.storage_format, File.FORMAT_SEGMENTED_GCM)
+        self.assertFalse(get_blob_store().exists(f"incoming-{upload['id'].replace('-', '')}"))
+        self.assertNotEqual(file.read_content()[16:1040], payload[:1024])
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+        self.assertDigests(file, payload)
+
+        # Finalized uploads aren't picked up again
+        call_command('finalize_direct_uploads', stdout=StringIO())
+        self.assertEqual(File.objects.count(), 1)
+
+    def test_finalizing_runs_in_the_background(self):
+        """Test that completing queues the encryption pass instead of running it"""
+        from unittest import mock
+        from . import serializers
+        import uuid
+
+        payload = random_payload(30_000)
+        upload = self.start_upload(payload)
+        self.put_data(upload['upload_url'], payload)
+        with override_settings(FILE_DIRECT_UPLOAD_WORKERS=2), \
+                mock.patch.object(serializers._finalize_pool, 'submit') as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/api/files/direct-uploads/{upload['id']}/complete/")
+        self.assertEqual(response.status_code, 202, response.content)
+        submit.assert_called_once_with(serializers.finalize_in_background, uuid.UUID(upload['id']))
+        self.assertFalse(File.objects.exists())
+
+        # A second finalizer can't take it while the first holds the claim
+        file = serializers.finalize_direct_upload(upload['id'])
+        self.assertIsNone(serializers.finalize_direct_upload(upload['id']))
+        self.assertEqual(File.objects.get().id, file.id)
+
+    def test_failed_finalizing_is_reported(self):
+        """Test that an upload that can't be finalized is marked failed and leaves nothing behind"""
+        from django.core.management import call_command
+        from io import StringIO
+        from unittest import mock
+
+        payload = random_payload(30_000)
+        upload = self.start_upload(payload)
+        self.put_data(upload['upload_url'], payload)
+        self.client.post(f"/api/files/direct-uploads/{upload['id']}/complete/")
+
+        with mock.patch.object(File.objects, 'create', side_effect=RuntimeError('disk full')):
+            call_command('finalize_direct_uploads', stdout=StringIO(), stderr=StringIO())
+        response = self.client.get(f"/api/files/direct-uploads/{upload['id']}/")
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(response.data['error'], 'disk full')
+        blobs_dir = os.path.join(self.storage_dir, 'blobs')
+        self.assertEqual(
+            [name for _, _, names in os.walk(blobs_dir) for name in names if not name.startswith('incoming-')],
+            []
+        )
+
+    def test_upload_urls_are_checked(self):
+        """Test that tokens are bound to their upload and uploads are validated"""
+        payload = random_payload(5000)
+        upload = self.start_upload(payload)
+        other = self.start_upload(payload)
+        url = f"/api/files/direct-uploads/{upload['id']}/data/"
+        other_token = other['upload_url'].split('token=')[1]
+
+        self.assertEqual(self.put_data(f'{url}?token=forged', payload).status_code, 403)
+        self.assertEqual(self.put_data(f'{url}?token={other_token}', payload).status_code, 403)
+        self.assertEqual(self.put_data(upload['upload_url'], payload[:100]).status_code, 400)
+        self.assertEqual(self.put_data(upload['upload_url'], payload + b'x').status_code, 400)
+
+        complete_url = f"/api/files/direct-uploads/{upload['id']}/complete/"
+        self.assertEqual(self.client.post(complete_url).status_code, 400)
+
+        with override_settings(FILE_DIRECT_UPLOAD_LIFETIME=timedelta(0)):
+            self.assertEqual(self.put_data(upload['upload_url'], payload).status_code, 403)
+
+        # Someone else's upload can't be completed
+        intruder = User.objects.create_user(email='intruder@test.com', username='intruder', password='testpass123')
+        client = APIClient()
+        client.force_authenticate(intruder)
+        self.assertEqual(self.put_data(upload['upload_url'], payload).status_code, 204)
+        self.assertEqual(client.post(complete_url).status_code, 404)
+        self.assertFalse(File.objects.exists())
+
+
+@override_settings(FILE_UPLOAD_STORAGE='')
+class DatabaseContentTest(UploadSessionTestCase):
+    def stored_blobs(self):
+        blobs_dir = os.path.join(self.storage_dir, 'blobs')
+        return [name for _, _, names in os.walk(blobs_dir) for name in names]
+
+    def test_content_streams_from_database(self):
+        """Test that inline content is written and read in chunks, not as one value"""
+        from .storage import DatabaseBlobReader
+
+        payload = random_payload(50_000)
+        file = self.upload(payload)
+        self.assertEqual(file.storage_backend, '')
+        self.assertEqual(self.stored_blobs(), [])
+        self.assertTrue(file.has_content())
+
+        with file.open_content() as f:
+            self.assertIsInstance(f, DatabaseBlobReader)
+            self.assertEqual(len(f.read(1000)), 1000)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            content = b''.join(response.streaming_content)
+        self.assertEqual(content, payload)
+        # Only its length is ever queried, the value itself is never selected
+        self.assertFalse(any(
+            'encrypted_content' in q['sql'] and 'LENGTH' not in q['sql']
+            for q in queries.captured_queries
+        ))
+
+    def test_other_engines_use_whole_values(self):
+        """Test the fallback for databases without incremental blob I/O"""
+        from unittest import mock
+        import io
+
+        payload = random_payload(10_000)
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            file = self.upload(payload)
+            with file.open_content() as f:
+                self.assertIsInstance(f, io.BytesIO)
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            self.assertEqual(b''.join(response.streaming_content), payload)
+
+        # Values written either way read back the same
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(b''.join(response.streaming_content), payload)
+
+    def test_session_completes_into_database(self):
+        """Test that finalizing an upload session stores content in the row"""
+        payload = random_payload(9000)
+        session = self.start_session(payload)
+        for index in range(session['total_chunks']):
+            self.put_chunk(session['id'], index, payload[index * 4096:(index + 1) * 4096])
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201, response.content)
+
+        file = File.objects.get(id=response.data['file']['id'])
+        self.assertEqual(file.storage_backend, '')
+        self.assertEqual(self.stored_blobs(), [])
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'staging')), [])
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/')), payload)
+
+
+@override_settings(FILE_UPLOAD_STORAGE='', FILE_SERVE_CHUNK_SIZE=4096)
+class DatabaseContentLockTest(BlobStoreMixin, TransactionTestCase):
+    def test_writes_go_ahead_during_downloads(self):
+        """Test that a download streaming from the database doesn't hold a lock between reads"""
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connections
+
+        payload = random_payload(100_000)
+        file = self.upload(payload)
+        self.assertEqual(file.storage_backend, '')
+
+        def write():
+            try:
+                File.objects.filter(pk=file.pk).update(filename='renamed.bin')
+                return self.upload(random_payload(5000), name='other.bin').filename
+            finally:
+                connections.close_all()
+
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        chunks = iter(response.streaming_content)
+        received = next(chunks)
+        with ThreadPoolExecutor(1) as pool:
+            self.assertEqual(pool.submit(write).result(timeout=30), 'other.bin')
+        received += b''.join(chunks)
+        response.close()
+
+        self.assertEqual(received, payload)
+        self.assertEqual(File.objects.get(pk=file.pk).filename, 'renamed.bin')
+
+
+class SizeTierTest(UploadSessionTestCase):
+    def setUp(self):
+        super().setUp()
+        threshold_override = override_settings(FILE_INLINE_THRESHOLD=8192)
+        threshold_override.enable()
+        self.addCleanup(threshold_override.disable)
+
+    def test_upload_tier_follows_size(self):
+        """Test that small uploads stay inline and larger ones go to the blob store"""
+        small_payload, large_payload = random_payload(3000), random_payload(20_000)
+        small, large = self.upload(small_payload), self.upload(large_payload)
+
+        self.assertEqual(small.storage_backend, '')
+        self.assertTrue(small.has_content())
+        self.assertFalse(get_blob_store().exists(small.encrypted_filename))
+        self.assertEqual(large.storage_backend, 'default')
+        self.assertTrue(get_blob_store().exists(large.encrypted_filename))
+
+        for file, payload in ((small, small_payload), (large, large_payload)):
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            self.assertEqual(b''.join(response.streaming_content), payload)
+            self.assertDigests(file, payload)
+
+    def test_inline_content_comes_with_the_row(self):
+        """Test that small inline content is served without querying for it again"""
+        payload = random_payload(3000)
+        file = self.upload(payload)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/files/{file.id}/content/')
+            self.assertEqual(b''.join(response.streaming_content), payload)
+        content_queries = [q['sql'] for q in queries.captured_queries if 'encrypted_content' in q['sql']]
+        self.assertEqual(len(content_queries), 1)
+        self.assertIn(f'= {file.id}', content_queries[0])
+
+        # Above the threshold it stays deferred, even when it is inline
+        with override_settings(FILE_INLINE_THRESHOLD=1000):
+            file = File.objects.with_inline_content().get(id=file.id)
+        self.assertIsNone(file.inline_content)
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/').streaming_content), payload)
+
+    def test_tier_boundary(self):
+        """Test that content of exactly the threshold size goes to the blob store"""
+        from .storage import TieredBlobWriter
+
+        for size, storage_backend in ((8191, ''), (8192, 'default')):
+            writer = TieredBlobWriter(f'boundary-{size}')
+            for offset in range(0, size, 1000):
+                writer.write(b'x' * min(1000, size - offset))
+            writer.commit()
+            self.assertEqual(writer.storage_backend, storage_backend)
+            if storage_backend:
+                self.assertIsNone(writer.file)
+                self.assertEqual(get_blob_store().size(f'boundary-{size}'), size)
+            else:
+                self.assertEqual(len(writer.file.read()), size)
+                writer.abort()
+
+    def test_session_upload_tier_follows_size(self):
+        """Test that a completed session goes inline when it is small"""
+        payload = random_payload(3000)
+        session = self.start_session(payload)
+        self.assertEqual(self.put_chunk(session['id'], 0, payload).status_code, 200)
+        response = self.complete(session['id'])
+        self.assertEqual(response.status_code, 201, response.content)
+
+        file = File.objects.get(id=response.data['file']['id'])
+        self.assertEqual(file.storage_backend, '')
+        self.assertEqual(b''.join(self.client.get(f'/api/files/{file.id}/content/').streaming_content), payload)
+
+
+class TrashTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        from shares.models import SharePermission
+
+        self.payload = random_payload(5000)
+        self.file = self.upload(self.payload)
+        self.shares = [
+            SharePermission.objects.create(file=self.file, shared_by=self.user, is_download_enabled=True)
+            for _ in range(5)
+        ]
+        self.share_url = f'/api/shares/shares/share/{self.shares[0].share_link_token}/download/'
+
+    def test_deleted_files_are_hidden_until_restored(self):
+        """Test that deleting only marks the file, which can then be restored"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(f'/api/files/{self.file.id}/')
+        self.assertEqual(response.status_code, 204)
+        # Nothing is deleted or cascaded during the request
+        self.assertFalse(any(q['sql'].startswith('DELETE') for q in queries.captured_queries))
+
+        self.assertEqual(self.client.get('/api/files/').data, [])
+        self.assertEqual(self.client.get(f'/api/files/{self.file.id}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/files/{self.file.id}/content/').status_code, 404)
+        self.assertEqual(APIClient().get(self.share_url).status_code, 404)
+        self.assertEqual(self.client.delete(f'/api/files/{self.file.id}/').status_code, 404)
+
+        # Relations still reach it, and the content is still stored
+        self.shares[0].refresh_from_db()
+        self.assertTrue(self.shares[0].file.is_trashed)
+        self.assertTrue(self.file.has_content())
+
+        trash = self.client.get('/api/files/trash/').data
+        self.assertEqual([f['id'] for f in trash], [self.file.id])
+        self.assertEqual(trash[0]['restore_url'], f'/api/files/{self.file.id}/restore/')
+
+        response = self.client.post(f'/api/files/{self.file.id}/restore/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/files/trash/').data, [])
+        self.assertEqual(b''.join(APIClient().get(self.share_url).streaming_content), self.payload)
+
+    def test_expired_trash_is_reclaimed(self):
+        """Test that files past the retention window are purged with their shares and content"""
+        from django.core.management import call_command
+        from shares.models import SharePermission
+        from io import StringIO
+
+        kept = self.upload(random_payload(1000), name='kept.bin')
+        self.file.trash()
+        with override_settings(FILE_TRASH_RETENTION=timedelta(0)):
+            self.assertEqual(self.client.post(f'/api/files/{self.file.id}/restore/').status_code, 404)
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('reclaim_trash', batch_size=1, stdout=StringIO())
+
+        self.assertFalse(File.all_objects.filter(id=self.file.id).exists())
+        self.assertFalse(SharePermission.objects.exists())
+        self.assertFalse(get_blob_store().exists(self.file.encrypted_filename))
+        self.assertTrue(kept.has_content())
+
+
+class FileArchiveTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payloads = [random_payload(300_000), random_payload(5000)]
+        self.files = [self.upload(payload) for payload in self.payloads]
+
+    def download(self, ids):
+        response = self.client.post('/api/files/archive/', {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        pieces = list(response.streaming_content)
+        return pieces, zipfile.ZipFile(io.BytesIO(b''.join(pieces)))
+
+    def test_archive_streams_members_and_manifest(self):
+        """Test that the archive holds every file once, in order, with a manifest of their IVs"""
+        with override_settings(FILE_INLINE_THRESHOLD=2 ** 20):
+            inline = self.upload(self.payloads[1], name='inline.bin')
+        ids = [self.files[1].id, self.files[0].id, inline.id, self.files[1].id]
+        with override_settings(FILE_SERVE_CHUNK_SIZE=4096):
+            pieces, archive = self.download(ids)
+
+        self.assertEqual(archive.namelist(), ['secret.bin', 'secret (2).bin', 'inline.bin', 'manifest.json'])
+        self.assertEqual(archive.read('secret.bin'), self.payloads[1])
+        self.assertEqual(archive.read('secret (2).bin'), self.payloads[0])
+        self.assertEqual(archive.read('inline.bin'), self.payloads[1])
+        for member in archive.infolist():
+            self.assertEqual(member.compress_type, zipfile.ZIP_STORED)
+
+        manifest = json.loads(archive.read('manifest.json'))['files']
+        self.assertEqual([entry['id'] for entry in manifest], ids[:3])
+        self.assertEqual([entry['name'] for entry in manifest], archive.namelist()[:3])
+        self.assertEqual(manifest[1]['encryption_iv'], '0' * 32)
+        self.assertEqual(manifest[1]['size'], len(self.payloads[0]))
+        self.assertEqual(manifest[1]['content_sha256'], hashlib.sha256(self.payloads[0]).hexdigest())
+
+        # The large member went out a segment at a time rather than whole
+        self.assertLess(max(len(piece) for piece in pieces), len(self.payloads[0]) // 4)
+
+    def test_large_archives_use_zip64(self):
+        """Test that members and archives past the ZIP limits get ZIP64 records"""
+        from unittest import mock
+
+        with mock.patch('zipfile.ZIP64_LIMIT', 1000):
+            pieces, _ = self.download([file.id for file in self.files])
+        data = b''.join(pieces)
+        self.assertIn(b'PK\x06\x06', data)  # ZIP64 end of central directory
+
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(archive.read('secret.bin'), self.payloads[0])
+        self.assertEqual(archive.read('secret (2).bin'), self.payloads[1])
+
+    def test_unreadable_files_are_listed_with_an_error(self):
+        """Test that a file whose content is missing is left out but still in the manifest"""
+        get_blob_store().delete(self.files[0].encrypted_filename)
+        with self.assertLogs('files.serving', 'ERROR'):
+            _, archive = self.download([file.id for file in self.files])
+
+        self.assertEqual(archive.namelist(), ['secret.bin', 'manifest.json'])
+        self.assertEqual(archive.read('secret.bin'), self.payloads[1])
+        manifest = json.loads(archive.read('manifest.json'))['files']
+        self.assertIsNone(manifest[0]['name'])
+        self.assertIn('error', manifest[0])
+        self.assertNotIn('error', manifest[1])
+
+    def test_only_own_live_files(self):
+        """Test that requests naming files the user can't download are rejected before streaming"""
+        other = User.objects.create_user(email='other@test.com', username='other', password='testpass123')
+        others_file = File.objects.create(user=other, filename='theirs.bin')
+        self.files[1].trash()
+
+        url = '/api/files/archive/'
+        response = self.client.post(url, {'ids': [self.files[0].id, self.files[1].id, others_file.id, 999]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['details']['ids'], [self.files[1].id, others_file.id, 999])
+
+        self.assertEqual(self.client.post(url, {'ids': []}, format='json').status_code, 400)
+        with override_settings(FILE_ARCHIVE_MAX_FILES=1):
+            response = self.client.post(url, {'ids': [self.files[0].id, others_file.id]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ids', response.data['details'])
+        self.assertIn(APIClient().post(url, {'ids': [self.files[0].id]}, format='json').status_code, (401, 403))
+
+
+class ContentCacheTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        cache_override = override_settings(FILE_CONTENT_CACHE_SIZE=64 * 1024, FILE_CONTENT_CACHE_MAX_ENTRY_SIZE=16 * 1024)
+        cache_override.enable()
+        self.addCleanup(cache_override.disable)
+
+    def download(self, file):
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_admission_keeps_popular_entries(self):
+        """Test that one-off entries can't push out frequently read ones"""
+        from .content_cache import ContentCache
+
+        cache = ContentCache(max_bytes=1000, max_entry_size=600, ttl=60)
+        for _ in range(5):
+            cache.get('hot', 'v1')
+        self.assertTrue(cache.put('hot', 'v1', b'h' * 600))
+
+        # Only room for it by evicting the hot entry, which is asked for more often
+        cache.get('cold', 'v1')
+        self.assertFalse(cache.put('cold', 'v1', b'c' * 600))
+        self.assertEqual(cache.get('hot', 'v1'), b'h' * 600)
+        self.assertIsNone(cache.get('hot', 'v2'))  # Other version
+        self.assertIsNone(cache.get('hot', 'v1'))  # Dropped along with it
+
+        # Larger than max_entry_size is never cached
+        self.assertFalse(cache.put('big', 'v1', b'b' * 601))
+        self.assertTrue(cache.put('small', 'v1', b's' * 400))
+        cache.invalidate('small')
+        self.assertIsNone(cache.get('small', 'v1'))
+
+        info = cache.info()
+        self.assertEqual((info['hits'], info['rejections'], info['invalidations']), (1, 2, 1))
+        self.assertEqual((info['entries'], info['bytes']), (0, 0))
+
+    def test_entries_expire(self):
+        """Test that entries are not served past their TTL and make room for others"""
+        from .content_cache import ContentCache
+
+        cache = ContentCache(max_bytes=1000, max_entry_size=1000, ttl=0)
+        for _ in range(5):
+            cache.get('stale', 'v1')
+        self.assertTrue(cache.put('stale', 'v1', b's' * 800))
+        self.assertTrue(cache.put('fresh', 'v1', b'f' * 800))
+        self.assertEqual(cache.info()['evictions'], 1)
+        self.assertIsNone(cache.get('fresh', 'v1'))
+        self.assertEqual(cache.info()['expirations'], 1)
+
+    def test_repeat_downloads_skip_storage(self):
+        """Test that small files are served from the cache until they are trashed"""
+        from unittest import mock
+
+        payload = random_payload(5000)
+        file = self.upload(payload)
+        self.assertEqual(self.download(file), payload)
+        with mock.patch.object(LocalBlobStore, 'open', side_effect=AssertionError('read from storage')):
+            self.assertEqual(self.download(file), payload)
+            response = self.client.get(f'/api/files/{file.id}/content/', HTTP_RANGE='bytes=100-199')
+            self.assertEqual(b''.join(response.streaming_content), payload[100:200])
+
+        # Too large for an entry, streamed from storage every time
+        large_payload = random_payload(20_000)
+        large = self.upload(large_payload)
+        for _ in range(2):
+            self.assertEqual(self.download(large), large_payload)
+
+        self.assertEqual(self.client.delete(f'/api/files/{file.id}/').status_code, 204)
+        self.assertEqual(self.client.get(f'/api/files/{file.id}/content/').status_code, 404)
+
+        from .content_cache import get_content_cache
+        info = get_content_cache().info()
+        self.assertEqual((info['hits'], info['admissions'], info['invalidations']), (2, 1, 1))
+        self.assertEqual(info['entries'], 0)
+
+    def test_stats_are_for_staff_only(self):
+        """Test that the cache counters are only shown to staff"""
+        self.assertEqual(self.client.get('/api/files/cache-stats/').status_code, 403)
+
+        from .content_cache import get_content_flights
+
+        self.user.is_staff = True
+        self.user.save()
+        led = get_content_flights().info()['led']
+        self.download(self.upload(random_payload(5000)))
+        response = self.client.get('/api/files/cache-stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['enabled'])
+        self.assertEqual((response.data['misses'], response.data['entries']), (1, 1))
+
+        self.assertEqual(response.data['coalescing']['led'], led + 1)
+
+        with override_settings(FILE_CONTENT_CACHE_SIZE=0):
+            self.assertFalse(self.client.get('/api/files/cache-stats/').data['enabled'])
+
+
+class ReadCoalescingTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        import threading
+        self.release = threading.Event()
+
+    def gate(self):
+        """Called by a shared computation, holds it until all callers are waiting for it"""
+        self.release.wait(5)
+
+    def run_concurrently(self, flights, call, callers):
+        """Run call() from `callers` threads, and open the gate once all but one wait for a flight"""
+        from concurrent.futures import ThreadPoolExecutor
+        import time
+
+        shared = flights.stats['shared']
+
+        def run():
+            try:
+                return call(), None
+            except BaseException as e:
+                return None, e
+
+        with ThreadPoolExecutor(callers) as pool:
+            results = [pool.submit(run) for _ in range(callers)]
+            deadline = time.monotonic() + 5
+            while flights.stats['shared'] < shared + callers - 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.release.set()
+            results = [result.result() for result in results]
+        self.release.clear()
+        return results
+
+    def test_subscribers_share_one_read(self):
+        """Test that subscribers of a key share one pass over its chunks, and others don't"""
+        from .content_cache import ContentFlights
+
+        flights = ContentFlights(buffer_size=1024, timeout=5)
+        reads, closed = [], []
+
+        def chunks():
+            for i in range(5):
+                reads.append(i)
+                yield bytes([i]) * 100
+
+        stream, leader, leading = flights.join('a')
+        self.assertTrue(leading)
+        followers = [flights.join('a') for _ in range(3)]
+        self.assertEqual([(joined, is_leader) for joined, _, is_leader in followers], [(stream, False)] * 3)
+        other_stream, other, leading = flights.join('b')
+        self.assertTrue(leading)
+        other.close()
+
+        stream.announce(500)
+        stream.start(chunks(), lambda: closed.append(1))
+        subscribers = [leader] + [subscriber for _, subscriber, _ in followers]
+        self.assertEqual([next(subscriber) for subscriber in subscribers], [b'\x00' * 100] * 4)
+
+        # Everyone is past the first chunk, so the next reader of the key leads again
+        _, late, leading = flights.join('a')
+        self.assertTrue(leading)
+        late.close()
+
+        expected = b''.join(bytes([i]) * 100 for i in range(1, 5))
+        self.assertEqual([b''.join(subscriber) for subscriber in subscribers], [expected] * 4)
+        self.assertEqual(reads, [0, 1, 2, 3, 4])
+        self.assertEqual(stream.wait_length(), 500)
+        for subscriber in subscribers:
+            subscriber.close()
+        self.assertEqual(closed, [1])
+        self.assertEqual(flights.info(), {'led': 3, 'shared': 3, 'fell_behind': 0, 'in_flight': 0})
+
+    def test_slow_subscribers_fall_behind(self):
+        """Test that the buffer stays bounded, and subscribers it no longer serves are told so"""
+        from .content_cache import ContentFlights, FellBehind
+
+        flights = ContentFlights(buffer_size=250, timeout=5)
+        stream, fast, _ = flights.join('a')
+        _, slow, _ = flights.join('a')
+        stream.announce(1000)
+        stream.start((bytes([i]) * 100 for i in range(10)), lambda: None)
+
+        self.assertEqual(next(slow), b'\x00' * 100)
+        self.assertEqual(len(b''.join(fast)), 1000)
+        self.assertLessEqual(stream._size, 250)
+        with self.assertRaises(FellBehind):
+            next(slow)
+        self.assertEqual(slow.offset, 100)
+        fast.close()
+        self.assertEqual(flights.info(), {'led': 1, 'shared': 1, 'fell_behind': 1, 'in_flight': 0})
+
+    def test_errors_and_interruptions(self):
+        """Test that subscribers get read errors, but read on their own after interruptions and timeouts"""
+        from .content_cache import ContentFlights, FellBehind
+
+        class Cancelled(BaseException):
+            pass
+
+        def failing(error):
+            yield b'first'
+            raise error
+
+        flights = ContentFlights(buffer_size=1024, timeout=5)
+        stream, leader, _ = flights.join('a')
+        _, follower, _ = flights.join('a')
+        stream.announce(10)
+        stream.start(failing(ValueError('unreadable')), lambda: None)
+        self.assertEqual(next(leader), b'first')
+        self.assertRaises(ValueError, next, leader)
+        self.assertEqual(next(follower), b'first')
+        self.assertRaises(ValueError, next, follower)
+
+        stream, leader, _ = flights.join('b')
+        _, follower, _ = flights.join('b')
+        stream.announce(10)
+        stream.start(failing(Cancelled()), lambda: None)
+        self.assertEqual(next(leader), b'first')
+        self.assertRaises(Cancelled, next, leader)
+        self.assertEqual(next(follower), b'first')
+        self.assertRaises(FellBehind, next, follower)
+
+        # A leader that can't open the content fails its followers
+        stream, leader, _ = flights.join('c')
+        _, follower, _ = flights.join('c')
+        stream.fail(ValueError('missing'))
+        self.assertRaises(ValueError, stream.wait_length)
+        self.assertTrue(flights.join('c')[2])
+
+        # Followers stop waiting for a leader that is stuck
+        flights = ContentFlights(buffer_size=1024, timeout=0.05)
+        stream, leader, _ = flights.join('a')
+        _, follower, _ = flights.join('a')
+        self.assertRaises(FellBehind, stream.wait_length)
+        stream.announce(10)
+        self.assertRaises(FellBehind, next, follower)
+        leader.close()
+        self.assertEqual(flights.info(), {'led': 1, 'shared': 1, 'fell_behind': 1, 'in_flight': 0})
+
+    def read(self, file, chunk_size=4096):
+        from .serving import open_served_content
+
+        content, source = open_served_content(file)
+        reader, chunks = content.chunks(chunk_size)
+        try:
+            return b''.join(chunks)
+        finally:
+            reader.close()
+
+    def test_concurrent_downloads_read_once(self):
+        """Test that concurrent downloads of a file read and decrypt it once, with the cache off"""
+        from unittest import mock
+        from .content_cache import ContentFlights, get_content_cache
+
+        payload = random_payload(200_000)
+        file = self.upload(payload)
+        flights = ContentFlights(buffer_size=2 ** 20, timeout=5)
+        open_content = File.open_content
+
+        self.assertIsNone(get_content_cache())
+        with mock.patch('files.serving.get_content_flights', return_value=flights), \
+                mock.patch.object(File, 'open_content', autospec=True,
+                                  side_effect=lambda instance: self.gate() or open_content(instance)) as opened, \
+                mock.patch.object(File, 'get_file_key', autospec=True, side_effect=File.get_file_key) as get_file_key:
+            results = self.run_concurrently(flights, lambda: self.read(file), 4)
+        self.assertEqual(results, [(payload, None)] * 4)
+        self.assertEqual((opened.call_count, get_file_key.call_count), (1, 1))
+        self.assertEqual(flights.info(), {'led': 1, 'shared': 3, 'fell_behind': 0, 'in_flight': 0})
+
+        # With the cache on, small content is also kept for later downloads
+        with override_settings(FILE_CONTENT_CACHE_SIZE=2 ** 20), \
+                mock.patch('files.serving.get_content_flights', return_value=flights):
+            small_payload = random_payload(5000)
+            small = self.upload(small_payload)
+            self.assertEqual(self.read(small), small_payload)
+            self.assertEqual(get_content_cache().info()['admissions'], 1)
+
+    def test_followers_read_on_their_own(self):
+        """Test that downloads behind the buffer, or of a range, read the content themselves"""
+        from unittest import mock
+        from .serving import open_served_content
+
+        payload = random_payload(200_000)
+        file = self.upload(payload)
+
+        with override_settings(FILE_COALESCE_BUFFER_SIZE=64 * 1024), \
+                mock.patch.object(File, 'get_file_key', autospec=True, side_effect=File.get_file_key) as get_file_key:
+            from .content_cache import get_content_flights
+
+            # Behind by more than the buffer, the follower continues from where it is
+            leader, _ = open_served_content(file)
+            follower, _ = open_served_content(file)
+            leader_reader, leader_chunks = leader.chunks(4096)
+            follower_reader, follower_chunks = follower.chunks(4096)
+            first = next(follower_chunks)
+            self.assertEqual(b''.join(leader_chunks), payload)
+            self.assertEqual(first + b''.join(follower_chunks), payload)
+            leader_reader.close()
+            follower_reader.close()
+            self.assertEqual(get_file_key.call_count, 2)
+            self.assertEqual(get_content_flights().info()['fell_behind'], 1)
+
+            # A range is read on its own, by the leader or a follower
+            leader, _ = open_served_content(file)
+            follower, _ = open_served_content(file)
+            reader, chunks = follower.range_chunks(100, 199, 4096)
+            self.assertEqual(b''.join(chunks), payload[100:200])
+            reader.close()
+            reader, chunks = leader.range_chunks(1000, 2999, 4096)
+            self.assertEqual(b''.join(chunks), payload[1000:3000])
+            reader.close()
+
+            leader, _ = open_served_content(file)
+            follower, _ = open_served_content(file)
+            reader, chunks = leader.range_chunks(1000, 2999, 4096)
+            self.assertEqual(b''.join(chunks), payload[1000:3000])
+            reader.close()
+            self.assertEqual(self.read_chunks(follower), payload)
+            self.assertEqual(get_content_flights().info()['in_flight'], 0)
+
+    def read_chunks(self, content):
+        reader, chunks = content.chunks(4096)
+        try:
+            return b''.join(chunks)
+        finally:
+            reader.close()
+
+
+class UploadIdempotencyTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payload = random_payload(5000)
+
+    def stored_blobs(self):
+        blobs_dir = os.path.join(self.storage_dir, 'blobs')
+        return [name for _, _, names in os.walk(blobs_dir) for name in names]
+
+    def post(self, payload, key='upload-1', digest_of=None):
+        digest = base64.b64encode(hashlib.sha256(digest_of or payload).digest()).decode()
+        return self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('secret.bin', payload),
+            'encryption_iv': '0' * 32,
+            'original_file_size': len(payload),
+            'mime_type': 'application/pdf',
+        }, format='multipart', HTTP_IDEMPOTENCY_KEY=key, HTTP_REPR_DIGEST=f'sha-256=:{digest}:')
+
+    def test_retry_returns_original_file(self):
+        """Test that a retried upload gets the first file back without storing a copy"""
+        first = self.post(self.payload)
+        self.assertEqual(first.status_code, 201, first.content)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        # The body of a replay isn't read, so even a broken one gets the original back
+        retry = self.post(b'not the file', digest_of=self.payload)
+        self.assertEqual(retry.status_code, 201, retry.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['file']['id'], first.data['file']['id'])
+        self.assertEqual(File.objects.count(), 1)
+        self.assertEqual(len(self.stored_blobs()), 1)
+
+        other = self.post(self.payload, key='upload-2')
+        self.assertEqual(other.status_code, 201)
+        self.assertNotEqual(other.data['file']['id'], first.data['file']['id'])
+
+    def test_key_reused_for_other_content(self):
+        """Test that a key can't be reused for a different file"""
+        self.assertEqual(self.post(self.payload).status_code, 201)
+        response = self.post(random_payload(5000))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(File.objects.count(), 1)
+
+    def test_concurrent_duplicate_is_turned_away(self):
+        """Test that a duplicate of an upload still in progress is rejected until the claim is abandoned"""
+        UploadIdempotencyKey.objects.create(
+            user=self.user, key='upload-1', content_sha256=hashlib.sha256(self.payload).digest()
+        )
+        response = self.post(self.payload)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(File.objects.exists())
+
+        UploadIdempotencyKey.objects.update(claimed_at=timezone.now() - timedelta(hours=1))
+        response = self.post(self.payload)
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(UploadIdempotencyKey.objects.get().file_id, response.data['file']['id'])
+
+    def test_digest_is_required_and_checked(self):
+        """Test that a key needs a matching Repr-Digest, and a failed upload can be retried"""
+        response = self.client.post('/api/files/upload/', {
+            'file': SimpleUploadedFile('secret.bin', self.payload),
+            'encryption_iv': '0' * 32,
+            'original_file_size': len(self.payload),
+            'mime_type': 'application/pdf',
+        }, format='multipart', HTTP_IDEMPOTENCY_KEY='upload-1')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post(random_payload(5000), digest_of=self.payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(File.objects.exists())
+        self.assertEqual(self.stored_blobs(), [])
+
+        self.assertEqual(self.post(self.payload).status_code, 201)
+
+    def test_failed_upload_is_discarded(self):
+        """Test that stored content is removed when an upload fails unexpectedly, before or after its row is written"""
+        from unittest import mock
+        from .key_management import KeyManagement
+
+        save = UploadIdempotencyKey.save
+
+        def failing_save(instance, *args, **kwargs):
+            if kwargs.get('update_fields') == ['file']:
+                raise RuntimeError('database went away')
+            return save(instance, *args, **kwargs)
+
+        failures = (
+            mock.patch.object(KeyManagement, 'encrypt_file_key', side_effect=RuntimeError('master key missing')),
+            mock.patch.object(UploadIdempotencyKey, 'save', autospec=True, side_effect=failing_save),
+        )
+        for failure in failures:
+            with failure, self.assertLogs('files.views', 'ERROR'):
+                response = self.post(self.payload)
+            self.assertEqual(response.status_code, 500)
+            self.assertFalse(File.objects.exists())
+            self.assertEqual(self.stored_blobs(), [])
+
+        # The key was released, so the upload can be retried
+        self.assertEqual(self.post(self.payload).status_code, 201)
+        self.assertEqual(len(self.stored_blobs()), 1)
+
+
+class StorageUsageTest(UploadSessionTestCase):
+    def usage(self):
+        response = self.client.get('/api/files/usage/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_counters_follow_files(self):
+        """Test that usage is counted as files are created and purged, without summing over them"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        first = self.upload(random_payload(3000))
+        session = self.start_session(random_payload(5000))
+        self.assertEqual(self.put_chunk(session['id'], 0, random_payload(4096)).status_code, 200)
+        self.assertEqual(self.put_chunk(session['id'], 1, random_payload(904)).status_code, 200)
+        self.assertEqual(self.complete(session['id']).status_code, 201)
+
+        with CaptureQueriesContext(connection) as queries:
+            usage = self.usage()
+        self.assertEqual((usage['bytes_used'], usage['file_count']), (8000, 2))
+        self.assertEqual((usage['quota_bytes'], usage['quota_files']), (None, None))
+        self.assertFalse(any('SUM(' in q['sql'] for q in queries.captured_queries))
+
+        # Trashed files still take up storage until they are purged
+        first.trash()
+        self.assertEqual(self.usage()['file_count'], 2)
+        with override_settings(FILE_TRASH_RETENTION=timedelta(0)), self.captureOnCommitCallbacks(execute=True):
+            call_command('reclaim_trash', stdout=StringIO())
+        usage = self.usage()
+        self.assertEqual((usage['bytes_used'], usage['file_count']), (5000, 1))
+
+    def test_quota_is_enforced_before_the_body(self):
+        """Test that uploads past the quota are refused up front on every upload path"""
+        from unittest import mock
+        from .models import StorageUsage
+        from .upload_handlers import EncryptingUploadHandler
+
+        self.upload(random_payload(6000))
+        with override_settings(FILE_QUOTA_BYTES=10_000):
+            with mock.patch.object(EncryptingUploadHandler, 'receive_data_chunk',
+                                   side_effect=AssertionError('body read')):
+                response = self.client.post('/api/files/upload/', {
+                    'file': SimpleUploadedFile('big.bin', random_payload(5000)),
+                    'encryption_iv': '0' * 32,
+                    'original_file_size': 5000,
+                    'mime_type': 'application/pdf',
+                }, format='multipart')
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('Storage quota exceeded', response.data['error'])
+
+            for url in ('/api/files/uploads/', '/api/files/direct-uploads/'):
+                response = self.client.post(url, {
+                    'filename': 'big.bin',
+                    'mime_type': 'application/pdf',
+                    'original_file_size': 5000,
+                    'encryption_iv': 'ab' * 16,
+                    'total_size': 5000,
+                }, format='json')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('total_size', response.data)
+
+            # Uploads that fit still go through, and a per-user quota overrides the setting
+            self.upload(random_payload(3000))
+            StorageUsage.objects.filter(user=self.user).update(quota_bytes=20_000)
+            self.upload(random_payload(5000))
+            self.assertEqual(self.usage()['quota_bytes'], 20_000)
+
+        with override_settings(FILE_QUOTA_FILES=3):
+            response = self.client.post('/api/files/uploads/', {
+                'filename': 'small.bin',
+                'mime_type': 'application/pdf',
+                'original_file_size': 10,
+                'encryption_iv': 'ab' * 16,
+                'total_size': 10,
+            }, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('File quota exceeded', str(response.data['total_size']))
+        self.assertEqual(self.usage()['file_count'], 3)
+
+    def test_quota_is_checked_once_the_size_is_known(self):
+        """Test that uploads without a length are refused, and received files are checked again"""
+        from .serializers import FileUploadSerializer
+
+        data = {
+            'file': SimpleUploadedFile('big.bin', random_payload(5000)),
+            'encryption_iv': '0' * 32,
+            'original_file_size': 0,
+            'mime_type': 'application/pdf',
+        }
+        with override_settings(FILE_QUOTA_BYTES=4000):
+            response = self.client.post('/api/files/upload/', data, format='multipart', CONTENT_LENGTH='')
+            self.assertEqual(response.status_code, 411)
+
+            # What a request with a Content-Length too small for its body would get to
+            data['file'].seek(0)
+            request = APIRequestFactory().post('/')
+            request.user = self.user
+            serializer = FileUploadSerializer(data=data, context={'request': request})
+            self.assertFalse(serializer.is_valid())
+            self.assertIn('Storage quota exceeded', str(serializer.errors['file']))
+
+        # Without a quota the length isn't needed
+        data['file'].seek(0)
+        response = self.client.post('/api/files/upload/', data, format='multipart', CONTENT_LENGTH='')
+        self.assertNotEqual(response.status_code, 411)
+        self.assertFalse(File.objects.exists())
+
+    def test_quota_is_checked_again_on_completion(self):
+        """Test that sessions started in parallel can't together exceed the quota"""
+        with override_settings(FILE_QUOTA_BYTES=6000):
+            payloads = [random_payload(4000), random_payload(4000)]
+            sessions = [self.start_session(payload) for payload in payloads]
+            for session, payload in zip(sessions, payloads):
+                self.assertEqual(self.put_chunk(session['id'], 0, payload).status_code, 200)
+            self.assertEqual(self.complete(sessions[0]['id']).status_code, 201)
+            response = self.complete(sessions[1]['id'])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Storage quota exceeded', str(response.data['details']['file']))
+        self.assertEqual(self.usage()['bytes_used'], 4000)
+
+    def test_received_sizes_are_counted(self):
+        """Test that files count the bytes received, whatever original_file_size they declare"""
+        from .models import UploadSession
+
+        def upload_declaring_nothing(payload):
+            return self.client.post('/api/files/upload/', {
+                'file': SimpleUploadedFile('small.bin', payload),
+                'encryption_iv': '0' * 32,
+                'original_file_size': 0,
+                'mime_type': 'application/pdf',
+            }, format='multipart')
+
+        with override_settings(FILE_QUOTA_BYTES=10_000):
+            self.assertEqual(upload_declaring_nothing(random_payload(4000)).status_code, 201)
+            session = self.start_session(random_payload(3000))
+            UploadSession.objects.filter(id=session['id']).update(original_file_size=0)
+            self.assertEqual(self.put_chunk(session['id'], 0, random_payload(3000)).status_code, 200)
+            self.assertEqual(self.complete(session['id']).status_code, 201)
+            self.assertEqual(self.usage()['bytes_used'], 7000)
+
+            self.assertEqual(upload_declaring_nothing(random_payload(4000)).status_code, 413)
+        self.assertEqual(self.usage()['file_count'], 2)
+
+    def test_reconcile_rebuilds_counters(self):
+        """Test that the reconcile command recounts drifted and missing counters in batches"""
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import StorageUsage
+
+        self.upload(random_payload(3000))
+        self.upload(random_payload(2000))
+        other = User.objects.create_user(email='other@test.com', username='other', password='testpass123')
+        StorageUsage.objects.filter(user=self.user).update(bytes_used=1, file_count=7)
+
+        out = StringIO()
+        call_command('reconcile_usage', batch_size=1, stdout=out)
+        self.assertIn('Checked 2 users, 1 corrected', out.getvalue())
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.file_count), (5000, 2))
+        usage = StorageUsage.objects.get(user=other)
+        self.assertEqual((usage.bytes_used, usage.file_count), (0, 0))
+
+
+class ClearStorageTest(BlobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        from shares.models import SharePermission
+
+        self.other = User.objects.create_user(email='other@test.com', username='other', password='testpass123')
+        self.files = [self.upload(random_payload(2000), name=f'{i}.bin') for i in range(3)]
+        with override_settings(FILE_UPLOAD_STORAGE=''):
+            self.files.append(self.upload(random_payload(2000), name='inline.bin'))
+        self.files[0].trash()
+        for file in self.files:
+            SharePermission.objects.create(file=file, shared_by=self.user, shared_with=self.other)
+
+        UploadIdempotencyKey.objects.create(
+            user=self.user, key='retry', content_sha256=bytes(self.files[1].content_sha256), file=self.files[1]
+        )
+
+        self.client.force_authenticate(self.other)
+        self.other_file = self.upload(random_payload(2000), name='other.bin')
+
+    def clear_storage(self, **options):
+        from django.core.management import call_command
+        from io import StringIO
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('clear_storage', stdout=out, **options)
+        return out.getvalue()
+
+    def test_dry_run_only_counts(self):
+        """Test that a dry run reports counts without deleting anything"""
+        output = self.clear_storage(dry_run=True, user='owner@test.com')
+        self.assertIn('4 share permissions', output)
+        self.assertIn('4 files', output)
+        self.assertIn('1 users', output)
+        self.assertEqual(File.all_objects.count(), 5)
+
+    def test_bulk_purge_per_user(self):
+        """Test batched purging of one user, then of everything"""
+        from shares.models import SharePermission
+
+        with CaptureQueriesContext(connection) as queries:
+            output = self.clear_storage(bulk=True, batch_size=2, user='owner@test.com')
+        self.assertIn('✓ Removed 4 files', output)
+        self.assertIn('files: 4/4', output)
+        # Content is never loaded, and rows go in batches rather than one by one
+        self.assertFalse(any(
+            'encrypted_content' in q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')
+        ))
+        self.assertEqual(sum(q['sql'].startswith('DELETE FROM "files_file"') for q in queries.captured_queries), 2)
+
+        self.assertFalse(User.objects.filter(email='owner@test.com').exists())
+        self.assertFalse(SharePermission.objects.exists())
+        self.assertEqual(list(File.all_objects.all()), [self.other_file])
+        for file in self.files[:3]:
+            self.assertFalse(get_blob_store().exists(file.encrypted_filename))
+        self.assertTrue(self.other_file.has_content())
+
+        self.clear_storage(bulk=True)
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(File.all_objects.exists())
+        self.assertFalse(get_blob_store().exists(self.other_file.encrypted_filename))
+
+
+class ScrubContentTest(BlobStoreMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payloads = [random_payload(6000) for _ in range(4)]
+        self.files = [self.upload(payload, name=f'{i}.bin') for i, payload in enumerate(self.payloads)]
+        with override_settings(FILE_UPLOAD_STORAGE=''):
+            self.inline_payload = random_payload(3000)
+            self.files.append(self.upload(self.inline_payload, name='inline.bin'))
+
+    def scrub(self, **options):
+        from django.core.management import call_command
+        from io import StringIO
+
+        err = StringIO()
+        call_command('scrub_content', stdout=StringIO(), stderr=err, batch_size=2, max_rate=0, **options)
+        return err.getvalue()
+
+    def test_intact_content_passes(self):
+        """Test that untouched files verify, both as stored and decrypted"""
+        self.scrub()
+        self.scrub(decrypt=True, workers=3)
+
+    def test_damage_is_reported(self):
+        """Test that bit rot, truncation and missing objects are all reported"""
+        from django.core.management.base import CommandError
+
+        store = get_blob_store()
+        flipped, truncated, missing = self.files[:3]
+        with open(store.path(flipped.encrypted_filename), 'r+b') as f:
+            f.seek(100)
+            byte = f.read(1)
+            f.seek(100)
+            f.write(bytes([byte[0] ^ 1]))
+        with open(store.path(truncated.encrypted_filename), 'r+b') as f:
+            f.truncate(1000)
+        store.delete(missing.encrypted_filename)
+
+        with self.assertRaises(CommandError) as raised:
+            self.scrub()
+        self.assertIn(str([flipped.pk, truncated.pk, missing.pk]), str(raised.exception))
+
+    def test_backfill_records_missing_digests(self):
+        """Test that files without digests are skipped, then hashed with --backfill"""
+        File.objects.update(content_sha256=None, stored_sha256=None)
+        self.scrub()
+        self.assertFalse(File.objects.filter(stored_sha256__isnull=False).exists())
+
+        self.scrub(backfill=True)
+        for file, payload in zip(self.files, self.payloads + [self.inline_payload]):
+            file.refresh_from_db()
+            self.assertDigests(file, payload)
+
+    def test_backfill_records_missing_sizes(self):
+        """Test that files stored without a size are measured, and usage moves off the declared size"""
+        from django.core.management import call_command
+        from io import StringIO
+        from files.models import StorageUsage
+
+        File.objects.update(content_size=None, original_file_size=1)
+        call_command('reconcile_usage', stdout=StringIO())
+        self.assertEqual(StorageUsage.for_user(self.user).bytes_used, len(self.files))
+
+        self.scrub(backfill=True)
+        payloads = self.payloads + [self.inline_payload]
+        for file, payload in zip(self.files, payloads):
+            file.refresh_from_db()
+            self.assertEqual(file.content_size, len(payload))
+        self.assertEqual(StorageUsage.for_user(self.user).bytes_used, sum(map(len, payloads)))
+
+    def test_rate_limit(self):
+        """Test that reads are spread out to the configured byte rate"""
+        from files.management.commands.scrub_content import RateLimiter
+        import time
+
+        limiter = RateLimiter(100_000)
+        started = time.monotonic()
+        for _ in range(5):
+            limiter.consume(5000)
+        # The first read goes right away, the other four wait 50 ms each
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+
+@override_settings(FILE_UPLOAD_STORAGE='')
+class MigrateStorageTest(BlobStoreMixin, TransactionTestCase):
+    """Copies run on worker threads, which only see committed rows"""
+
+    def setUp(self):
+        super().setUp()
+        self.payloads = [random_payload(size) for size in (5000, 20_000, 1)]
+        self.files = [self.upload(payload, name=f'{i}.bin') for i, payload in enumerate(self.payloads)]
+        self.checkpoint = os.path.join(self.storage_dir, 'checkpoint.json')
+
+    def migrate(self, *args, **options):
+        from django.core.management import call_command
+        from io import StringIO
+
+        out = StringIO()
+        options = {'target': 'default', 'checkpoint': self.checkpoint, 'batch_size': 2, 'workers': 2, **options}
+        call_command('migrate_storage', *args, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def assertServes(self, file, payload):
+        response = self.client.get(f'/api/files/{file.id}/content/')
+        self.assertEqual(b''.join(response.streaming_content), payload)
+
+    def test_inline_content_moves_to_blob_store(self):
+        """Test moving, verifying and resuming a migration from the database"""
+        store = get_blob_store()
+        output = self.migrate(vacuum=True)
+        self.assertIn('Moved 3 files', output)
+        # A full VACUUM is never run without being asked for
+        self.assertIn('Skipping vacuum', output)
+        for file, payload in zip(self.files, self.payloads):
+            file = File._base_manager.get(pk=file.pk)
+            self.assertEqual(file.storage_backend, 'default')
+            self.assertIsNone(File._base_manager.values_list('encrypted_content', flat=True).get(pk=file.pk))
+            self.assertTrue(store.exists(file.encrypted_filename))
+            self.assertServes(file, payload)
+
+        # A later run only picks up what arrived since the checkpoint
+        payload = random_payload(3000)
+        new_file = self.upload(payload, name='new.bin')
+        output = self.migrate()
+        self.assertIn(f'Resuming after file {self.files[-1].pk}', output)
+        self.assertIn('Moved 4 files', output)
+        self.assertServes(new_file, payload)
+
+        # And back again
+        os.unlink(self.checkpoint)
+        self.migrate(source='default', target='database')
+        self.assertEqual(self.stored_blobs(), [])
+        self.assertServes(new_file, payload)
+
+    def test_vacuum_is_incremental_once_enabled(self):
+        """Test that the full VACUUM turning on incremental mode only runs when asked for"""
+        output = self.migrate(enable_incremental_vacuum=True)
+        self.assertIn('Enabling incremental auto-vacuum', output)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA auto_vacuum')
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+        # From then on --vacuum releases pages in steps
+        os.unlink(self.checkpoint)
+        self.migrate(source='default', target='database')
+        os.unlink(self.checkpoint)
+        output = self.migrate(vacuum=True, vacuum_pages=1)
+        self.assertNotIn('Enabling', output)
+        self.assertNotIn('Skipping vacuum', output)
+        self.assertIn('Database shrunk', output)
+
+    def test_mismatched_copies_stay_at_the_source(self):
+        """Test that a copy failing verification leaves the file where it was"""
+        from unittest import mock
+        from django.core.management.base import CommandError
+        from files.management.commands.migrate_storage import Command
+        import io
+
+        broken = self.files[1]
+        original_open_target = Command.open_target
+
+        def open_target(command, file_instance):
+            if file_instance.pk == broken.pk:
+                return io.BytesIO(b'corrupted')
+            return original_open_target(command, file_instance)
+
+        with mock.patch.object(Command, 'open_target', open_target):
+            with self.assertRaises(CommandError):
+                self.migrate()
+        broken = File._base_manager.get(pk=broken.pk)
+        self.assertEqual(broken.storage_backend, '')
+        self.assertFalse(get_blob_store().exists(broken.encrypted_filename))
+        self.assertServes(broken, self.payloads[1])
+
+        # The checkpoint is past it, so it is only retried with --restart
+        with self.assertRaises(CommandError):
+            self.migrate()
+        self.assertIn('Moved 1 files', self.migrate(restart=True))
+        self.assertServes(broken, self.payloads[1])
+
+    def stored_blobs(self):
+        blobs_dir = os.path.join(self.storage_dir, 'blobs')
+        return [name for _, _, names in os.walk(blobs_dir) for name in names]
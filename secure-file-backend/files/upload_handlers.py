@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from .key_management import KeyManagement
+from .models import SNIFF_SIZE, content_encryptor
+from .storage import get_blob_store, TieredBlobWriter
+import io
+import uuid
+
+
+class EncryptedUploadedFile(UploadedFile):
+    """
+    An upload that was server-side encrypted and stored while it arrived.
+
+    Only the first SNIFF_SIZE bytes of the client-encrypted data are kept
+    in memory (exposed through read() for validation); the ciphertext is
+    already committed to the blob store under encrypted_filename, or, when
+    it was small enough to be kept inline (storage_backend is empty),
+    spooled to pending_content until it can be written to the database
+    row. The File digest fields computed on the way through are kept in
+    digests.
+    """
+
+    def __init__(self, head, name, content_type, size, charset, content_type_extra,
+                 encrypted_filename, storage_backend, storage_format, file_key, server_iv, stored,
+                 pending_content=None, digests=None):
+        super().__init__(io.BytesIO(bytes(head)), name, content_type, size, charset, content_type_extra)
+        self.encrypted_filename = encrypted_filename
+        self.storage_backend = storage_backend
+        self.storage_format = storage_format
+        self.file_key = file_key
+        self.server_iv = server_iv
+        self.stored = stored
+        self.pending_content = pending_content
+        self.digests = digests or {}
+
+    def discard(self):
+        """Delete the stored ciphertext, e.g. when validation fails"""
+        if self.pending_content is not None:
+            self.pending_content.close()
+            self.pending_content = None
+        if self.stored and self.storage_backend:
+            get_blob_store(self.storage_backend).delete(self.encrypted_filename)
+        self.stored = False
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    """
+    Encrypt uploaded file data chunk by chunk as the request body arrives.
+
+    Each chunk is fed through an incremental encryptor for the configured
+    FILE_STORAGE_FORMAT and the ciphertext is written straight to the blob
+    store, so memory use per upload stays at roughly one chunk regardless
+    of file size. Ciphertext that stays below FILE_INLINE_THRESHOLD is kept
+    for the database row instead (see TieredBlobWriter). Uploads larger
+    than FILE_UPLOAD_MAX_SIZE are counted but not stored, leaving the size
+    check to the serializer.
+    """
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, request=None, storage_backend=None):
+        super().__init__(request)
+        if storage_backend is None:
+            storage_backend = settings.FILE_UPLOAD_STORAGE
+        self.storage_backend = storage_backend
+        self.storage_format = settings.FILE_STORAGE_FORMAT
+        self.max_size = settings.FILE_UPLOAD_MAX_SIZE
+        self.writer = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_key = KeyManagement.generate_file_key()
+        self.server_iv = KeyManagement.generate_iv()
+        self.encryptor = content_encryptor(self.storage_format, self.file_key, self.server_iv)
+        self.encrypted_filename = uuid.uuid4().hex
+        self.writer = TieredBlobWriter(self.encrypted_filename, self.storage_backend)
+        self.head = bytearray()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += raw_data[:SNIFF_SIZE - len(self.head)]
+
+        self.size += len(raw_data)
+        if self.writer is not None:
+            if self.size > self.max_size:
+                # Too large to keep, stop storing but keep counting
+                self._abort()
+            else:
+                self.writer.write(self.encryptor.update(raw_data))
+        return None
+
+    def file_complete(self, file_size):
+        stored = self.writer is not None
+        storage_backend = self.storage_backend
+        pending_content = None
+        if stored:
+            self.writer.write(self.encryptor.finalize())
+            self.writer.commit()
+            storage_backend = self.writer.storage_backend
+            pending_content = self.writer.file
+            self.writer = None
+
+        return EncryptedUploadedFile(
+            head=self.head,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            encrypted_filename=self.encrypted_filename,
+            storage_backend=storage_backend,
+            storage_format=self.storage_format,
+            file_key=self.file_key,
+            server_iv=self.server_iv,
+            stored=stored,
+            pending_content=pending_content,
+            digests=self.encryptor.digests() if stored else None,
+        )
+
+    def upload_interrupted(self):
+        self._abort()
+
+    def _abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
@@ -3,14 +3,40 @@ from .views import (
     FileUploadView,
     FileListView,
     FileDetailView,
+    FileTrashListView,
+    FileRestoreView,
+    StorageUsageView,
     FileContentView,
-    FilePreviewView
+    FilePreviewView,
+    FileArchiveView,
+    ContentCacheStatsView,
+    UploadSessionCreateView,
+    UploadSessionDetailView,
+    UploadChunkView,
+    UploadSessionCompleteView,
+    DirectUploadCreateView,
+    DirectUploadDetailView,
+    DirectUploadReceiveView,
+    DirectUploadCompleteView
 )
 
 urlpatterns = [
     path('', FileListView.as_view(), name='file-list'),
     path('upload/', FileUploadView.as_view(), name='file-upload'),
+    path('trash/', FileTrashListView.as_view(), name='file-trash'),
+    path('usage/', StorageUsageView.as_view(), name='storage-usage'),
+    path('archive/', FileArchiveView.as_view(), name='file-archive'),
+    path('cache-stats/', ContentCacheStatsView.as_view(), name='content-cache-stats'),
+    path('uploads/', UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('uploads/<uuid:id>/', UploadSessionDetailView.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:session_id>/chunks/<int:index>/', UploadChunkView.as_view(), name='upload-session-chunk'),
+    path('uploads/<uuid:session_id>/complete/', UploadSessionCompleteView.as_view(), name='upload-session-complete'),
+    path('direct-uploads/', DirectUploadCreateView.as_view(), name='direct-upload-create'),
+    path('direct-uploads/<uuid:id>/', DirectUploadDetailView.as_view(), name='direct-upload-detail'),
+    path('direct-uploads/<uuid:upload_id>/data/', DirectUploadReceiveView.as_view(), name='direct-upload-receive'),
+    path('direct-uploads/<uuid:upload_id>/complete/', DirectUploadCompleteView.as_view(), name='direct-upload-complete'),
     path('<int:id>/', FileDetailView.as_view(), name='file-detail'),
+    path('<int:file_id>/restore/', FileRestoreView.as_view(), name='file-restore'),
     path('<int:file_id>/content/', FileContentView.as_view(), name='file-content'),
     path('<int:file_id>/preview/', FilePreviewView.as_view(), name='file-preview'),
 ] 
\ No newline at end of file
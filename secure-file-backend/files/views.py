@@ -1,24 +1,78 @@
 from django.shortcuts import render, get_object_or_404
 from rest_framework import generics, status, permissions
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.views import APIView
+from django.conf import settings
+from django.core import signing
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.http import FileResponse, HttpResponse, Http404
-from .serializers import FileUploadSerializer, FileDownloadSerializer
-from .models import File
+from .serializers import (
+    FileUploadSerializer,
+    FileDownloadSerializer,
+    UploadSessionSerializer,
+    UploadSessionCompleteSerializer,
+    DirectUploadSerializer,
+    DirectUploadCompleteSerializer,
+    TrashedFileSerializer,
+    StorageUsageSerializer,
+    FileArchiveSerializer
+)
+from .models import (
+    File, UploadSession, UploadPart, DirectUpload, UploadIdempotencyKey, StorageUsage, STAGING_CHUNK_SIZE
+)
 from .key_management import KeyManagement
+from .upload_handlers import EncryptingUploadHandler, EncryptedUploadedFile
+from .serving import file_content_response, file_archive_response
+from .content_cache import get_content_cache, get_content_flights
+from shares.models import SharePermission
 import traceback
 import logging
 from django.utils import timezone
 from rest_framework.exceptions import PermissionDenied
 from django.utils.http import http_date
+import base64
+import binascii
+import io
 import mimetypes
 import os
+import re
 
 logger = logging.getLogger(__name__)
 
+def parse_content_digest(header):
+    """
+    Get the SHA-256 digest from a Content-Digest or Repr-Digest header (RFC 9530).
+
+    Returns None when there is no header or it has no sha-256 entry.
+    """
+    if not header:
+        return None
+    match = re.search(r'sha-256=:([A-Za-z0-9+/=]+):', header)
+    if not match:
+        return None
+    try:
+        digest = base64.b64decode(match.group(1), validate=True)
+    except binascii.Error:
+        digest = b''
+    if len(digest) != 32:
+        raise ValueError("Invalid sha-256 digest")
+    return digest
+
+
+def uploaded_file_data(file_instance):
+    """Summary of a newly uploaded file for upload responses"""
+    return {
+        'id': file_instance.id,
+        'filename': file_instance.filename,
+        'upload_timestamp': file_instance.upload_timestamp,
+        'mime_type': file_instance.mime_type,
+        'original_file_size': file_instance.original_file_size
+    }
+
+
 class FileUploadView(generics.CreateAPIView):
     """
     Upload an encrypted file.
@@ -29,12 +83,51 @@ class FileUploadView(generics.CreateAPIView):
     - encryption_iv: Initialization vector used for encryption (32 char hex)
     - original_file_size: Size of the original file before encryption
     - mime_type: Original file's MIME type
+
+    Retries can be made safe with an Idempotency-Key header, sent along
+    with a sha-256 Repr-Digest header of the encrypted file.
+
+    Uploads that can't fit in the user's quota are refused with 413
+    before the body is read, going by the request's Content-Length, and
+    checked again against the file's size once it is received. While a
+    quota applies, requests without a Content-Length are refused with 411.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = FileUploadSerializer
     parser_classes = (MultiPartParser, FormParser)
 
     def post(self, request, *args, **kwargs):
+        # Encrypt and store the file while the body streams in instead of
+        # buffering it; must be set before request.data is first accessed
+        upload_handler = EncryptingUploadHandler(request._request)
+        request._request.upload_handlers = [upload_handler]
+
+        # Settle retries before the body is read
+        idempotency_key = None
+        if 'Idempotency-Key' in request.headers:
+            idempotency_key, response = self.claim_idempotency_key(request, request.headers['Idempotency-Key'])
+            if response is not None:
+                return response
+
+        usage = StorageUsage.for_user(request.user)
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or '')
+        except ValueError:
+            content_length = None
+        if content_length is None and usage.effective_quota_bytes() is not None:
+            self.release_idempotency_key(idempotency_key)
+            return Response(
+                {'error': 'Uploads need a Content-Length while a storage quota applies'},
+                status=status.HTTP_411_LENGTH_REQUIRED
+            )
+
+        # The body is a little larger than the file, so this errs on the safe side
+        quota_error = usage.quota_error(content_length or 0)
+        if quota_error is not None:
+            self.release_idempotency_key(idempotency_key)
+            return Response({'error': quota_error}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        file_instance = None
         try:
             serializer = self.get_serializer(
                 data=request.data,
@@ -43,31 +136,422 @@ class FileUploadView(generics.CreateAPIView):
             
             if not serializer.is_valid():
                 logger.error(f"Serializer validation errors: {serializer.errors}")
+                self.discard_uploads(request)
+                self.release_idempotency_key(idempotency_key)
                 return Response({
                     'error': 'Validation failed',
                     'details': serializer.errors
                 }, status=status.HTTP_400_BAD_REQUEST)
-                
-            file_instance = serializer.save()
+
+            if idempotency_key is not None:
+                received_sha256 = serializer.validated_data['file'].digests.get('content_sha256')
+                if received_sha256 != bytes(idempotency_key.content_sha256):
+                    self.discard_uploads(request)
+                    self.release_idempotency_key(idempotency_key)
+                    return Response({
+                        'error': "The uploaded file doesn't match its Repr-Digest"
+                    }, status=status.HTTP_400_BAD_REQUEST)
+
+            with transaction.atomic():
+                created = serializer.save()
+                if idempotency_key is not None:
+                    idempotency_key.file = created
+                    idempotency_key.save(update_fields=['file'])
+            file_instance = created
             
             return Response({
                 'message': 'File uploaded successfully',
-                'file': {
-                    'id': file_instance.id,
-                    'filename': file_instance.filename,
-                    'upload_timestamp': file_instance.upload_timestamp,
-                    'mime_type': file_instance.mime_type,
-                    'original_file_size': file_instance.original_file_size
-                }
+                'file': uploaded_file_data(file_instance)
             }, status=status.HTTP_201_CREATED)
             
         except ValidationError as e:
             logger.error(f"Validation error: {str(e)}")
+            self.discard_uploads(request)
+            self.release_idempotency_key(idempotency_key)
             return Response({
                 'error': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error during file upload: {str(e)}\n{traceback.format_exc()}")
+            # Stored content only stays once its row is committed
+            if file_instance is None:
+                self.discard_uploads(request)
+            self.release_idempotency_key(idempotency_key)
+            return Response({
+                'error': 'An error occurred while uploading the file.',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            # Drop any partially written ciphertext if the body was cut off
+            upload_handler.upload_interrupted()
+
+    def claim_idempotency_key(self, request, key):
+        """
+        Claim an Idempotency-Key for this upload.
+
+        Returns:
+            tuple: (UploadIdempotencyKey to complete, None) when the upload
+            should go ahead, or (None, Response) to answer with instead
+        """
+        try:
+            content_sha256 = parse_content_digest(request.headers.get('Repr-Digest'))
+        except ValueError:
+            content_sha256 = None
+        if not key or len(key) > 255 or content_sha256 is None:
+            return None, Response({
+                'error': 'Idempotency-Key must be 1 to 255 characters and come with a sha-256 Repr-Digest'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            record, created = UploadIdempotencyKey.objects.select_for_update().get_or_create(
+                user=request.user,
+                key=key,
+                defaults={'content_sha256': content_sha256}
+            )
+            if created:
+                return record, None
+
+            if record.is_expired() or (record.file is not None and record.file.is_trashed):
+                record.reset(content_sha256)
+                return record, None
+            if bytes(record.content_sha256) != content_sha256:
+                return None, Response({
+                    'error': 'This Idempotency-Key was already used for a different file'
+                }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if record.file is not None:
+                response = Response({
+                    'message': 'File uploaded successfully',
+                    'file': uploaded_file_data(record.file)
+                }, status=status.HTTP_201_CREATED)
+                response['Idempotent-Replayed'] = 'true'
+                return None, response
+            if not record.is_abandoned():
+                response = Response({
+                    'error': 'An upload with this Idempotency-Key is still in progress'
+                }, status=status.HTTP_409_CONFLICT)
+                response['Retry-After'] = '1'
+                return None, response
+
+            # The first attempt never finished, this one takes over
+            record.claimed_at = timezone.now()
+            record.save(update_fields=['claimed_at'])
+            return record, None
+
+    def release_idempotency_key(self, idempotency_key):
+        """Let a failed upload be retried under the same key"""
+        if idempotency_key is not None:
+            idempotency_key.delete()
+
+    def discard_uploads(self, request):
+        """Remove stored ciphertext for uploads that won't become files"""
+        for uploaded_file in request.FILES.values():
+            if isinstance(uploaded_file, EncryptedUploadedFile):
+                uploaded_file.discard()
+
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    """
+    Start a resumable upload of an encrypted file.
+    Required fields are the same as for a single upload, plus:
+    - total_size: Size of the encrypted file in bytes
+    The response gives the session id and the chunk_size every chunk
+    except the last must have.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+
+class UploadSessionDetailView(generics.RetrieveDestroyAPIView):
+    """
+    Get the progress of an upload session (received_bytes, next_chunk),
+    e.g. to resume after a dropped connection, or abort it.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(
+            user=self.request.user,
+            expires_at__gt=timezone.now()
+        )
+
+
+class UploadChunkView(APIView):
+    """
+    Upload chunk `index` of a session as the raw request body.
+    Chunks can be sent in any order and over several connections at once,
+    up to FILE_UPLOAD_MAX_CONCURRENT_PARTS per user. An optional
+    Content-Digest header (sha-256, RFC 9530) is checked against the body.
+    Re-sending a chunk that was already received is acknowledged without
+    storing it again.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def put(self, request, session_id, index):
+        try:
+            expected_sha256 = parse_content_digest(request.headers.get('Content-Digest'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # 1. Reserve the part, keeping the session locked only briefly
+            with transaction.atomic():
+                session = self.get_session(request, session_id)
+                if session.is_expired():
+                    return Response(
+                        {"error": "Upload session has expired"},
+                        status=status.HTTP_410_GONE
+                    )
+
+                if not 0 <= index < session.total_chunks:
+                    return Response(
+                        {"error": f"Chunk index must be between 0 and {session.total_chunks - 1}"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                part = session.parts.filter(index=index).first()
+                if part is not None and part.is_stale():
+                    part.delete()
+                    part = None
+
+                received = index < session.next_chunk or (part is not None and part.state == UploadPart.STAGED)
+                if not received:
+                    if part is not None:
+                        return Response(
+                            {"error": f"Chunk {index} is already being uploaded"},
+                            status=status.HTTP_409_CONFLICT
+                        )
+
+                    # Counted and reserved under the user's lock, so uploads to other sessions can't race past the cap
+                    StorageUsage.lock(request.user)
+                    receiving = UploadPart.objects.filter(
+                        session__user=request.user,
+                        state=UploadPart.RECEIVING,
+                        created_at__gt=timezone.now() - settings.FILE_UPLOAD_PART_TIMEOUT
+                    ).count()
+                    if receiving >= settings.FILE_UPLOAD_MAX_CONCURRENT_PARTS:
+                        return Response(
+                            {"error": "Too many chunks are being uploaded at once"},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS
+                        )
+
+                    part = UploadPart.objects.create(session=session, index=index)
+
+            if received:
+                # Already received, e.g. the response to a retry was lost; finish assembling if that was cut short
+                session.assemble_parts()
+                return Response(UploadSessionSerializer(session).data)
+
+            # 2. Receive the body without holding any lock
+            try:
+                part.receive(
+                    request.stream or io.BytesIO(),
+                    session.expected_chunk_size(index),
+                    expected_sha256
+                )
+            except ValueError as e:
+                part.delete()
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except BaseException:
+                part.delete()
+                raise
+
+            # 3. Stage the part, then chain every part that can now be appended onto the encrypted stream
+            with transaction.atomic():
+                session = self.get_session(request, session_id)
+                part.save(update_fields=['state', 'size', 'sha256'])
+            session.assemble_parts()
+
+            return Response(UploadSessionSerializer(session).data)
+
+        except Http404:
+            raise
+        except Exception as e:
+            logger.error(f"Error during chunk upload: {str(e)}\n{traceback.format_exc()}")
+            return Response({
+                'error': 'An error occurred while uploading the chunk.',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def get_session(self, request, session_id):
+        return get_object_or_404(
+            UploadSession.objects.select_for_update(),
+            id=session_id,
+            user=request.user
+        )
+
+
+class UploadSessionCompleteView(APIView):
+    """
+    Finalize a fully received upload session into a file.
+    Runs the same validation as a single upload.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, session_id):
+        try:
+            with transaction.atomic():
+                session = get_object_or_404(
+                    UploadSession.objects.select_for_update(),
+                    id=session_id,
+                    user=request.user,
+                    expires_at__gt=timezone.now()
+                )
+                serializer = UploadSessionCompleteSerializer(session, data={})
+                if not serializer.is_valid():
+                    logger.error(f"Upload session validation errors: {serializer.errors}")
+                    return Response({
+                        'error': 'Validation failed',
+                        'details': serializer.errors
+                    }, status=status.HTTP_400_BAD_REQUEST)
+
+                file_instance = serializer.save()
+
+            return Response({
+                'message': 'File uploaded successfully',
+                'file': uploaded_file_data(file_instance)
+            }, status=status.HTTP_201_CREATED)
+
+        except Http404:
+            raise
+        except Exception as e:
+            logger.error(f"Error finalizing upload session: {str(e)}\n{traceback.format_exc()}")
+            return Response({
+                'error': 'An error occurred while uploading the file.',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class DirectUploadCreateView(generics.CreateAPIView):
+    """
+    Start an upload that goes straight to the storage tier.
+    Required fields are the same as for an upload session. The response
+    gives an upload_url, valid for FILE_DIRECT_UPLOAD_LIFETIME, to PUT
+    the encrypted file to as the raw request body; then call complete.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = DirectUploadSerializer
+
+
+class DirectUploadDetailView(generics.RetrieveDestroyAPIView):
+    """Get or abort a direct upload that hasn't been completed"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = DirectUploadSerializer
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        return DirectUpload.objects.filter(
+            user=self.request.user,
+            expires_at__gt=timezone.now()
+        )
+
+
+class DirectUploadReceiveView(APIView):
+    """
+    Receive the body of a direct upload for stores that can't hand out
+    pre-signed URLs. Authorized by the signed token in the upload URL
+    rather than the user's credentials; the body is streamed into the
+    blob store as is, with no encryption work on the way.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def put(self, request, upload_id):
+        try:
+            signed_id = DirectUpload.unsign(request.query_params.get('token', ''))
+        except signing.BadSignature:
+            return Response(
+                {"error": "Invalid or expired upload token"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if signed_id != str(upload_id):
+            return Response(
+                {"error": "Invalid or expired upload token"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        upload = get_object_or_404(DirectUpload, id=upload_id)
+        if upload.is_expired():
+            return Response(
+                {"error": "Direct upload has expired"},
+                status=status.HTTP_410_GONE
+            )
+        if upload.completed_at is not None:
+            return Response(
+                {"error": "Direct upload has already been completed"},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        try:
+            stream = request.stream or io.BytesIO()
+            writer = upload.blob_store.writer(upload.incoming_key)
+            received = 0
+            try:
+                for data in iter(lambda: stream.read(STAGING_CHUNK_SIZE), b''):
+                    received += len(data)
+                    if received > upload.total_size:
+                        break
+                    writer.write(data)
+                if received != upload.total_size:
+                    writer.abort()
+                    return Response(
+                        {"error": f"Upload must be {upload.total_size} bytes"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            except BaseException:
+                writer.abort()
+                raise
+            writer.commit()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        except Exception as e:
+            logger.error(f"Error receiving direct upload: {str(e)}\n{traceback.format_exc()}")
+            return Response({
+                'error': 'An error occurred while uploading the file.',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class DirectUploadCompleteView(APIView):
+    """
+    Register a direct upload as a file once its data is in storage.
+    Runs the same validation as a single upload, then queues the
+    server-side encryption and answers 202 right away. Poll the upload
+    until its status is complete (its file is set) or failed.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        try:
+            with transaction.atomic():
+                upload = get_object_or_404(
+                    DirectUpload.objects.select_for_update(),
+                    id=upload_id,
+                    user=request.user,
+                    expires_at__gt=timezone.now()
+                )
+                # Completing again only reports how it is going
+                if upload.completed_at is None:
+                    serializer = DirectUploadCompleteSerializer(upload, data={})
+                    if not serializer.is_valid():
+                        logger.error(f"Direct upload validation errors: {serializer.errors}")
+                        return Response({
+                            'error': 'Validation failed',
+                            'details': serializer.errors
+                        }, status=status.HTTP_400_BAD_REQUEST)
+
+                    serializer.save()
+
+            return Response({
+                'message': 'File upload is being finalized',
+                'upload': DirectUploadSerializer(upload).data
+            }, status=status.HTTP_202_ACCEPTED)
+
+        except Http404:
+            raise
+        except Exception as e:
+            logger.error(f"Error finalizing direct upload: {str(e)}\n{traceback.format_exc()}")
             return Response({
                 'error': 'An error occurred while uploading the file.',
                 'details': str(e)
@@ -107,6 +591,46 @@ class FileDetailView(generics.RetrieveDestroyAPIView):
         user = self.request.user
         return File.objects.filter(user=user)
 
+    def perform_destroy(self, instance):
+        # Only mark it trashed, reclaim_trash purges it after FILE_TRASH_RETENTION
+        instance.trash()
+
+
+class FileTrashListView(generics.ListAPIView):
+    """List the current user's deleted files that can still be restored"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = TrashedFileSerializer
+
+    def get_queryset(self):
+        return File.all_objects.filter(
+            user=self.request.user,
+            deleted_at__gt=timezone.now() - settings.FILE_TRASH_RETENTION
+        ).order_by('-deleted_at')
+
+
+class StorageUsageView(generics.RetrieveAPIView):
+    """Get the current user's storage usage and quotas"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = StorageUsageSerializer
+
+    def get_object(self):
+        return StorageUsage.for_user(self.request.user)
+
+
+class FileRestoreView(APIView):
+    """Take a deleted file back out of the trash"""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, file_id):
+        file_instance = get_object_or_404(
+            File.all_objects,
+            id=file_id,
+            user=request.user,
+            deleted_at__gt=timezone.now() - settings.FILE_TRASH_RETENTION
+        )
+        file_instance.restore()
+        return Response(FileDownloadSerializer(file_instance).data)
+
 
 class FileContentView(APIView):
     """
@@ -118,7 +642,7 @@ class FileContentView(APIView):
     
     def get_object(self, file_id, user=None):
         """Get file if user has access through ownership or share"""
-        file_instance = get_object_or_404(File, id=file_id)
+        file_instance = get_object_or_404(File.objects.with_inline_content(), id=file_id)
         
         # Check if user owns the file
         if user and file_instance.user == user:
@@ -144,10 +668,7 @@ class FileContentView(APIView):
             # Get the file instance
             file_instance = self.get_object(file_id, request.user if request.user.is_authenticated else None)
             
-            # Get the server-side encrypted data from database
-            server_encrypted_data = file_instance.encrypted_content
-            
-            if not server_encrypted_data:
+            if not file_instance.has_content():
                 return Response(
                     {
                         "status": "error",
@@ -157,28 +678,16 @@ class FileContentView(APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Get the file key and decrypt it
-            file_key = file_instance.get_file_key()
-
-            # Decrypt the server-side encryption
-            client_encrypted_data = KeyManagement.decrypt_file(
-                server_encrypted_data,
-                file_key,
-                file_instance.server_side_iv
+            # Stream the client-encrypted file, removing server-side encryption on the fly
+            return file_content_response(
+                file_instance,
+                content_type='application/octet-stream',  # Always send as binary data
+                disposition='attachment',
+                request=request
             )
             
-            # Create the response with the client-encrypted file
-            response = HttpResponse(
-                client_encrypted_data,
-                content_type='application/octet-stream'  # Always send as binary data
-            )
-            
-            # Add headers for better download handling
-            response['Content-Disposition'] = f'attachment; filename="{file_instance.filename}"'
-            response['Content-Length'] = len(client_encrypted_data)
-            
-            return response
-            
+        except Http404:
+            raise
         except PermissionDenied as e:
             return Response(
                 {
@@ -200,6 +709,55 @@ class FileContentView(APIView):
             )
 
 
+class FileArchiveView(APIView):
+    """
+    Download several of the user's files as one ZIP archive.
+    Like single downloads, the members are decrypted from server-side
+    encryption as the archive streams but stay client-side encrypted;
+    manifest.json at the end of the archive has the IV of each.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = FileArchiveSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                {
+                    'error': 'Validation failed',
+                    'details': serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        ids = serializer.validated_data['ids']
+        files = File.objects.filter(user=request.user).in_bulk(ids)
+        missing = [file_id for file_id in ids if file_id not in files]
+        if missing:
+            return Response(
+                {
+                    'error': 'Files not found',
+                    'details': {'ids': missing}
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        return file_archive_response([files[file_id] for file_id in ids])
+
+
+class ContentCacheStatsView(APIView):
+    """
+    Counters of the content cache and of coalesced reads, for tuning the
+    FILE_CONTENT_CACHE_* settings. Every worker process has its own cache,
+    these are the answering one's.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        cache = get_content_cache()
+        stats = {'enabled': False} if cache is None else {'enabled': True, **cache.info()}
+        return Response({**stats, 'coalescing': get_content_flights().info()})
+
+
 class FilePreviewView(APIView):
     """View for previewing files"""
     permission_classes = [IsAuthenticated]
@@ -207,38 +765,30 @@ class FilePreviewView(APIView):
     def get(self, request, file_id):
         try:
             # Get the file instance
-            file = get_object_or_404(File, id=file_id, user=request.user)
+            file = get_object_or_404(File.objects.with_inline_content(), id=file_id, user=request.user)
             
-            if not file.encrypted_content:
+            if not file.has_content():
                 return Response(
                     {"error": "File content not found"},
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Get the file key and decrypt it
-            file_key = file.get_file_key()
-
-            # Decrypt the server-side encryption
-            decrypted_data = KeyManagement.decrypt_file(
-                file.encrypted_content,
-                file_key,
-                file.server_side_iv
-            )
-            
-            # Create response with proper content type
-            response = HttpResponse(
-                decrypted_data,
-                content_type=file.mime_type
+            # Create streaming response with proper content type
+            response = file_content_response(
+                file,
+                content_type=file.mime_type,
+                disposition='inline',
+                request=request
             )
             
             # Set headers for preview
-            response['Content-Length'] = len(decrypted_data)
-            response['Content-Disposition'] = f'inline; filename="{file.filename}"'
             response['X-Frame-Options'] = 'SAMEORIGIN'
             response['Access-Control-Allow-Origin'] = '*'
             
             return response
             
+        except Http404:
+            raise
         except Exception as e:
             logger.error(f"Error in FilePreviewView: {str(e)}\n{traceback.format_exc()}")
             return Response(
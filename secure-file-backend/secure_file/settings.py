@@ -116,6 +116,54 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Encrypted file content storage (see files.storage)
+FILE_STORAGES = {
+    'default': {
+        'BACKEND': 'files.storage.LocalBlobStore',
+        'OPTIONS': {
+            'location': os.getenv('FILE_STORAGE_LOCATION', str(MEDIA_ROOT / 'blobs')),
+            # Internal nginx location aliased to the blob directory, e.g. /protected/blobs/,
+            # to have nginx send at-rest content with X-Accel-Redirect. nginx must see the
+            # directory at the same path (the nginx service in docker-compose.yml mounts
+            # the media_files volume at /app/media), or offloaded downloads get a 404
+            'accel_redirect': os.getenv('FILE_STORAGE_ACCEL_REDIRECT'),
+        },
+    },
+}
+if os.getenv('FILE_STORAGE_PACK_MAX_SIZE'):
+    # Append blobs smaller than this many bytes to shared pack files instead of
+    # one file each; compact them with the compact_packs command
+    FILE_STORAGES['default']['BACKEND'] = 'files.storage.PackedBlobStore'
+    FILE_STORAGES['default']['OPTIONS']['max_packed_size'] = int(os.getenv('FILE_STORAGE_PACK_MAX_SIZE'))
+if os.getenv('FILE_STORAGE_S3_BUCKET'):
+    # S3-compatible object storage, select it with FILE_UPLOAD_STORAGE=s3.
+    # Credentials come from the standard AWS environment variables
+    FILE_STORAGES['s3'] = {
+        'BACKEND': 'files.storage.S3BlobStore',
+        'OPTIONS': {
+            'bucket': os.getenv('FILE_STORAGE_S3_BUCKET'),
+            'prefix': os.getenv('FILE_STORAGE_S3_PREFIX', ''),
+            'endpoint_url': os.getenv('FILE_STORAGE_S3_ENDPOINT_URL'),  # e.g. http://localhost:9000 for MinIO
+            'region_name': os.getenv('FILE_STORAGE_S3_REGION'),
+        },
+    }
+    if os.getenv('FILE_STORAGE_S3_CACHE_SIZE'):
+        # Keep up to this many bytes of recently downloaded S3 objects on local disk
+        FILE_STORAGES['s3'] = {
+            'BACKEND': 'files.storage.CachedBlobStore',
+            'OPTIONS': {
+                'origin': FILE_STORAGES['s3'],
+                'location': os.getenv('FILE_STORAGE_S3_CACHE_LOCATION', str(MEDIA_ROOT / 'blob-cache' / 's3')),
+                'max_size': int(os.getenv('FILE_STORAGE_S3_CACHE_SIZE')),
+            },
+        }
+FILE_UPLOAD_STORAGE = os.getenv('FILE_UPLOAD_STORAGE', 'default')  # FILE_STORAGES alias new content goes to, empty to keep it in the database
+FILE_INLINE_THRESHOLD = int(os.getenv('FILE_INLINE_THRESHOLD', 32 * 1024))  # Content smaller than this (as stored) is kept in the File row instead of FILE_UPLOAD_STORAGE, 0 to turn off
+FILE_STORAGE_FORMAT = os.getenv('FILE_STORAGE_FORMAT', 'aes-256-gcm-segmented')  # Format new content is stored in, see File.STORAGE_FORMAT_CHOICES
+FILE_SEGMENT_SIZE = 64 * 1024  # Plaintext bytes per AES-GCM segment in the segmented format
+FILE_CRYPTO_WORKERS = None  # Threads sealing/opening segments in parallel, None for one per CPU
+FILE_PARALLEL_DECRYPT_THRESHOLD = 4 * 1024 * 1024  # AES-CBC data at least this large is decrypted on several threads
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -153,14 +201,56 @@ CORS_ALLOW_HEADERS = [
     'accept',
     'accept-encoding',
     'authorization',
+    'content-digest',
     'content-type',
     'dnt',
+    'idempotency-key',
     'origin',
+    'repr-digest',
+    'resume-token',
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
 ]
+CORS_EXPOSE_HEADERS = [
+    'resume-token',
+]
 
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 10MB
+FILE_UPLOAD_MAX_SIZE = 10 * 1024 * 1024  # Largest file accepted by a single upload request
+FILE_IDEMPOTENCY_KEY_LIFETIME = timedelta(hours=24)  # How long a retried upload returns the original file
+FILE_IDEMPOTENCY_CLAIM_TIMEOUT = timedelta(minutes=10)  # Uploads unfinished after this long no longer block retries
+
+# Resumable upload session settings
+FILE_UPLOAD_SESSION_MAX_SIZE = 2 * 1024 * 1024 * 1024  # Largest file accepted through an upload session
+FILE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Size of every chunk but the last, a multiple of FILE_SEGMENT_SIZE
+FILE_UPLOAD_SESSION_LIFETIME = timedelta(hours=24)  # Sessions without activity for this long expire
+FILE_UPLOAD_MAX_CONCURRENT_PARTS = 8  # Chunks a user can be uploading at the same time
+FILE_UPLOAD_PART_TIMEOUT = timedelta(minutes=15)  # Unfinished chunk uploads older than this are abandoned
+FILE_UPLOAD_STAGING_DIR = os.getenv('FILE_UPLOAD_STAGING_DIR', str(MEDIA_ROOT / 'staging'))
+
+# Trash settings
+FILE_TRASH_RETENTION = timedelta(days=30)  # How long deleted files can be restored before they are reclaimed
+
+# Quota settings, StorageUsage.quota_bytes/quota_files override them per user
+FILE_QUOTA_BYTES = int(os.getenv('FILE_QUOTA_BYTES', 0)) or None  # Bytes of files (original sizes, trash included) each user may store, None for no limit
+FILE_QUOTA_FILES = int(os.getenv('FILE_QUOTA_FILES', 0)) or None  # Files (trash included) each user may store, None for no limit
+
+# Direct upload settings
+FILE_DIRECT_UPLOAD_LIFETIME = timedelta(minutes=15)  # How long a signed upload URL stays valid
+FILE_DIRECT_UPLOAD_WORKERS = 2  # Threads finalizing completed direct uploads in the background, 0 to leave them to finalize_direct_uploads
+FILE_DIRECT_UPLOAD_FINALIZE_TIMEOUT = timedelta(minutes=30)  # Finalizing unfinished after this long is abandoned and can be retried
+FILE_DIRECT_UPLOAD_RESULT_LIFETIME = timedelta(hours=24)  # How long a completed direct upload can be polled for its file
+
+# File download settings
+FILE_SERVE_CHUNK_SIZE = 256 * 1024  # Bytes read and decrypted per step when streaming content
+FILE_READ_AHEAD_WORKERS = 8  # Threads prefetching the next chunk from storage
+FILE_CONTENT_CACHE_SIZE = int(os.getenv('FILE_CONTENT_CACHE_SIZE', 64 * 1024 * 1024))  # Bytes of decrypted content each process keeps for repeated downloads, 0 to turn off
+FILE_CONTENT_CACHE_MAX_ENTRY_SIZE = 4 * 1024 * 1024  # Larger files are always streamed from storage
+FILE_CONTENT_CACHE_TTL = timedelta(minutes=5)  # How long cached content is served before it is read from storage again
+FILE_COALESCE_TIMEOUT = timedelta(seconds=30)  # How long a download waits for a concurrent one reading the same content before reading on its own
+FILE_COALESCE_BUFFER_SIZE = 4 * 1024 * 1024  # Bytes of content a shared read keeps for the downloads behind it; those further behind read on their own
+FILE_ARCHIVE_MAX_FILES = 1000  # Most files one archive download can hold
+SHARE_DOWNLOAD_RESUME_WINDOW = timedelta(hours=1)  # How long after a share download it can be resumed without counting again
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 01:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shares', '0002_alter_sharepermission_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharepermission',
+            name='resume_token',
+            field=models.UUIDField(blank=True, editable=False, help_text='Handed out with the last recorded download, for resuming it', null=True),
+        ),
+    ]
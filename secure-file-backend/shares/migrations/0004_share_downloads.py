@@ -0,0 +1,34 @@
+# Generated by Django 5.0.2 on 2026-10-17 01:48
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shares', '0003_sharepermission_resume_token'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='sharepermission',
+            name='resume_token',
+        ),
+        migrations.CreateModel(
+            name='ShareDownload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('served_until', models.BigIntegerField(default=0, help_text='Offset just past the furthest byte sent for this download')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('share', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='downloads', to='shares.sharepermission')),
+            ],
+            options={
+                'verbose_name': 'share download',
+                'verbose_name_plural': 'share downloads',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
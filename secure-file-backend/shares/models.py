@@ -77,6 +77,38 @@ class SharePermission(models.Model):
             return True
         return self.downloads_used < self.max_downloads
 
+    def get_resumable_download(self, resume_token):
+        """
+        Get the recorded download a Resume-Token was handed out with.
+
+        Returns:
+            ShareDownload | None: The download, or None if the token is
+            unknown or the download can no longer be resumed
+        """
+        try:
+            token = uuid.UUID(str(resume_token))
+        except ValueError:
+            return None
+        download = self.downloads.filter(token=token).first()
+        if download is None or not download.is_resumable():
+            return None
+        return download
+
+    def can_resume_download(self, resume_token, byte_range=None):
+        """
+        Check if a partial (resumed) download can continue a recorded one.
+
+        Resumed downloads don't count against max_downloads as long as they
+        send the Resume-Token of a download recorded within
+        SHARE_DOWNLOAD_RESUME_WINDOW. When the range is given it must also
+        start no later than the content already served for that download
+        (see ShareDownload.can_resume), so a resume never skips ahead.
+        """
+        download = self.get_resumable_download(resume_token)
+        if download is None:
+            return False
+        return byte_range is None or download.can_resume(byte_range)
+
     def can_access(self, user):
         """Check if user can access (view) through this share"""
         if self.is_expired():
@@ -106,14 +138,22 @@ class SharePermission(models.Model):
         return True
 
     def record_download(self):
-        """Record a successful download"""
+        """
+        Record a successful download.
+
+        Returns:
+            ShareDownload: The download, whose token is its Resume-Token
+        """
         if not self.has_downloads_remaining():
             raise ValidationError("No downloads remaining")
             
         self.downloads_used += 1
         self.last_downloaded_at = timezone.now()
         self.save(update_fields=['downloads_used', 'last_downloaded_at'])
+        # Downloads past the resume window are only kept until the next one is recorded
+        self.downloads.filter(created_at__lt=self.last_downloaded_at - settings.SHARE_DOWNLOAD_RESUME_WINDOW).delete()
         logger.info(f"Download recorded for share {self.id}, downloads used: {self.downloads_used}")
+        return ShareDownload.objects.create(share=self)
 
     def clean(self):
         """Validate share permission"""
@@ -140,3 +180,46 @@ class SharePermission(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+
+
+class ShareDownload(models.Model):
+    """
+    A recorded download of a share, which its recipient can resume.
+
+    Every download that counts against max_downloads gets one, and its
+    token goes out as the download's Resume-Token. Each keeps its own
+    progress, so recipients of the same link never invalidate each
+    other's resumes.
+    """
+    share = models.ForeignKey(
+        SharePermission,
+        on_delete=models.CASCADE,
+        related_name='downloads'
+    )
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    served_until = models.BigIntegerField(
+        default=0,
+        help_text="Offset just past the furthest byte sent for this download"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'share download'
+        verbose_name_plural = 'share downloads'
+
+    def __str__(self):
+        return f"Download {self.token} of share {self.share_id}"
+
+    def is_resumable(self):
+        """Check if the download is still within SHARE_DOWNLOAD_RESUME_WINDOW"""
+        return timezone.now() - self.created_at <= settings.SHARE_DOWNLOAD_RESUME_WINDOW
+
+    def can_resume(self, byte_range):
+        """Check if a range continues the download, rather than skipping past what it was sent"""
+        return byte_range[0] <= self.served_until
+
+    def record_served(self, offset):
+        """Move served_until up to offset, unless a concurrent resume already got further"""
+        ShareDownload.objects.filter(pk=self.pk, served_until__lt=offset).update(served_until=offset)
+        self.served_until = max(self.served_until, offset)
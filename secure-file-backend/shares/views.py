@@ -11,13 +11,46 @@ from files.models import File
 from django.urls import reverse
 from rest_framework.views import APIView
 from django.http import FileResponse, HttpResponse, Http404
-from files.key_management import KeyManagement
+from files.serving import file_content_response
 import logging
 from django.utils.http import http_date
 import mimetypes
 
 logger = logging.getLogger(__name__)
 
+
+class ServedContent:
+    """
+    Response iterator that records how far into the content a share
+    download got, once the response is closed; a chunk counts as sent
+    when the server comes back for the next one.
+    """
+
+    def __init__(self, download, chunks, offset):
+        self.download = download
+        self.chunks = chunks
+        self.offset = offset
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+            self.offset += len(chunk)
+
+    def close(self):
+        self.download.record_served(self.offset)
+
+
+def track_served_content(response, download):
+    """Record how much of a share download's content a response sends, see ShareDownload.served_until"""
+    start = response.byte_range[0] if response.byte_range is not None else 0
+    if response.streaming:
+        response.streaming_content = ServedContent(download, response.streaming_content, start)
+    else:
+        # nginx sends X-Accel-Redirect content itself, the whole range is taken as sent
+        end = response.byte_range[1] + 1 if response.byte_range is not None else response.content_length
+        download.record_served(end)
+
+
 class FilePreviewView(APIView):
     """View for previewing files for authenticated users"""
     permission_classes = [permissions.IsAuthenticated]
@@ -25,14 +58,11 @@ class FilePreviewView(APIView):
     def get(self, request, file_id):
         try:
             # Get the file and verify ownership
-            file_instance = get_object_or_404(File, id=file_id)
+            file_instance = get_object_or_404(File.objects.with_inline_content(), id=file_id)
             if file_instance.user != request.user:
                 raise PermissionDenied("You don't have permission to preview this file")
             
-            # Get the server-side encrypted data
-            server_encrypted_data = file_instance.encrypted_content
-            
-            if not server_encrypted_data:
+            if not file_instance.has_content():
                 return Response(
                     {
                         "status": "error",
@@ -42,28 +72,14 @@ class FilePreviewView(APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Get the file key and decrypt it
-            file_key = file_instance.get_file_key()
-
-            # Decrypt the server-side encryption
-            client_encrypted_data = KeyManagement.decrypt_file(
-                server_encrypted_data,
-                file_key,
-                file_instance.server_side_iv
-            )
-            
-            # Create the response with the client-encrypted file
-            response = HttpResponse(
-                client_encrypted_data,
-                content_type=file_instance.mime_type
+            # Stream the client-encrypted file for preview
+            return file_content_response(
+                file_instance,
+                content_type=file_instance.mime_type,
+                disposition='inline',
+                request=request
             )
             
-            # Add headers for preview
-            response['Content-Disposition'] = f'inline; filename="{file_instance.filename}"'
-            response['Content-Length'] = len(client_encrypted_data)
-            
-            return response
-            
         except PermissionDenied as e:
             return Response(
                 {
@@ -73,6 +89,8 @@ class FilePreviewView(APIView):
                 },
                 status=status.HTTP_403_FORBIDDEN
             )
+        except Http404:
+            raise
         except Exception as e:
             logger.error(f"Error during file preview: {str(e)}", exc_info=True)
             return Response(
@@ -88,10 +106,10 @@ class SharePreviewView(APIView):
     """View for previewing publicly shared files"""
     permission_classes = []  # Allow public access
 
-    def get(self, request, share_token):
+    def get(self, request, token):
         try:
             # Get the share permission
-            share = SharePermission.objects.get(share_link_token=share_token)
+            share = SharePermission.objects.get(share_link_token=token, file__deleted_at__isnull=True)
             
             # Check if share has expired
             if share.expires_at and share.expires_at < timezone.now():
@@ -100,13 +118,10 @@ class SharePreviewView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
             
-            # Get the associated file
-            file = share.file
-            
-            # Get the server-side encrypted data
-            server_encrypted_data = file.encrypted_content
+            # Get the associated file, with its content if it is small enough
+            file = File.all_objects.with_inline_content().get(pk=share.file_id)
             
-            if not server_encrypted_data:
+            if not file.has_content():
                 return Response(
                     {
                         "status": "error",
@@ -116,32 +131,19 @@ class SharePreviewView(APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Get the file key and decrypt it
-            file_key = file.get_file_key()
-
-            # Decrypt the server-side encryption
-            client_encrypted_data = KeyManagement.decrypt_file(
-                server_encrypted_data,
-                file_key,
-                file.server_side_iv
-            )
-            
             # Determine content type
             content_type, encoding = mimetypes.guess_type(file.filename)
             if not content_type:
                 content_type = 'application/octet-stream'
             
-            # Create response with client-encrypted data
-            response = HttpResponse(
-                client_encrypted_data,
-                content_type=content_type
+            # Create streaming response with client-encrypted data
+            response = file_content_response(
+                file,
+                content_type=content_type,
+                disposition='inline',
+                request=request
             )
             
-            # Add headers for preview
-            response['Content-Disposition'] = f'inline; filename="{file.filename}"'
-            response['Content-Length'] = len(client_encrypted_data)
-            response['Last-Modified'] = http_date(timezone.now().timestamp())
-            
             # Security headers to prevent download/copy
             response['Content-Security-Policy'] = "default-src 'self'; object-src 'none'; base-uri 'none';"
             response['X-Content-Type-Options'] = 'nosniff'
@@ -166,7 +168,8 @@ class ShareDownloadView(APIView):
     permission_classes = []  # Allow public access
     
     def get_object(self, token):
-        share = get_object_or_404(SharePermission, share_link_token=token)
+        # Shares of trashed files are gone as far as recipients can tell
+        share = get_object_or_404(SharePermission, share_link_token=token, file__deleted_at__isnull=True)
         
         # Check if share has expired
         if share.expires_at and share.expires_at < timezone.now():
@@ -182,8 +185,9 @@ class ShareDownloadView(APIView):
                 "detail": "Downloads are not enabled for this share"
             })
             
-        # Check download limit
-        if not share.has_downloads_remaining():
+        # Check download limit, exhausted shares can still finish a resumed download
+        resume_token = self.request.headers.get('Resume-Token')
+        if not share.has_downloads_remaining() and not share.can_resume_download(resume_token):
             raise PermissionDenied({
                 "message": "Download limit reached",
                 "detail": "Maximum number of downloads reached"
@@ -194,12 +198,9 @@ class ShareDownloadView(APIView):
     def get(self, request, token):
         try:
             share = self.get_object(token)
-            file_instance = share.file
-            
-            # Get the server-side encrypted data from database
-            server_encrypted_data = file_instance.encrypted_content
+            file_instance = File.all_objects.with_inline_content().get(pk=share.file_id)
             
-            if not server_encrypted_data:
+            if not file_instance.has_content():
                 return Response(
                     {
                         "status": "error",
@@ -209,31 +210,48 @@ class ShareDownloadView(APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Get the file key and decrypt it
-            file_key = file_instance.get_file_key()
-
-            # Decrypt the server-side encryption
-            client_encrypted_data = KeyManagement.decrypt_file(
-                server_encrypted_data,
-                file_key,
-                file_instance.server_side_iv
-            )
-            
-            # Record the download
-            share.record_download()
-            
-            # Create the response with the client-encrypted file
-            response = HttpResponse(
-                client_encrypted_data,
-                content_type='application/octet-stream'  # Always binary for downloads
+            # Build the streaming response before counting the download
+            response = file_content_response(
+                file_instance,
+                content_type='application/octet-stream',  # Always binary for downloads
+                disposition='attachment',
+                request=request
             )
             
-            # Add headers for download
-            response['Content-Disposition'] = f'attachment; filename="{file_instance.filename}"'
-            response['Content-Length'] = len(client_encrypted_data)
+            # Range requests carrying the Resume-Token of a recorded download
+            # continue it and don't use up another one while it's resumable,
+            # as long as they don't skip past what it was sent; everything
+            # else that sends content counts as a new download and gets a
+            # Resume-Token of its own
+            if response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE:
+                return response
+            download = None
+            if response.byte_range is not None:
+                download = share.get_resumable_download(request.headers.get('Resume-Token'))
+                if download is not None and not download.can_resume(response.byte_range):
+                    download = None
+            if download is None:
+                if not share.has_downloads_remaining():
+                    response.close()
+                    raise PermissionDenied({
+                        "message": "Download limit reached",
+                        "detail": "Maximum number of downloads reached"
+                    })
+                download = share.record_download()
+                response['Resume-Token'] = str(download.token)
+            track_served_content(response, download)
             
             return response
             
+        except Http404:
+            return Response(
+                {
+                    "status": "error",
+                    "message": "Invalid share link",
+                    "detail": "This share link does not exist"
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
         except PermissionDenied as e:
             return Response(
                 {
@@ -370,7 +388,7 @@ class ShareLinkAccessView(APIView):
     def get(self, request, token):
         try:
             # Get the share permission
-            share = get_object_or_404(SharePermission, share_link_token=token)
+            share = get_object_or_404(SharePermission, share_link_token=token, file__deleted_at__isnull=True)
             
             # Check if share has expired
             if share.expires_at and share.expires_at < timezone.now():
@@ -404,7 +422,7 @@ class ShareLinkAccessView(APIView):
             
             return Response(response_data)
             
-        except SharePermission.DoesNotExist:
+        except (SharePermission.DoesNotExist, Http404):
             return Response(
                 {"error": "Invalid share link"},
                 status=status.HTTP_404_NOT_FOUND